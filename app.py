@@ -1,24 +1,162 @@
 import streamlit as st
-import openpyxl
-from openpyxl import Workbook
-import csv
-from docxtpl import DocxTemplate, InlineImage
-from docx.shared import Cm
+import pandas as pd
 import os
 import tempfile
-import shutil
-from pathlib import Path
 import zipfile
-import sys
-import pandas as pd
-import requests
+import time
+import uuid
 from requests.auth import HTTPBasicAuth
 
+import odk
+import dados
+import gerador
+import colunas
+from base_local import BaseLocal
+from instrumentacao import Instrumentacao
+from cache_anexos import CacheAnexos
+from cache_relatorios import CacheRelatorios
+from cache_exportacoes import CacheExportacoes
+from areas_trabalho import AreasTrabalho
+import conversor_pdf
+from imagens import preparar_imagem
+import tarefas
+from tarefas import GerenciadorTarefas
+
 st.set_page_config(page_title="Gerador de Relatórios SEPE", layout="wide")
 
 st.title("🏗️ Gerador de Relatórios de Vistoria")
 st.markdown("---")
 
+# Cache de anexos compartilhado por todas as sessões do servidor
+@st.cache_resource
+def obter_cache_anexos():
+    return CacheAnexos()
+
+cache_anexos = obter_cache_anexos()
+
+# Última exportação de cada formulário; o servidor continua checando a senha a cada busca
+@st.cache_resource
+def obter_cache_exportacoes():
+    return CacheExportacoes()
+
+# Gerações em segundo plano, compartilhadas por todas as sessões do servidor
+@st.cache_resource
+def obter_gerenciador_tarefas():
+    return GerenciadorTarefas(cache_anexos, cache_relatorios=CacheRelatorios())
+
+gerenciador_tarefas = obter_gerenciador_tarefas()
+
+# Pastas de trabalho por sessão, compartilhadas pelo gerenciador de limpeza
+@st.cache_resource
+def obter_areas_trabalho():
+    return AreasTrabalho()
+
+def area_trabalho_sessao():
+    """Pasta só desta sessão; arquivos temporários da tela vão nela, nunca numa pasta comum"""
+    if 'id_sessao' not in st.session_state:
+        st.session_state['id_sessao'] = uuid.uuid4().hex
+    return obter_areas_trabalho().obter(st.session_state['id_sessao'])
+
+def ler_arquivo(caminho):
+    """Função sem argumentos que lê o arquivo só quando o download é clicado"""
+    def ler():
+        with open(caminho, 'rb') as f:
+            return f.read()
+    return ler
+
+# LibreOffice e ponte UNO instalados no servidor (verificado uma vez)
+@st.cache_resource
+def verificar_pdf_disponivel():
+    return conversor_pdf.pdf_disponivel()
+
+# Opções de linhas por página nas tabelas de relatórios
+TAMANHOS_PAGINA = [25, 50, 100, 250]
+
+# Datasets interpretados, compartilhados entre execuções e sessões pelo hash do CSV
+@st.cache_resource(max_entries=8)
+def carregar_dataset(csv_hash, _csv_texto):
+    return dados.Dataset(_csv_texto)
+
+def definir_csv(csv_texto, fonte):
+    """Guarda o CSV carregado e o hash do conteúdo no session_state"""
+    st.session_state['csv_data'] = csv_texto
+    st.session_state['csv_hash'] = dados.hash_csv(csv_texto)
+    st.session_state['data_source'] = fonte
+
+def mostrar_metricas(resumo):
+    """Painel com os tempos por etapa, as fases dos relatórios e os relatórios mais lentos"""
+    st.caption(f"Início: {resumo['inicio']} · duração total: {resumo['segundos']:.1f} s")
+    st.dataframe(pd.DataFrame(resumo['etapas']), hide_index=True, width="stretch")
+    
+    contadores = resumo.get('contadores') or {}
+    if 'cache_relatorios_acertos' in contadores or 'cache_relatorios_faltas' in contadores:
+        st.caption(
+            f"Relatórios reaproveitados do cache: {contadores.get('cache_relatorios_acertos', 0)} · "
+            f"renderizados: {contadores.get('cache_relatorios_faltas', 0)}"
+        )
+    
+    relatorios = resumo.get('relatorios')
+    if relatorios:
+        col_m1, col_m2, col_m3, col_m4 = st.columns(4)
+        col_m1.metric("Relatórios", relatorios['quantidade'])
+        col_m2.metric("Mediana", f"{relatorios['mediana'] * 1000:.0f} ms")
+        col_m3.metric("P95", f"{relatorios['p95'] * 1000:.0f} ms")
+        col_m4.metric("Máximo", f"{relatorios['maximo'] * 1000:.0f} ms")
+        st.caption("Tempo somado por fase da renderização (segundos):")
+        st.dataframe(pd.DataFrame([relatorios['fases']]), hide_index=True, width="stretch")
+        if relatorios['lentos']:
+            st.caption("Relatórios bem mais lentos que a mediana:")
+            st.dataframe(
+                pd.DataFrame([
+                    {
+                        'relatorio': lento['relatorio'],
+                        'segundos': round(lento['segundos'], 3),
+                        'imagens (MB)': round(lento.get('bytes_imagens', 0) / (1024 * 1024), 2),
+                        'docx (MB)': round(lento.get('bytes', 0) / (1024 * 1024), 2),
+                    }
+                    for lento in relatorios['lentos']
+                ]),
+                hide_index=True, width="stretch"
+            )
+    
+    if resumo.get('perfil'):
+        st.caption("Perfil (cProfile) das funções mais caras:")
+        st.code(resumo['perfil'])
+
+def anexos_odk_sessao():
+    """Credenciais do ODK para baixar anexos sob demanda, ou None se os dados não vieram do ODK nesse modo"""
+    if st.session_state.get('data_source') == 'odk' and st.session_state.get('anexos_sob_demanda'):
+        return st.session_state.get('odk_credentials')
+    return None
+
+def mostrar_fotos(numero):
+    """Miniaturas das fotos de uma linha; no modo sob demanda, baixa só essas fotos para o cache"""
+    referencias = gerador.listar_imagens_referenciadas(st.session_state['csv_data'], [numero])
+    if not referencias:
+        st.info("Esta linha não tem fotos.")
+        return
+    
+    credenciais = anexos_odk_sessao()
+    if credenciais:
+        with st.spinner("Baixando fotos..."):
+            with odk.criar_sessao(credenciais['auth'], max_conexoes=credenciais['max_conexoes']) as sessao:
+                _, erros = odk.baixar_anexos_referenciados(
+                    sessao, credenciais['base_url'], referencias, cache_anexos,
+                    max_workers=credenciais['max_conexoes']
+                )
+        for _, erro in erros:
+            st.warning(erro)
+    
+    indice_midia = gerador.IndiceMidia(cache_anexos, [gerador.DIRETORIO_MIDIA_LOCAL])
+    colunas_fotos = st.columns(len(referencias))
+    for coluna, referencia in zip(colunas_fotos, referencias):
+        caminho = indice_midia.caminhos.get(referencia['nome'])
+        if caminho:
+            # Miniatura reduzida no servidor, para não mandar a foto original ao navegador
+            coluna.image(preparar_imagem(caminho, 5, 72), caption=referencia['nome'])
+        else:
+            coluna.caption(f"{referencia['nome']}: não encontrada")
+
 # Adicionar tabs para escolher fonte de dados
 tab1, tab2 = st.tabs(["📡 Conectar ao ODK Central", "📁 Upload de Arquivo CSV"])
 
@@ -58,10 +196,30 @@ with tab1:
             help="Senha do usuário"
         )
         
-        baixar_anexos = st.checkbox(
-            "Baixar anexos (imagens)",
+        modo_anexos = st.radio(
+            "Anexos (imagens)",
+            ['sob_demanda', 'todos', 'lote', 'nenhum'],
+            format_func={
+                'sob_demanda': "Sob demanda: só os dos relatórios gerados",
+                'todos': "Baixar todos ao conectar",
+                'lote': "Baixar todos ao conectar, numa exportação única",
+                'nenhum': "Não baixar",
+            }.get,
+            help="Sob demanda, a conexão busca só os dados e cada geração baixa apenas as fotos das linhas selecionadas"
+        )
+        
+        downloads_simultaneos = st.slider(
+            "Downloads simultâneos",
+            min_value=1,
+            max_value=32,
+            value=8,
+            help="Número de anexos baixados em paralelo"
+        )
+        
+        sincronizacao_incremental = st.checkbox(
+            "Sincronização incremental",
             value=True,
-            help="Baixa automaticamente as imagens enviadas no formulário"
+            help="Busca apenas as submissions e anexos novos desde a última conexão, usando a base local"
         )
     
     if st.button("🔄 Conectar e Buscar Dados", type="primary", use_container_width=True):
@@ -77,137 +235,83 @@ with tab1:
                     # Buscar submissions via API REST
                     st.info("Buscando dados do formulário...")
                     
-                    # Endpoint para submissions em formato .csv.zip
-                    csv_url = f"{base_url}/submissions.csv.zip"
-                    
-                    response = requests.get(csv_url, auth=auth)
-                    response.raise_for_status()
-                    
-                    # Extrair CSV do ZIP
-                    import io
-                    from zipfile import ZipFile
-                    
-                    zip_buffer = io.BytesIO(response.content)
-                    
-                    with ZipFile(zip_buffer, 'r') as zip_file:
-                        # Pegar o primeiro arquivo CSV do ZIP
-                        csv_filename = [f for f in zip_file.namelist() if f.endswith('.csv')][0]
-                        csv_content = zip_file.read(csv_filename).decode('utf-8')
-                    
-                    # Salvar em session_state para poder baixar depois
-                    st.session_state['csv_data'] = csv_content
-                    st.session_state['data_source'] = 'odk'
-                    st.session_state['odk_credentials'] = {
-                        'base_url': base_url,
-                        'auth': auth
-                    }
-                    
-                    # Contar registros
-                    num_linhas = len(csv_content.split('\n')) - 1  # -1 para excluir header
-                    
-                    # Baixar anexos se solicitado
-                    if baixar_anexos:
-                        st.info("Baixando anexos (imagens)...")
+                    with odk.criar_sessao(auth, max_conexoes=downloads_simultaneos) as sessao:
+                        instrumentacao = Instrumentacao('conexao odk')
                         
-                        # Criar diretórios para salvar as imagens
-                        # Tentar criar em C:/ se estiver em Windows
-                        local_media_dir = None
-                        if os.name == 'nt' or os.path.exists('C:/'):
-                            try:
-                                local_media_dir = 'C:/arquivos_sepe/media'
-                                os.makedirs(local_media_dir, exist_ok=True)
-                            except:
-                                local_media_dir = None
+                        # Com a sincronização incremental, só as submissions novas são buscadas
+                        base_local = BaseLocal() if sincronizacao_incremental else None
+                        with instrumentacao.etapa('busca_csv') as registro:
+                            csv_content, novas = odk.baixar_csv(sessao, base_url, base_local, obter_cache_exportacoes())
+                            registro['bytes'] = len(csv_content.encode('utf-8'))
+                        if novas is not None:
+                            st.info(f"{novas} submissions novas desde a última sincronização")
+                        
+                        # Salvar em session_state para poder baixar depois
+                        definir_csv(csv_content, 'odk')
+                        st.session_state['odk_credentials'] = {
+                            'base_url': base_url,
+                            'auth': auth,
+                            'max_conexoes': downloads_simultaneos
+                        }
+                        st.session_state['anexos_sob_demanda'] = modo_anexos == 'sob_demanda'
+                        st.session_state.pop('anexos_baixados', None)
                         
-                        # Sempre criar diretório temporário como fallback
-                        temp_media_dir = os.path.join(tempfile.gettempdir(), 'odk_media')
-                        os.makedirs(temp_media_dir, exist_ok=True)
+                        # Contar registros
+                        num_linhas = csv_content.count('\n')  # quebras de linha = linhas sem o header (sem copiar o texto)
                         
-                        try:
-                            # Buscar lista de submissions para pegar os IDs
-                            submissions_url = f"{base_url}/submissions"
-                            submissions_response = requests.get(submissions_url, auth=auth)
-                            submissions_response.raise_for_status()
-                            submissions_data = submissions_response.json()
-                            
-                            total_anexos = 0
-                            anexos_baixados = []
-                            
-                            # Para cada submission, baixar seus anexos
-                            for submission in submissions_data:
-                                instance_id = submission.get('instanceId')
+                        # Baixar anexos se solicitado (sob demanda, ficam para a geração)
+                        if modo_anexos in ('todos', 'lote'):
+                            try:
+                                # Baixar anexos em paralelo, mostrando o progresso
+                                barra_anexos = st.progress(0)
+                                texto_anexos = st.empty()
                                 
-                                # Buscar o ID do projeto (details-N_mero_ID) desta submission
-                                # Procurar no campo correto do JSON
-                                id_projeto = None
-                                if 'details' in submission and isinstance(submission['details'], dict):
-                                    id_projeto = submission['details'].get('N_mero_ID') or submission['details'].get('Numero_ID')
-                                elif 'details-N_mero_ID' in submission:
-                                    id_projeto = submission.get('details-N_mero_ID')
+                                def mostrar_progresso(etapa, concluidos, total):
+                                    barra_anexos.progress(concluidos / total)
+                                    if etapa == 'listando':
+                                        texto_anexos.text(f"Listando anexos: submission {concluidos} de {total}")
+                                    elif etapa == 'extraindo':
+                                        texto_anexos.text(f"Extraindo anexos da exportação: {concluidos} de {total}")
+                                    else:
+                                        texto_anexos.text(f"Baixando anexos: {concluidos} de {total}")
                                 
-                                # Buscar anexos desta submission
-                                attachments_url = f"{base_url}/submissions/{instance_id}/attachments"
-                                att_response = requests.get(attachments_url, auth=auth)
+                                # Na sincronização incremental, apenas submissions cujos anexos ainda não foram baixados
+                                if modo_anexos == 'lote':
+                                    texto_anexos.text("Baixando a exportação com os anexos...")
+                                with instrumentacao.etapa('download_anexos') as registro:
+                                    anexos_baixados, erros_anexos = odk.sincronizar_anexos(
+                                        sessao, base_url, cache_anexos, base_local,
+                                        max_workers=downloads_simultaneos,
+                                        progresso=mostrar_progresso,
+                                        em_lote=modo_anexos == 'lote'
+                                    )
+                                    registro['itens'] = len(anexos_baixados)
+                                    registro['bytes'] = sum(anexo['tamanho'] for anexo in anexos_baixados)
+                                    registro['erros'] = len(erros_anexos)
+                                total_anexos = len(anexos_baixados)
                                 
-                                if att_response.status_code == 200:
-                                    attachments = att_response.json()
-                                    
-                                    for attachment in attachments:
-                                        att_name = attachment.get('name')
-                                        
-                                        # Baixar o arquivo
-                                        att_download_url = f"{attachments_url}/{att_name}"
-                                        file_response = requests.get(att_download_url, auth=auth)
-                                        
-                                        if file_response.status_code == 200:
-                                            # Criar novo nome com ID do projeto
-                                            extensao = os.path.splitext(att_name)[1]
-                                            if id_projeto:
-                                                novo_nome = f"id{id_projeto}_{att_name}"
-                                            else:
-                                                novo_nome = att_name
-                                            
-                                            # Salvar em C:/ se possível (com nome original)
-                                            if local_media_dir:
-                                                try:
-                                                    file_path_local = os.path.join(local_media_dir, att_name)
-                                                    with open(file_path_local, 'wb') as f:
-                                                        f.write(file_response.content)
-                                                except Exception as e:
-                                                    st.warning(f"Erro ao salvar {att_name} localmente: {e}")
-                                            
-                                            # Sempre salvar no temporário
-                                            file_path_temp = os.path.join(temp_media_dir, att_name)
-                                            with open(file_path_temp, 'wb') as f:
-                                                f.write(file_response.content)
-                                            
-                                            anexos_baixados.append({
-                                                'nome_original': att_name,
-                                                'nome_com_id': novo_nome,
-                                                'path_temp': file_path_temp,
-                                                'data': file_response.content
-                                            })
-                                            
-                                            total_anexos += 1
-                            
-                            # Salvar lista de anexos no session_state
-                            st.session_state['anexos_baixados'] = anexos_baixados
-                            
-                            # Mensagem de sucesso adequada
-                            if local_media_dir and os.path.exists(local_media_dir):
-                                # Verificar se realmente salvou
-                                arquivos_salvos = os.listdir(local_media_dir) if os.path.exists(local_media_dir) else []
-                                if len(arquivos_salvos) > 0:
-                                    st.success(f"✅ {total_anexos} anexos baixados para C:/arquivos_sepe/media/")
-                                else:
-                                    st.warning(f"⚠️ {total_anexos} anexos baixados, mas não foi possível salvar em C:/arquivos_sepe/media/")
-                            else:
-                                st.success(f"✅ {total_anexos} anexos baixados")
-                        except Exception as e:
-                            st.warning(f"⚠️ Aviso ao baixar anexos: {str(e)}")
-                    
-                    st.success(f"✅ Conectado com sucesso! {num_linhas} registros encontrados.")
-                    st.rerun()
+                                barra_anexos.empty()
+                                texto_anexos.empty()
+                                
+                                for _, erro in erros_anexos[:10]:
+                                    st.warning(erro)
+                                if len(erros_anexos) > 10:
+                                    st.warning(f"... e mais {len(erros_anexos) - 10} erros ao baixar anexos")
+                                
+                                # Salvar lista de anexos no session_state
+                                st.session_state['anexos_baixados'] = anexos_baixados
+                                
+                                st.success(f"✅ {total_anexos} anexos disponíveis no cache")
+                            except Exception as e:
+                                st.warning(f"⚠️ Aviso ao baixar anexos: {str(e)}")
+                        
+                        # Tempos da conexão, mostrados depois do rerun e gravados no log de métricas
+                        st.session_state['metricas_conexao'] = instrumentacao.gravar_log(
+                            formulario=base_url, incremental=sincronizacao_incremental, novas=novas
+                        )
+                        
+                        st.success(f"✅ Conectado com sucesso! {num_linhas} registros encontrados.")
+                        st.rerun()
                     
             except Exception as e:
                 st.error(f"❌ Erro ao conectar: {str(e)}")
@@ -218,22 +322,29 @@ with tab2:
     csv_file_upload = st.file_uploader("Selecione o arquivo CSV", type=['csv'])
     
     if csv_file_upload:
-        st.session_state['csv_data'] = csv_file_upload.getvalue().decode('utf-8')
-        st.session_state['data_source'] = 'upload'
+        # Decodificar só quando um novo arquivo é enviado, não a cada execução do script
+        if st.session_state.get('csv_upload_id') != csv_file_upload.file_id:
+            definir_csv(csv_file_upload.getvalue().decode('utf-8'), 'upload')
+            st.session_state['csv_upload_id'] = csv_file_upload.file_id
         st.success("✅ Arquivo CSV carregado com sucesso!")
 
 st.markdown("---")
 
 # Verificar se há dados carregados (de qualquer fonte)
-csv_file = None
+dataset = None
 if 'csv_data' in st.session_state:
-    # Converter dados para formato compatível
-    from io import StringIO, BytesIO
-    csv_file = BytesIO(st.session_state['csv_data'].encode('utf-8'))
+    # CSV interpretado uma vez por conteúdo e reaproveitado nas próximas execuções
+    if 'csv_hash' not in st.session_state:
+        st.session_state['csv_hash'] = dados.hash_csv(st.session_state['csv_data'])
+    dataset = carregar_dataset(st.session_state['csv_hash'], st.session_state['csv_data'])
     
     fonte = "ODK Central" if st.session_state.get('data_source') == 'odk' else "Upload Manual"
     st.info(f"📊 Dados carregados de: **{fonte}**")
     
+    if st.session_state.get('data_source') == 'odk' and 'metricas_conexao' in st.session_state:
+        with st.expander("⏱️ Tempos da última conexão ao ODK"):
+            mostrar_metricas(st.session_state['metricas_conexao'])
+    
     # Botão para baixar imagens em ZIP (se houver anexos baixados)
     if 'anexos_baixados' in st.session_state and len(st.session_state['anexos_baixados']) > 0:
         st.subheader("📥 Download de Imagens")
@@ -241,26 +352,36 @@ if 'csv_data' in st.session_state:
         col_img1, col_img2 = st.columns(2)
         
         with col_img1:
-            st.info(f"**{len(st.session_state['anexos_baixados'])} imagens** disponíveis para download")
+            tamanho_mb = sum(anexo['tamanho'] for anexo in st.session_state['anexos_baixados']) / (1024 * 1024)
+            st.info(f"**{len(st.session_state['anexos_baixados'])} imagens** ({tamanho_mb:.1f} MB) disponíveis para download")
         
         with col_img2:
             # Criar ZIP com todas as imagens
             if st.button("📦 Baixar Todas as Imagens (ZIP)", use_container_width=True):
                 try:
-                    # Criar ZIP em memória
-                    zip_buffer = BytesIO()
-                    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                        for anexo in st.session_state['anexos_baixados']:
-                            # Usar o nome com ID do projeto
-                            zip_file.writestr(anexo['nome_com_id'], anexo['data'])
-                    
-                    zip_buffer.seek(0)
-                    
+                    # Montar o ZIP na pasta da sessão, lendo cada imagem do disco; ele fica lá até o
+                    # download ser clicado (e some com a pasta), então o botão não guarda o arquivo na memória
+                    zip_imagens = os.path.join(area_trabalho_sessao(), 'imagens_odk_com_id.zip')
+                    fd, zip_temp = tempfile.mkstemp(suffix='.zip', dir=area_trabalho_sessao())
+                    os.close(fd)
+                    try:
+                        with zipfile.ZipFile(zip_temp, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                            for anexo in st.session_state['anexos_baixados']:
+                                # Anexos removidos do cache desde a conexão ficam de fora
+                                if os.path.exists(anexo['caminho']):
+                                    # Usar o nome com ID do projeto
+                                    zip_file.write(anexo['caminho'], anexo['nome_com_id'])
+                        os.replace(zip_temp, zip_imagens)
+                    finally:
+                        if os.path.exists(zip_temp):
+                            os.remove(zip_temp)
+
                     st.download_button(
                         label="⬇️ Download ZIP com Imagens Renomeadas",
-                        data=zip_buffer,
+                        data=ler_arquivo(zip_imagens),
                         file_name="imagens_odk_com_id.zip",
                         mime="application/zip",
+                        on_click="ignore",
                         use_container_width=True
                     )
                     
@@ -270,173 +391,155 @@ if 'csv_data' in st.session_state:
         
         st.markdown("---")
 
-# Criar diretórios temporários
-@st.cache_resource
-def criar_diretorios_temp():
-    temp_dir = tempfile.mkdtemp()
-    dirs = {
-        'base': temp_dir,
-        'xlsx': os.path.join(temp_dir, 'arquivo_xlsx'),
-        'relatorios': os.path.join(temp_dir, 'relatorios_pdf'),
-        'media': os.path.join(temp_dir, 'media'),
-        'sem_media': os.path.join(temp_dir, 'sem_media'),
-        'modelo': os.path.join(temp_dir, 'modelo_relatorio')
-    }
-    for d in dirs.values():
-        os.makedirs(d, exist_ok=True)
-    return dirs
-
-def converter_csv_para_xlsx(csv_file, xlsx_path):
-    """Converte CSV para XLSX com coluna de numeração"""
-    wb = Workbook()
-    ws = wb.active
-    ws.title = 'dados_vistoria'
-    
-    # Decodificar o arquivo CSV
-    csv_content = csv_file.getvalue().decode('utf-8').splitlines()
-    csv_reader = csv.reader(csv_content, delimiter=',')
-    
-    for row_index, row in enumerate(csv_reader, start=1):
-        ws.cell(row=row_index, column=1, value=row_index)
-        for col_index, value in enumerate(row, start=2):
-            ws.cell(row=row_index, column=col_index, value=value)
-    
-    wb.save(xlsx_path)
-    return xlsx_path
+def paginacao(total, chave):
+    """Controles de página; retorna (número da página, linhas por página)"""
+    col_tamanho, col_pagina, col_info = st.columns([1, 1, 2])
+    with col_tamanho:
+        tamanho = st.selectbox("Linhas por página", TAMANHOS_PAGINA, key=f"tamanho_pagina_{chave}")
+    paginas = max(1, -(-total // tamanho))
+    with col_pagina:
+        numero = st.number_input("Página", min_value=1, max_value=paginas, value=1, key=f"pagina_{chave}")
+    with col_info:
+        st.caption(f"{total} relatórios, página {numero} de {paginas}")
+    return min(numero, paginas), tamanho
+
+def selecionar_relatorios(dataset):
+    """Busca, filtros e tabela paginada com caixas de seleção; retorna os números selecionados.
+
+    A seleção fica na sessão (por CSV) e é mantida ao trocar de página ou
+    de filtro; a tabela recebe só a página atual.
+    """
+    selecao = st.session_state.get('selecao')
+    if selecao is None or selecao['csv_hash'] != st.session_state['csv_hash']:
+        selecao = st.session_state['selecao'] = {
+            'csv_hash': st.session_state['csv_hash'], 'numeros': set(), 'versao': 0
+        }
+    numeros = selecao['numeros']
+
+    texto = st.text_input("🔍 Buscar por ID do projeto ou processo SEI", key="busca_relatorios")
+    col_tipo, col_cidade, col_periodo = st.columns(3)
+    with col_tipo:
+        tipos = st.multiselect("Tipo de relatório", dataset.valores_filtro('tipo'), key="filtro_tipos")
+    with col_cidade:
+        cidades = st.multiselect("Cidade / região", dataset.valores_filtro('cidade'), key="filtro_cidades")
+    with col_periodo:
+        periodo = None
+        limites = dataset.periodo_datas()
+        if limites:
+            datas = st.date_input("Período de envio", value=(), min_value=limites[0], max_value=limites[1],
+                                  format="DD/MM/YYYY", key="filtro_periodo")
+            if len(datas) == 2:
+                periodo = datas
+    posicoes = dataset.filtrar(texto, tipos, cidades, periodo)
+
+    col_todos, col_limpar = st.columns(2)
+    with col_todos:
+        if st.button(f"☑️ Selecionar os {len(posicoes)} filtrados", use_container_width=True):
+            numeros.update((posicoes + 1).tolist())
+            selecao['versao'] += 1
+    with col_limpar:
+        if st.button("✖️ Limpar seleção", use_container_width=True):
+            numeros.clear()
+            selecao['versao'] += 1
+
+    numero, tamanho = paginacao(len(posicoes), "selecao")
+    pagina = dataset.pagina(posicoes, numero, tamanho)
+    pagina.insert(0, 'Selecionar', pagina['#'].isin(numeros))
+    # Chave nova a cada página, filtro ou ação em massa, para a tabela não reaplicar edições antigas
+    chave = f"tabela_{hash((texto, tuple(tipos), tuple(cidades), periodo, numero, tamanho))}_{selecao['versao']}"
+    editada = st.data_editor(
+        pagina, key=chave, hide_index=True, width="stretch",
+        disabled=[coluna for coluna in pagina.columns if coluna != 'Selecionar'],
+        column_config={'Selecionar': st.column_config.CheckboxColumn("✔", width="small")}
+    )
+    for numero_relatorio, marcado in zip(editada['#'].tolist(), editada['Selecionar'].tolist()):
+        if marcado:
+            numeros.add(numero_relatorio)
+        else:
+            numeros.discard(numero_relatorio)
 
-def processar_relatorios(xlsx_path, modelo_path, dirs, indices_selecionados=None):
-    """Processa e gera os relatórios em DOCX"""
+    # Seleção por números, para quem já sabe quais linhas quer
+    numeros_digitados = st.text_input(
+        "Adicionar por número (separados por vírgula):",
+        placeholder="Ex: 1, 3, 5, 7-10",
+        help="Você pode usar vírgulas para separar números individuais ou hífen para intervalos"
+    )
+    if numeros_digitados and st.button("➕ Adicionar à seleção"):
+        try:
+            numeros.update(n for n in dados.interpretar_numeros(numeros_digitados) if n <= len(dataset))
+            selecao['versao'] += 1
+            st.rerun()
+        except ValueError as e:
+            st.error(f"❌ {e}. Use números separados por vírgula ou intervalos com hífen.")
+
+    if numeros:
+        ordenados = sorted(numeros)
+        amostra = ', '.join(map(str, ordenados[:20])) + (", ..." if len(ordenados) > 20 else "")
+        st.success(f"✅ {len(ordenados)} relatórios selecionados: {amostra}")
+    return sorted(numeros)
+
+def mostrar_tarefa(id_tarefa):
+    """Mostra o estado de uma geração em segundo plano; retorna True se ela ainda não terminou"""
+    tarefa = gerenciador_tarefas.obter(id_tarefa)
+    st.markdown(f"**Tarefa** `{id_tarefa}`")
+    if tarefa is None:
+        st.warning("⚠️ Tarefa não encontrada: o código está errado ou o resultado já expirou.")
+        return False
     
-    workbook = openpyxl.load_workbook(xlsx_path)
-    sheet = workbook['dados_vistoria']
-    list_values = list(sheet.values)
+    if tarefa['estado'] == tarefas.NA_FILA:
+        st.info(f"⏳ Na fila ({tarefa['total']} relatórios)")
+        return True
     
-    relatorios_gerados = []
-    progress_bar = st.progress(0)
-    status_text = st.empty()
+    if tarefa['estado'] == tarefas.EXECUTANDO:
+        st.progress(min(tarefa['concluidos'] / tarefa['total'], 1.0))
+        if tarefa['mensagem']:
+            # Etapa anterior à renderização (ex.: anexos sob demanda)
+            st.text(tarefa['mensagem'])
+        else:
+            st.text(f"Processando relatório {tarefa['concluidos']} de {tarefa['total']}: {tarefa['relatorio_atual'] or ''}")
+        return True
     
-    # Filtrar apenas os índices selecionados
-    if indices_selecionados:
-        dados_filtrados = [list_values[0]] + [list_values[i] for i in indices_selecionados if i < len(list_values)]
-    else:
-        dados_filtrados = list_values
+    if tarefa['metricas']:
+        with st.expander("⏱️ Tempos desta geração"):
+            mostrar_metricas(tarefa['metricas'])
     
-    total = len(dados_filtrados[1:])
+    if tarefa['estado'] == tarefas.FALHOU:
+        st.error(f"❌ Erro ao processar: {tarefa['mensagem']}")
+        return False
     
-    for idx, valores in enumerate(dados_filtrados[1:], 1):
-        status_text.text(f"Processando relatório {idx} de {total}: {valores[0]}")
-        progress_bar.progress(idx / total)
-        
-        doc = DocxTemplate(modelo_path)
-        
-        # Processar imagens
-        imagem1 = processar_imagem(doc, valores[17], dirs)
-        imagem2 = processar_imagem(doc, valores[18], dirs)
-        imagem3 = processar_imagem(doc, valores[19], dirs)
-        imagem4 = processar_imagem(doc, valores[20], dirs)
-        imagem5 = processar_imagem(doc, valores[21], dirs)
-        
-        # Formatar data se necessário (converter de YYYY-MM-DD para DD-MM-YYYY)
-        data_formatada = valores[2]
-        if valores[2] and isinstance(valores[2], str):
-            try:
-                # Tentar converter de ISO format para DD-MM-YYYY
-                from datetime import datetime
-                if 'T' in valores[2]:  # ISO format com hora
-                    dt = datetime.fromisoformat(valores[2].replace('Z', '+00:00'))
-                else:  # Formato YYYY-MM-DD
-                    dt = datetime.strptime(valores[2], '%Y-%m-%d')
-                data_formatada = dt.strftime('%d-%m-%Y')
-            except:
-                data_formatada = valores[2]  # Mantém original se falhar
-        
-        # Renderizar documento
-        doc.render({
-            'relatorio': valores[0],
-            'id_proj': valores[5],
-            'id_tipo_rel': valores[7],
-            'meta': valores[23],
-            'data': data_formatada,
-            'processo_sei': valores[6],
-            'cidade': valores[11],
-            'responsavel': valores[26],
-            'lat': valores[12],
-            'long': valores[13],
-            'observacao': valores[22],
-            'tipo_proj': valores[16],
-            'imagem_1': imagem1,
-            'imagem_2': imagem2,
-            'imagem_3': imagem3,
-            'imagem_4': imagem4,
-            'imagem_5': imagem5
-        })
-        
-        # Salvar documento DOCX
-        doc_name = os.path.join(dirs['relatorios'], f"{valores[0]}.docx")
-        doc.save(doc_name)
-        
-        relatorios_gerados.append(doc_name)
+    if tarefa['mensagem']:
+        # Aviso de uma tarefa concluída (ex.: anexos que não puderam ser baixados)
+        st.warning(f"⚠️ {tarefa['mensagem']}")
+    for relatorio, erro in tarefa['erros'][:10]:
+        st.warning(f"⚠️ Erro no relatório {relatorio}: {erro}")
+    if len(tarefa['erros']) > 10:
+        st.warning(f"... e mais {len(tarefa['erros']) - 10} relatórios com erro")
+    st.success(f"✅ {tarefa['gerados']} relatórios gerados com sucesso!")
     
-    progress_bar.empty()
-    status_text.empty()
-    
-    return relatorios_gerados
-
-def processar_imagem(doc, valor_imagem, dirs):
-    """Processa uma imagem para o relatório"""
-    if valor_imagem is None or valor_imagem == '':
-        # Tentar caminho local primeiro (Windows)
-        imagem_path = 'C:/arquivos_sepe/xxx.jpg'
-        if os.path.exists(imagem_path):
-            return InlineImage(doc, imagem_path, Cm(3))
-        
-        # Tentar baixar imagem padrão da internet
-        try:
-            default_image_url = "https://st2.depositphotos.com/12694644/47297/v/380/depositphotos_472972706-stock-illustration-image-available-sign-isolated-white.jpg"
-            temp_image_path = os.path.join(tempfile.gettempdir(), 'no_image_default.jpg')
-            
-            # Baixar apenas se não existir no temp
-            if not os.path.exists(temp_image_path):
-                response = requests.get(default_image_url)
-                if response.status_code == 200:
-                    with open(temp_image_path, 'wb') as f:
-                        f.write(response.content)
-            
-            if os.path.exists(temp_image_path):
-                return InlineImage(doc, temp_image_path, Cm(3))
-        except:
-            pass
-        
-        # Se tudo falhar, retornar None
-        return None
-    else:
-        # Tentar vários caminhos para encontrar a imagem
-        caminhos_possiveis = [
-            f'C:/arquivos_sepe/media/{valor_imagem}',  # Caminho local
-            os.path.join(tempfile.gettempdir(), 'odk_media', valor_imagem),  # Caminho temporário
-            os.path.join(dirs.get('media', ''), valor_imagem)  # Diretório temporário dos relatórios
-        ]
-        
-        for imagem_path in caminhos_possiveis:
-            if os.path.exists(imagem_path):
-                try:
-                    return InlineImage(doc, imagem_path, Cm(7))
-                except Exception as e:
-                    print(f"Erro ao processar imagem {imagem_path}: {e}")
-                    continue
-        
-        # Se não encontrar a imagem, usar imagem padrão
-        print(f"Imagem não encontrada: {valor_imagem}")
-        return processar_imagem(doc, None, dirs)
+    if os.path.exists(tarefa['zip_path']):
+        st.download_button(
+            label="📥 Download de Todos os Relatórios (ZIP)",
+            data=ler_arquivo(tarefa['zip_path']),
+            file_name="relatorios_vistoria.zip",
+            mime="application/zip",
+            on_click="ignore",
+            use_container_width=True,
+            key=f"download_{id_tarefa}"
+        )
+        expira = time.strftime('%d-%m-%Y %H:%M', time.localtime(tarefa['expira_em']))
+        st.caption(f"Disponível para download até {expira}")
+    return False
+
+def mostrar_tarefas(ids_tarefas, acompanhando):
+    """Lista as gerações da sessão; enquanto alguma roda, é reexecutado sozinho a cada 2 s"""
+    ativas = [mostrar_tarefa(id_tarefa) for id_tarefa in reversed(ids_tarefas)]
+    if acompanhando and not any(ativas):
+        # Todas terminaram: parar de consultar e atualizar a página inteira
+        st.rerun()
 
-def criar_zip(arquivos, zip_path):
-    """Cria um arquivo ZIP com os relatórios"""
-    with zipfile.ZipFile(zip_path, 'w') as zipf:
-        for arquivo in arquivos:
-            zipf.write(arquivo, os.path.basename(arquivo))
 
 # Interface principal
-dirs = criar_diretorios_temp()
+area_trabalho_sessao()
 
 col1, col2 = st.columns(2)
 
@@ -458,7 +561,7 @@ with col2:
         if os.path.exists('C:/arquivos_sepe/xxx.jpg'):
             st.success("✅ Imagem padrão local encontrada")
         else:
-            st.info("ℹ️ Usando imagem padrão da internet")
+            st.info("ℹ️ Usando imagem padrão do aplicativo")
         
         if os.path.exists('C:/arquivos_sepe/media'):
             num_imagens = len([f for f in os.listdir('C:/arquivos_sepe/media') if f.lower().endswith(('.jpg', '.jpeg', '.png'))])
@@ -467,79 +570,23 @@ with col2:
             st.warning("⚠️ Diretório de imagens não encontrado")
     else:
         st.info("**🌐 Modo Cloud**")
-        st.success("✅ Imagem padrão: Internet (depositphotos)")
+        st.success("✅ Imagem padrão: incluída no aplicativo")
         st.success("✅ Imagens do projeto: Download do ODK")
-        st.caption("Marque '✓ Baixar anexos' ao conectar ao ODK")
+        st.caption("Sob demanda, só as fotos dos relatórios gerados são baixadas")
 
 st.markdown("---")
 
 # Seção de preview e seleção de relatórios
-if csv_file is not None:
+if dataset is not None:
     st.subheader("📋 Visualizar e Selecionar Relatórios")
     
-    # Ler CSV permitindo colunas duplicadas
-    csv_file.seek(0)
-    csv_text = csv_file.read().decode('utf-8')
+    df = dataset.df
+    header = dataset.header
     
-    # Processar linha por linha
-    lines = csv_text.strip().split('\n')
-    
-    if len(lines) > 1:
-        import csv
-        
-        # Ler header usando csv.reader (trata vírgulas entre aspas)
-        header_reader = csv.reader([lines[0]])
-        original_cols = next(header_reader)
-        
-        # Fazer renomeação GARANTIDA de duplicatas
-        seen = {}
-        unique_cols = []
-        
-        for col in original_cols:
-            col = col.strip()
-            if col not in seen:
-                seen[col] = 0
-                unique_cols.append(col)
-            else:
-                seen[col] += 1
-                unique_cols.append(f"{col}_dup{seen[col]}")
-        
-        # Ler dados (pular header)
-        data_reader = csv.reader(lines[1:])
-        data_rows = [row for row in data_reader if row]  # Remove linhas vazias
-        
-        # Criar DataFrame COM NOMES ÚNICOS GARANTIDOS
-        df = pd.DataFrame(data_rows, columns=unique_cols)
-        
-        # VERIFICAÇÃO FINAL - se ainda houver duplicatas, adicionar índice
-        final_cols = []
-        for i, col in enumerate(df.columns):
-            if df.columns.tolist().count(col) > 1:
-                final_cols.append(f"{col}_idx{i}")
-            else:
-                final_cols.append(col)
-        
-        df.columns = final_cols
-        
-        # Adicionar coluna de numeração
-        df.insert(0, '#', range(1, len(df) + 1))
-        
-        header = df.columns.tolist()
-        
-        # DEBUG: Verificar se ainda há duplicatas
-        if len(header) != len(set(header)):
-            st.error(f"🔴 AINDA HÁ DUPLICATAS: {[h for h in header if header.count(h) > 1]}")
-            st.stop()
-        
-        # Formatar a coluna SubmissionDate se existir
-        submission_date_cols = [col for col in df.columns if 'SubmissionDate' in col and not col.endswith(tuple('0123456789'))]
-        if submission_date_cols:
-            try:
-                col_name = submission_date_cols[0]
-                df[col_name] = pd.to_datetime(df[col_name], errors='coerce')
-                df[col_name] = df[col_name].dt.strftime('%d-%m-%Y')
-            except:
-                pass
+    # DEBUG: Verificar se ainda há duplicatas
+    if len(header) != len(set(header)):
+        st.error(f"🔴 AINDA HÁ DUPLICATAS: {[h for h in header if header.count(h) > 1]}")
+        st.stop()
     
     if len(df) > 0:
         # Mostrar informações resumidas
@@ -557,133 +604,21 @@ if csv_file is not None:
         
         with col_sel2:
             if selecao_tipo == "Selecionar específicos":
-                # Mostrar colunas importantes para seleção
-                colunas_display = ['#']
-                
-                # Procurar coluna ID do Projeto
-                id_proj_cols = [col for col in header if 'N_mero_ID' in col or 'Numero_ID' in col or 'details-N' in col]
-                if id_proj_cols:
-                    colunas_display.append(id_proj_cols[0])
-                elif len(header) > 1:
-                    colunas_display.append(header[1])
-                
-                # Procurar coluna Tipo de Relatório
-                tipo_relat_cols = [col for col in header if 'Tipo_Relat' in col or 'Tipo_Relatorio' in col]
-                if tipo_relat_cols:
-                    colunas_display.append(tipo_relat_cols[0])
-                
-                # Adicionar SubmissionDate (procurar sem sufixo _dup)
-                submission_cols = [col for col in header if 'SubmissionDate' in col]
-                if submission_cols:
-                    colunas_display.append(submission_cols[0])
-                elif len(header) > 3:
-                    colunas_display.append(header[3])
-                
-                # Adicionar outras colunas importantes
-                cidade_cols = [col for col in header if 'cidade' in col.lower() or 'regiao' in col.lower()]
-                if cidade_cols:
-                    colunas_display.append(cidade_cols[0])
-                elif len(header) > 7:
-                    colunas_display.append(header[7])
-                
-                processo_cols = [col for col in header if 'processo' in col.lower() or 'sei' in col.lower()]
-                if processo_cols:
-                    colunas_display.append(processo_cols[0])
-                elif len(header) > 6:
-                    colunas_display.append(header[6])
-                
-                # REMOVER DUPLICATAS da lista de colunas_display
-                colunas_display_unique = []
-                for col in colunas_display:
-                    if col not in colunas_display_unique and col in df.columns:
-                        colunas_display_unique.append(col)
-                
-                # COPIAR DataFrame para evitar referência
-                df_display = df[colunas_display_unique].copy()
-                df_display = df_display.reset_index(drop=True)
-                
-                st.dataframe(df_display, width="stretch", height=400)
-                
-                # Input para seleção de números
-                numeros_selecionados = st.text_input(
-                    "Digite os números dos relatórios (separados por vírgula):",
-                    placeholder="Ex: 1, 3, 5, 7-10",
-                    help="Você pode usar vírgulas para separar números individuais ou hífen para intervalos"
-                )
-                
-                # Processar seleção
-                indices_selecionados = []
-                if numeros_selecionados:
-                    try:
-                        partes = numeros_selecionados.split(',')
-                        for parte in partes:
-                            parte = parte.strip()
-                            if '-' in parte:
-                                inicio, fim = map(int, parte.split('-'))
-                                indices_selecionados.extend(range(inicio, fim + 1))
-                            else:
-                                indices_selecionados.append(int(parte))
-                        
-                        indices_selecionados = sorted(set(indices_selecionados))
-                        st.success(f"✅ {len(indices_selecionados)} relatórios selecionados: {', '.join(map(str, indices_selecionados))}")
-                    except:
-                        st.error("❌ Formato inválido. Use números separados por vírgula ou intervalos com hífen.")
+                indices_selecionados = selecionar_relatorios(dataset)
             else:
-                # Mostrar TODOS os dados
-                colunas_display = ['#']
-                
-                # Procurar coluna ID do Projeto
-                id_proj_cols = [col for col in header if 'N_mero_ID' in col or 'Numero_ID' in col or 'details-N' in col]
-                if id_proj_cols:
-                    colunas_display.append(id_proj_cols[0])
-                elif len(header) > 1:
-                    colunas_display.append(header[1])
-                
-                # Procurar coluna Tipo de Relatório
-                tipo_relat_cols = [col for col in header if 'Tipo_Relat' in col or 'Tipo_Relatorio' in col]
-                if tipo_relat_cols:
-                    colunas_display.append(tipo_relat_cols[0])
-                
-                # Adicionar SubmissionDate (procurar sem sufixo _dup)
-                submission_cols = [col for col in header if 'SubmissionDate' in col]
-                if submission_cols:
-                    colunas_display.append(submission_cols[0])
-                elif len(header) > 3:
-                    colunas_display.append(header[3])
-                
-                # Adicionar outras colunas importantes
-                cidade_cols = [col for col in header if 'cidade' in col.lower() or 'regiao' in col.lower()]
-                if cidade_cols:
-                    colunas_display.append(cidade_cols[0])
-                elif len(header) > 7:
-                    colunas_display.append(header[7])
-                
-                processo_cols = [col for col in header if 'processo' in col.lower() or 'sei' in col.lower()]
-                if processo_cols:
-                    colunas_display.append(processo_cols[0])
-                elif len(header) > 6:
-                    colunas_display.append(header[6])
-                
-                tipo_proj_cols = [col for col in header if 'tipo' in col.lower() and 'proj' in col.lower()]
-                if tipo_proj_cols:
-                    colunas_display.append(tipo_proj_cols[0])
-                elif len(header) > 12:
-                    colunas_display.append(header[12])
-                
-                # REMOVER DUPLICATAS da lista de colunas_display
-                colunas_display_unique = []
-                for col in colunas_display:
-                    if col not in colunas_display_unique and col in df.columns:
-                        colunas_display_unique.append(col)
-                
-                # COPIAR DataFrame para evitar referência
-                df_display = df[colunas_display_unique].copy()
-                df_display = df_display.reset_index(drop=True)
-                
-                st.dataframe(df_display, width="stretch", height=400)
-                st.caption(f"📊 Mostrando todos os {len(df)} relatórios")
+                # Mostrar os dados uma página por vez
+                posicoes = dataset.filtrar()
+                numero, tamanho = paginacao(len(posicoes), "todos")
+                st.dataframe(dataset.pagina(posicoes, numero, tamanho, todas_colunas=True),
+                             width="stretch", hide_index=True)
                 
                 indices_selecionados = list(range(1, len(df) + 1))
+        
+        # As fotos só são buscadas quando o usuário pede para vê-las
+        with st.expander("🖼️ Fotos de um relatório"):
+            numero_fotos = st.number_input("Número do relatório (coluna #)", min_value=1, max_value=len(df), value=1)
+            if st.button("Mostrar fotos"):
+                mostrar_fotos(numero_fotos)
     else:
         st.warning("⚠️ O arquivo CSV está vazio.")
         indices_selecionados = []
@@ -693,54 +628,108 @@ else:
 st.markdown("---")
 
 # Botão de gerar com validação de seleção
-botao_habilitado = csv_file is not None and modelo_file is not None and len(indices_selecionados) > 0
+botao_habilitado = dataset is not None and modelo_file is not None and len(indices_selecionados) > 0
 
-if not botao_habilitado and csv_file is not None and modelo_file is not None:
+if not botao_habilitado and dataset is not None and modelo_file is not None:
     st.warning("⚠️ Nenhum relatório selecionado. Por favor, selecione ao menos um relatório.")
 
+processos_renderizacao = st.number_input(
+    "Processos de renderização",
+    min_value=1,
+    max_value=os.cpu_count() or 1,
+    value=min(4, os.cpu_count() or 1),
+    help="Número de relatórios renderizados em paralelo (um processo por núcleo)"
+)
+
+col_img_opt1, col_img_opt2 = st.columns(2)
+
+with col_img_opt1:
+    reduzir_imagens = st.checkbox(
+        "Reduzir fotos antes de embutir",
+        value=True,
+        help="Gira as fotos conforme o EXIF e reduz para a resolução escolhida na largura exibida (7 cm), diminuindo o tamanho dos relatórios"
+    )
+
+with col_img_opt2:
+    dpi_imagens = st.number_input(
+        "Resolução das fotos (DPI)",
+        min_value=72,
+        max_value=600,
+        value=150,
+        step=10,
+        disabled=not reduzir_imagens
+    )
+
+incluir_xlsx = st.checkbox(
+    "Incluir planilha XLSX com os dados no ZIP",
+    value=False,
+    help="Adiciona ao ZIP a planilha dados.xlsx com todas as linhas do CSV"
+)
+
+pdf_disponivel = verificar_pdf_disponivel()
+incluir_pdf = st.checkbox(
+    "Incluir PDF de cada relatório no ZIP",
+    value=False,
+    disabled=not pdf_disponivel,
+    help="Converte os relatórios com o LibreOffice enquanto eles são gerados" if pdf_disponivel
+    else "Requer o LibreOffice instalado no servidor"
+)
+
+capturar_perfil = st.checkbox(
+    "Capturar perfil (cProfile) da geração",
+    value=False,
+    help="Mostra as funções mais caras no painel de tempos; com vários processos, cobre só o processo principal"
+)
+
 if st.button("🚀 Gerar Relatórios", type="primary", use_container_width=True, disabled=not botao_habilitado):
     
-    if not csv_file:
+    if dataset is None:
         st.error("❌ Por favor, faça upload do arquivo CSV ou conecte ao ODK Central!")
     elif not modelo_file:
         st.error("❌ Por favor, faça upload do modelo DOCX!")
     else:
-        try:
-            with st.spinner("Processando..."):
-                
-                # Salvar modelo
-                modelo_path = os.path.join(dirs['modelo'], 'formulario.docx')
-                with open(modelo_path, 'wb') as f:
-                    f.write(modelo_file.getbuffer())
-                
-                # Converter CSV para XLSX
-                st.info("Convertendo CSV para XLSX...")
-                xlsx_path = os.path.join(dirs['xlsx'], 'dados.xlsx')
-                converter_csv_para_xlsx(csv_file, xlsx_path)
-                
-                # Processar relatórios
-                st.info("Gerando relatórios...")
-                relatorios = processar_relatorios(xlsx_path, modelo_path, dirs, indices_selecionados)
-                
-                # Criar ZIP
-                zip_path = os.path.join(dirs['base'], 'relatorios.zip')
-                criar_zip(relatorios, zip_path)
-                
-                st.success(f"✅ {len(relatorios)} relatórios gerados com sucesso!")
-                
-                # Download do ZIP
-                with open(zip_path, 'rb') as f:
-                    st.download_button(
-                        label="📥 Download de Todos os Relatórios DOCX (ZIP)",
-                        data=f,
-                        file_name="relatorios_vistoria.zip",
-                        mime="application/zip",
-                        use_container_width=True
-                    )
-                
-        except Exception as e:
-            st.error(f"❌ Erro ao processar: {str(e)}")
-            st.exception(e)
+        # Campos do modelo cujas colunas não foram achadas pelo nome no cabeçalho
+        _, por_posicao = colunas.resolver_mapeamento(dataset.cabecalho_csv)
+        if por_posicao:
+            st.warning(
+                f"⚠️ Colunas não encontradas pelo nome; lidas pela posição no CSV, confira nos relatórios: "
+                f"{', '.join(por_posicao)}"
+            )
+        
+        # A geração roda em segundo plano; a página só acompanha o progresso
+        id_tarefa = gerenciador_tarefas.enviar(
+            st.session_state['csv_data'], modelo_file.getvalue(), indices_selecionados,
+            diretorios_midia=[gerador.DIRETORIO_MIDIA_LOCAL],
+            workers=processos_renderizacao,
+            dpi_imagens=dpi_imagens if reduzir_imagens else None,
+            incluir_xlsx=incluir_xlsx,
+            perfil=capturar_perfil,
+            anexos_odk=anexos_odk_sessao(),
+            incluir_pdf=incluir_pdf
+        )
+        st.session_state.setdefault('tarefas', []).append(id_tarefa)
+        # O código na URL permite voltar à tarefa depois de recarregar a página
+        st.query_params['tarefa'] = id_tarefa
+        st.info(f"Geração enviada. Guarde o código da tarefa para baixar o resultado depois: `{id_tarefa}`")
+
+# Acompanhamento das gerações desta sessão (ou retomadas pelo código)
+ids_tarefas = st.session_state.setdefault('tarefas', [])
+codigo_url = st.query_params.get('tarefa')
+if codigo_url and codigo_url not in ids_tarefas:
+    ids_tarefas.append(codigo_url)
+
+with st.expander("🔁 Retomar uma geração pelo código da tarefa"):
+    codigo_informado = st.text_input("Código da tarefa", key="codigo_tarefa").strip()
+    if codigo_informado and codigo_informado not in ids_tarefas:
+        ids_tarefas.append(codigo_informado)
+
+if ids_tarefas:
+    st.subheader("📦 Gerações")
+    em_andamento = any(
+        (gerenciador_tarefas.obter(id_tarefa) or {}).get('estado') in tarefas.ESTADOS_ATIVOS
+        for id_tarefa in ids_tarefas
+    )
+    st.fragment(mostrar_tarefas, run_every=2 if em_andamento else None)(ids_tarefas, em_andamento)
 
 st.markdown("---")
 st.caption("Desenvolvido para SEPE - Sistema de Geração de Relatórios de Vistoria")
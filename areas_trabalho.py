@@ -0,0 +1,85 @@
+"""Pastas de trabalho de cada sessão do app, apagadas por inatividade e pelo espaço ocupado"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+DIRETORIO_SESSOES = os.path.join(tempfile.gettempdir(), 'sepe_sessoes')
+RETENCAO_SESSOES_SEGUNDOS = int(os.environ.get('SEPE_RETENCAO_SESSOES_H', '6')) * 3600
+LIMITE_SESSOES_BYTES = int(os.environ.get('SEPE_LIMITE_SESSOES_MB', '1024')) * 1024 * 1024
+
+# Intervalo mínimo entre duas limpezas
+INTERVALO_LIMPEZA = 300
+
+
+def tamanho_pasta(caminho):
+    """Total de bytes dos arquivos dentro da pasta (0 se ela não existe)"""
+    total = 0
+    for raiz, _, arquivos in os.walk(caminho):
+        for nome in arquivos:
+            try:
+                total += os.path.getsize(os.path.join(raiz, nome))
+            except OSError:
+                pass
+    return total
+
+
+class AreasTrabalho:
+    """Uma pasta por sessão, para que usuários simultâneos nunca gravem nos mesmos arquivos.
+
+    ``obter(id_sessao)`` cria a pasta na primeira vez e marca o acesso
+    (mtime) nas seguintes. A limpeza apaga as pastas sem acesso há mais de
+    ``retencao_segundos`` e, se o total ainda passar de ``limite_bytes``,
+    as de acesso mais antigo; roda no máximo a cada INTERVALO_LIMPEZA,
+    dentro de ``obter``.
+    """
+
+    def __init__(self, diretorio=DIRETORIO_SESSOES, retencao_segundos=RETENCAO_SESSOES_SEGUNDOS,
+                 limite_bytes=LIMITE_SESSOES_BYTES):
+        self.diretorio = diretorio
+        self.retencao_segundos = retencao_segundos
+        self.limite_bytes = limite_bytes
+        os.makedirs(diretorio, exist_ok=True)
+        self._lock = threading.Lock()
+        self._ultima_limpeza = 0
+
+    def obter(self, id_sessao):
+        """Caminho da pasta da sessão, criada se ainda não existe"""
+        pasta = os.path.join(self.diretorio, id_sessao)
+        os.makedirs(pasta, exist_ok=True)
+        os.utime(pasta)
+        if time.monotonic() - self._ultima_limpeza > INTERVALO_LIMPEZA:
+            self.limpar(manter=id_sessao)
+        return pasta
+
+    def limpar(self, manter=None):
+        """Apaga as pastas expiradas e as excedentes; retorna quantas foram apagadas"""
+        with self._lock:
+            self._ultima_limpeza = time.monotonic()
+            pastas = []
+            for entrada in os.scandir(self.diretorio):
+                if entrada.is_dir() and entrada.name != manter:
+                    try:
+                        pastas.append((entrada.stat().st_mtime, entrada.path))
+                    except FileNotFoundError:
+                        pass
+            pastas.sort()
+
+            limite = time.time() - self.retencao_segundos
+            remover = [caminho for acesso, caminho in pastas if acesso < limite]
+            restantes = [caminho for acesso, caminho in pastas if acesso >= limite]
+            tamanhos = {caminho: tamanho_pasta(caminho) for caminho in restantes}
+            total = sum(tamanhos.values())
+            if manter:
+                total += tamanho_pasta(os.path.join(self.diretorio, manter))
+            # As de acesso mais antigo primeiro, até voltar ao limite
+            for caminho in restantes:
+                if total <= self.limite_bytes:
+                    break
+                remover.append(caminho)
+                total -= tamanhos[caminho]
+
+            for caminho in remover:
+                shutil.rmtree(caminho, ignore_errors=True)
+            return len(remover)
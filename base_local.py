@@ -0,0 +1,197 @@
+"""Base local (SQLite) com as submissions já sincronizadas do ODK Central"""
+import csv
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+
+from colunas import MAPEAMENTO_CAMPOS, NOMES_DATA_ENVIO, NOMES_INSTANCE_ID, indice_coluna
+
+DIRETORIO_BASE_LOCAL = os.path.join(tempfile.gettempdir(), 'sepe_sync')
+
+
+class BaseLocal:
+    """Submissions e anexos de cada formulário, indexados por instanceId.
+
+    Cada formulário é identificado pela sua URL base na API do ODK Central.
+    Os arquivos dos anexos ficam no CacheAnexos; aqui fica só o registro
+    de quais anexos cada submission tem.
+    """
+
+    def __init__(self, diretorio=DIRETORIO_BASE_LOCAL):
+        self.diretorio = diretorio
+        os.makedirs(diretorio, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.conexao = sqlite3.connect(os.path.join(diretorio, 'submissions.db'), check_same_thread=False)
+        with self.conexao:
+            self.conexao.executescript("""
+                CREATE TABLE IF NOT EXISTS formularios (
+                    chave TEXT PRIMARY KEY,
+                    cabecalho TEXT NOT NULL,
+                    watermark TEXT
+                );
+                CREATE TABLE IF NOT EXISTS submissions (
+                    chave TEXT NOT NULL,
+                    instance_id TEXT NOT NULL,
+                    submission_date TEXT,
+                    id_projeto TEXT,
+                    linha TEXT NOT NULL,
+                    anexos_sincronizados INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (chave, instance_id)
+                );
+                CREATE TABLE IF NOT EXISTS anexos (
+                    chave TEXT NOT NULL,
+                    instance_id TEXT NOT NULL,
+                    nome TEXT NOT NULL,
+                    nome_com_id TEXT NOT NULL,
+                    caminho TEXT NOT NULL,
+                    PRIMARY KEY (chave, instance_id, nome)
+                );
+            """)
+
+    def obter_estado(self, chave):
+        """Retorna (cabeçalho, watermark) da última sincronização do formulário"""
+        with self._lock:
+            linha = self.conexao.execute(
+                "SELECT cabecalho, watermark FROM formularios WHERE chave = ?", (chave,)
+            ).fetchone()
+        if linha is None:
+            return None, None
+        return json.loads(linha[0]), linha[1]
+
+    def limpar(self, chave):
+        """Remove as submissions e anexos registrados de um formulário"""
+        with self._lock, self.conexao:
+            for tabela in ('formularios', 'submissions', 'anexos'):
+                self.conexao.execute(f"DELETE FROM {tabela} WHERE chave = ?", (chave,))
+
+    def gravar_submissions(self, chave, cabecalho, linhas):
+        """Insere ou atualiza submissions e avança o watermark (maior SubmissionDate)"""
+        col_id = indice_coluna(cabecalho, *NOMES_INSTANCE_ID)
+        col_data = indice_coluna(cabecalho, *NOMES_DATA_ENVIO)
+        col_projeto = indice_coluna(cabecalho, *MAPEAMENTO_CAMPOS['id_proj'][0])
+        if col_id is None or col_data is None:
+            raise ValueError("O CSV exportado não tem as colunas KEY e SubmissionDate")
+
+        _, watermark = self.obter_estado(chave)
+        registros = []
+        for linha in linhas:
+            data = linha[col_data]
+            if watermark is None or data > watermark:
+                watermark = data
+            id_projeto = linha[col_projeto] if col_projeto is not None and col_projeto < len(linha) else None
+            registros.append((chave, linha[col_id], data, id_projeto or None, json.dumps(linha)))
+
+        with self._lock, self.conexao:
+            self.conexao.executemany(
+                """INSERT INTO submissions (chave, instance_id, submission_date, id_projeto, linha)
+                   VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT (chave, instance_id) DO UPDATE SET
+                       submission_date = excluded.submission_date,
+                       id_projeto = excluded.id_projeto,
+                       linha = excluded.linha""",
+                registros
+            )
+            self.conexao.execute(
+                """INSERT INTO formularios (chave, cabecalho, watermark) VALUES (?, ?, ?)
+                   ON CONFLICT (chave) DO UPDATE SET
+                       cabecalho = excluded.cabecalho,
+                       watermark = excluded.watermark""",
+                (chave, json.dumps(cabecalho), watermark)
+            )
+
+    def gerar_csv(self, chave):
+        """Monta o CSV completo do formulário a partir das submissions armazenadas"""
+        cabecalho, _ = self.obter_estado(chave)
+        saida = io.StringIO()
+        if cabecalho is None:
+            return ''
+        writer = csv.writer(saida, lineterminator='\n')
+        writer.writerow(cabecalho)
+        with self._lock:
+            cursor = self.conexao.execute(
+                "SELECT linha FROM submissions WHERE chave = ? ORDER BY submission_date, instance_id", (chave,)
+            )
+            for (linha,) in cursor:
+                writer.writerow(json.loads(linha))
+        return saida.getvalue()
+
+    def submissions_sem_anexos(self, chave):
+        """Submissions cujos anexos ainda não foram baixados, no formato da API /submissions"""
+        with self._lock:
+            cursor = self.conexao.execute(
+                "SELECT instance_id, id_projeto FROM submissions WHERE chave = ? AND anexos_sincronizados = 0",
+                (chave,)
+            )
+            return [{'instanceId': instance_id, 'details-N_mero_ID': id_projeto} for instance_id, id_projeto in cursor]
+
+    def data_mais_antiga_sem_anexos(self, chave):
+        """Menor SubmissionDate entre as submissions cujos anexos ainda não foram baixados, ou None"""
+        with self._lock:
+            return self.conexao.execute(
+                "SELECT MIN(submission_date) FROM submissions WHERE chave = ? AND anexos_sincronizados = 0",
+                (chave,)
+            ).fetchone()[0]
+
+    def registrar_anexos(self, chave, anexos, instance_ids_concluidos):
+        """Registra anexos baixados e marca as submissions cujos anexos estão completos"""
+        with self._lock, self.conexao:
+            self.conexao.executemany(
+                """INSERT OR REPLACE INTO anexos (chave, instance_id, nome, nome_com_id, caminho)
+                   VALUES (?, ?, ?, ?, ?)""",
+                [
+                    (chave, anexo['instance_id'], anexo['nome_original'], anexo['nome_com_id'], anexo['caminho'])
+                    for anexo in anexos
+                ]
+            )
+            self.conexao.executemany(
+                "UPDATE submissions SET anexos_sincronizados = 1 WHERE chave = ? AND instance_id = ?",
+                [(chave, instance_id) for instance_id in instance_ids_concluidos]
+            )
+
+    def revalidar_anexos(self, chave):
+        """Reabre as submissions com anexos que saíram do cache (removidos pelo limite de tamanho).
+
+        O registro desses anexos é apagado e a submission volta a constar
+        como sem anexos, para que a próxima sincronização os baixe de novo.
+        Retorna quantas submissions foram reabertas.
+        """
+        with self._lock:
+            linhas = self.conexao.execute(
+                "SELECT instance_id, nome, caminho FROM anexos WHERE chave = ?", (chave,)
+            ).fetchall()
+            ausentes = [(instance_id, nome) for instance_id, nome, caminho in linhas if not os.path.exists(caminho)]
+            reabertas = {instance_id for instance_id, _ in ausentes}
+            with self.conexao:
+                self.conexao.executemany(
+                    "DELETE FROM anexos WHERE chave = ? AND instance_id = ? AND nome = ?",
+                    [(chave, instance_id, nome) for instance_id, nome in ausentes]
+                )
+                self.conexao.executemany(
+                    "UPDATE submissions SET anexos_sincronizados = 0 WHERE chave = ? AND instance_id = ?",
+                    [(chave, instance_id) for instance_id in reabertas]
+                )
+        return len(reabertas)
+
+    def listar_anexos(self, chave):
+        """Anexos do formulário cujos arquivos ainda estão no cache"""
+        with self._lock:
+            cursor = self.conexao.execute(
+                "SELECT instance_id, nome, nome_com_id, caminho FROM anexos WHERE chave = ? ORDER BY instance_id, nome",
+                (chave,)
+            )
+            linhas = cursor.fetchall()
+        return [
+            {
+                'instance_id': instance_id,
+                'nome_original': nome,
+                'nome_com_id': nome_com_id,
+                'caminho': caminho,
+                'tamanho': os.path.getsize(caminho)
+            }
+            for instance_id, nome, nome_com_id, caminho in linhas
+            if os.path.exists(caminho)
+        ]
@@ -0,0 +1,6 @@
+"""Medição de desempenho do pipeline com dados sintéticos e um ODK Central local.
+
+Uso, a partir da raiz do repositório:
+    python -m benchmarks.executar --linhas 100
+    python -m benchmarks.executar --linhas 10000 --relatorios 500 --processos 4 --saida resultado.json
+"""
@@ -0,0 +1,102 @@
+"""Exportações CSV no formato do ODK Central, fotos JPEG e modelo DOCX sintéticos"""
+import csv
+import io
+import random
+from datetime import datetime, timedelta
+
+from docx import Document
+from PIL import Image
+
+# Mesma disposição de colunas da exportação do formulário de vistoria (ver colunas.MAPEAMENTO_CAMPOS)
+CABECALHO = [
+    'SubmissionDate', 'details-data_vistoria', 'start', 'end', 'details-N_mero_ID',
+    'details-Processo_SEI', 'details-Tipo_Relat_rio', 'details-Regi_o', 'details-Endereco',
+    'details-Bairro', 'details-Cidade', 'local-Latitude', 'local-Longitude', 'local-Altitude',
+    'local-Accuracy', 'details-Tipo_Projeto', 'fotos-foto_1', 'fotos-foto_2', 'fotos-foto_3',
+    'fotos-foto_4', 'fotos-foto_5', 'details-Observa_o', 'details-Meta', 'SubmitterID',
+    'SubmitterName', 'details-Respons_vel', 'KEY',
+]
+COLUNAS_FOTO = range(16, 21)
+VARIAVEIS_MODELO = (
+    'relatorio', 'id_proj', 'id_tipo_rel', 'meta', 'data', 'processo_sei', 'cidade',
+    'responsavel', 'lat', 'long', 'observacao', 'tipo_proj',
+)
+
+CIDADES = ['Ceilândia', 'Taguatinga', 'Samambaia', 'Planaltina', 'Gama', 'Sobradinho', 'Brazlândia']
+TIPOS_RELATORIO = ['Vistoria inicial', 'Acompanhamento', 'Fiscalização', 'Encerramento']
+TIPOS_PROJETO = ['Obra', 'Reforma', 'Urbanização', 'Drenagem']
+
+
+def gerar_linhas(quantidade, fotos_por_linha=3, semente=0):
+    """Linhas sintéticas na ordem do CABECALHO, com datas de envio crescentes"""
+    aleatorio = random.Random(semente)
+    inicio = datetime(2024, 1, 1, 8, 0, 0)
+    for numero in range(quantidade):
+        enviado = inicio + timedelta(minutes=7 * numero)
+        instance_id = f"uuid:{semente:04d}{numero:012d}"
+        fotos = [
+            f"{1700000000000 + numero * 10 + k}.jpg" if k < fotos_por_linha else ''
+            for k in range(5)
+        ]
+        yield [
+            enviado.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            enviado.strftime('%Y-%m-%d'),
+            enviado.isoformat(),
+            (enviado + timedelta(minutes=20)).isoformat(),
+            str(10000 + numero),
+            f"00{aleatorio.randint(100, 999)}-{aleatorio.randint(10000000, 99999999)}/2024-{aleatorio.randint(10, 99)}",
+            aleatorio.choice(TIPOS_RELATORIO),
+            f"RA {aleatorio.randint(1, 33)}",
+            f"Quadra {aleatorio.randint(1, 50)}, Conjunto {aleatorio.choice('ABCDEFG')}, Lote {aleatorio.randint(1, 40)}",
+            'Setor ' + aleatorio.choice('NSLO'),
+            aleatorio.choice(CIDADES),
+            f"{-15.5 - aleatorio.random():.6f}",
+            f"{-47.5 - aleatorio.random():.6f}",
+            f"{1000 + aleatorio.random() * 200:.1f}",
+            f"{aleatorio.random() * 10:.1f}",
+            aleatorio.choice(TIPOS_PROJETO),
+            *fotos,
+            "Observações da vistoria, com vírgulas e \"aspas\". " * aleatorio.randint(1, 4),
+            f"Meta {aleatorio.randint(1, 12)}",
+            str(aleatorio.randint(1, 40)),
+            f"agente{aleatorio.randint(1, 40)}",
+            f"Responsável {aleatorio.randint(1, 40)}",
+            instance_id,
+        ]
+
+
+def gerar_csv(quantidade, fotos_por_linha=3, semente=0):
+    """Texto de uma exportação CSV com ``quantidade`` submissions"""
+    saida = io.StringIO()
+    escritor = csv.writer(saida)
+    escritor.writerow(CABECALHO)
+    escritor.writerows(gerar_linhas(quantidade, fotos_por_linha, semente))
+    return saida.getvalue()
+
+
+def gerar_jpegs(quantidade=8, largura=2000, altura=1500, qualidade=90, semente=0):
+    """Fotos JPEG distintas com ruído, para que a compressão se pareça com a de fotos reais"""
+    aleatorio = random.Random(semente)
+    fotos = []
+    for _ in range(quantidade):
+        base = Image.linear_gradient('L').resize((largura, altura)).rotate(aleatorio.randint(0, 359))
+        ruido = Image.effect_noise((largura, altura), aleatorio.randint(20, 60))
+        azul = Image.new('L', (largura, altura), aleatorio.randint(0, 255))
+        buffer = io.BytesIO()
+        Image.merge('RGB', (base, ruido, azul)).save(buffer, 'JPEG', quality=qualidade)
+        fotos.append(buffer.getvalue())
+    return fotos
+
+
+def criar_modelo(caminho):
+    """Modelo DOCX mínimo com todas as variáveis e as cinco imagens do relatório"""
+    documento = Document()
+    documento.add_heading('Relatório de Vistoria {{ relatorio }}', level=1)
+    tabela = documento.add_table(rows=len(VARIAVEIS_MODELO), cols=2)
+    for linha, variavel in zip(tabela.rows, VARIAVEIS_MODELO):
+        linha.cells[0].text = variavel
+        linha.cells[1].text = f"{{{{ {variavel} }}}}"
+    for numero in range(1, 6):
+        documento.add_paragraph(f"{{{{ imagem_{numero} }}}}")
+    documento.save(caminho)
+    return caminho
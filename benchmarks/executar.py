@@ -0,0 +1,205 @@
+"""Mede cada etapa do pipeline contra o ODK Central falso e imprime o resultado em JSON.
+
+Etapas: busca do CSV (completa, revalidada por ETag e incremental), listagem paginada das
+submissions, download dos anexos (um a um, numa exportação única e de novo
+depois de saírem do cache), leitura do CSV, conversão para XLSX,
+mapeamento dos campos, renderização dos relatórios e geração do ZIP (também com o cache de relatórios vazio e cheio).
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+
+from requests.auth import HTTPBasicAuth
+
+import dados
+import gerador
+import odk
+from base_local import BaseLocal
+from benchmarks.dados_sinteticos import criar_modelo, gerar_csv, gerar_jpegs
+from benchmarks.odk_falso import ServidorODKFalso
+from cache_anexos import CacheAnexos
+from cache_exportacoes import CacheExportacoes
+from cache_relatorios import CacheRelatorios
+from instrumentacao import Instrumentacao
+
+
+def bytes_enviados(servidor, rota):
+    return servidor.estatisticas.get(rota, (0, 0))[1]
+
+
+def executar(args, pasta):
+    instrumentacao = Instrumentacao('benchmark')
+    medir = instrumentacao.etapa
+    csv_texto = gerar_csv(args.linhas, args.fotos_por_linha, args.semente)
+    largura, altura = (int(v) for v in args.tamanho_foto.lower().split('x'))
+    fotos = gerar_jpegs(largura=largura, altura=altura, semente=args.semente)
+    modelo_path = args.modelo or criar_modelo(os.path.join(pasta, 'modelo.docx'))
+    indices = list(range(1, min(args.relatorios, args.linhas) + 1))
+
+    servidor = ServidorODKFalso(csv_texto, fotos, latencia=args.latencia)
+    base_url = servidor.iniciar()
+    try:
+        sessao = odk.criar_sessao(HTTPBasicAuth('benchmark', 'benchmark'), max_conexoes=args.downloads)
+
+        with medir('busca_csv') as registro:
+            csv_baixado, _ = odk.baixar_csv(sessao, base_url)
+            registro['itens'] = args.linhas
+            registro['bytes'] = bytes_enviados(servidor, 'csv')
+
+        # A primeira busca guarda a exportação; a segunda recebe 304 e não transfere o ZIP
+        cache_exportacoes = CacheExportacoes(os.path.join(pasta, 'exportacoes'))
+        odk.baixar_csv(sessao, base_url, cache_exportacoes=cache_exportacoes)
+        with medir('busca_csv_revalidada') as registro:
+            csv_revalidado, _ = odk.baixar_csv(sessao, base_url, cache_exportacoes=cache_exportacoes)
+            registro['itens'] = args.linhas
+            registro['nao_modificada'] = servidor.estatisticas.get('csv_304', (0, 0))[0]
+            registro['identica'] = csv_revalidado == csv_baixado
+
+        base = BaseLocal(os.path.join(pasta, 'base'))
+        with medir('sincronizacao_inicial') as registro:
+            registro['itens'] = odk.sincronizar_submissions(sessao, base_url, base)
+        with medir('sincronizacao_sem_novas') as registro:
+            registro['novas'] = odk.sincronizar_submissions(sessao, base_url, base)
+
+        with medir('listagem_submissions') as registro:
+            submissions = list(odk.iterar_submissions(sessao, base_url))
+            registro['itens'] = len(submissions)
+            registro['bytes'] = bytes_enviados(servidor, 'odata')
+
+        submissions = submissions[:args.anexos]
+        cache = CacheAnexos(os.path.join(pasta, 'cache'), limite_bytes=1 << 40)
+        with medir('download_anexos') as registro:
+            anexos, erros = odk.baixar_anexos(sessao, base_url, submissions, cache, max_workers=args.downloads)
+            registro['itens'] = len(anexos)
+            registro['bytes'] = sum(anexo['tamanho'] for anexo in anexos)
+            registro['erros'] = len(erros)
+        with medir('download_anexos_em_cache') as registro:
+            anexos, _ = odk.baixar_anexos(sessao, base_url, submissions, cache, max_workers=args.downloads)
+            registro['itens'] = len(anexos)
+
+        # Mesmos anexos numa só exportação com a mídia, num cache vazio
+        cache_lote = CacheAnexos(os.path.join(pasta, 'cache_lote'), limite_bytes=1 << 40)
+        with medir('download_anexos_em_lote') as registro:
+            anexos, erros, _ = odk.baixar_anexos_em_lote(sessao, base_url, cache_lote)
+            registro['itens'] = len(anexos)
+            registro['bytes'] = bytes_enviados(servidor, 'csv_midia')
+            registro['erros'] = len(erros)
+
+        # Anexos sincronizados pela base local, metade removida do cache (como faria o limite de
+        # tamanho): a sincronização seguinte deve baixá-los de novo
+        if args.linhas <= args.anexos:
+            cache_base = CacheAnexos(os.path.join(pasta, 'cache_base'), limite_bytes=1 << 40)
+            sincronizados, _ = odk.sincronizar_anexos(sessao, base_url, cache_base, base, max_workers=args.downloads)
+            removidos = {anexo['caminho'] for anexo in sincronizados[::2]}
+            for caminho in removidos:
+                os.remove(caminho)
+            with medir('sincronizacao_anexos_removidos') as registro:
+                anexos, erros = odk.sincronizar_anexos(sessao, base_url, cache_base, base, max_workers=args.downloads)
+                registro['itens'] = len(anexos)
+                registro['removidos'] = len(removidos)
+                registro['recuperados'] = len(anexos) == len(sincronizados)
+                registro['erros'] = len(erros)
+    finally:
+        servidor.parar()
+
+    with medir('leitura_csv') as registro:
+        registro['itens'] = len(dados.Dataset(csv_baixado))
+        registro['bytes'] = len(csv_baixado.encode('utf-8'))
+
+    with medir('conversao_xlsx') as registro:
+        xlsx_path = gerador.exportar_xlsx(csv_baixado, os.path.join(pasta, 'dados.xlsx'))
+        registro['itens'] = args.linhas
+        registro['bytes'] = os.path.getsize(xlsx_path)
+
+    with medir('mapeamento_campos') as registro:
+        registros = list(gerador.iterar_registros(csv_baixado, indices))
+        registro['itens'] = len(registros)
+
+    indice_midia = gerador.IndiceMidia(cache)
+    dpi_imagens = args.dpi or None
+    pasta_relatorios = os.path.join(pasta, 'relatorios')
+    os.makedirs(pasta_relatorios)
+    with medir('renderizacao_pasta') as registro:
+        gerados, erros = gerador.gerar_relatorios(
+            registros, modelo_path, pasta_relatorios, indice_midia.localizar,
+            workers=args.processos, dpi_imagens=dpi_imagens
+        )
+        registro['itens'] = len(gerados)
+        registro['bytes'] = sum(os.path.getsize(caminho) for caminho in gerados)
+        registro['erros'] = len(erros)
+
+    # Geração completa como no app: renderização direto no ZIP, com as fases de cada relatório
+    zip_path = os.path.join(pasta, 'relatorios.zip')
+    with medir('geracao_zip') as registro:
+        gerados, erros = gerador.gerar_zip(
+            csv_baixado, modelo_path, zip_path, indice_midia.localizar, indices,
+            workers=args.processos, dpi_imagens=dpi_imagens, instrumentacao=instrumentacao
+        )
+        registro['itens'] = len(gerados)
+        registro['bytes'] = os.path.getsize(zip_path)
+        registro['erros'] = len(erros)
+
+    # Duas gerações com o cache de relatórios: a primeira preenche, a segunda reaproveita tudo
+    cache_relatorios = CacheRelatorios(os.path.join(pasta, 'cache_relatorios'), limite_bytes=1 << 40)
+    for etapa in ('geracao_zip_cache_vazio', 'geracao_zip_cache_cheio'):
+        with medir(etapa) as registro:
+            # Instrumentação à parte, só para os contadores de acertos e faltas
+            contagem = Instrumentacao(etapa)
+            gerados, erros = gerador.gerar_zip(
+                csv_baixado, modelo_path, zip_path, indice_midia.localizar, indices,
+                workers=args.processos, dpi_imagens=dpi_imagens, instrumentacao=contagem,
+                cache_relatorios=cache_relatorios
+            )
+            registro['itens'] = len(gerados)
+            registro['erros'] = len(erros)
+            registro.update(contagem.contadores)
+
+    return {
+        'ambiente': {
+            'python': platform.python_version(),
+            'plataforma': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'parametros': {
+            chave: valor for chave, valor in vars(args).items() if chave != 'saida'
+        },
+        'etapas': instrumentacao.etapas,
+        'relatorios': instrumentacao.resumo_relatorios(),
+    }
+
+
+def criar_parser():
+    parser = argparse.ArgumentParser(description="Benchmark do pipeline de geração de relatórios")
+    parser.add_argument('--linhas', type=int, default=100, help="Submissions no CSV sintético (ex.: 100, 10000, 100000)")
+    parser.add_argument('--relatorios', type=int, default=100, help="Quantos relatórios renderizar (padrão: 100)")
+    parser.add_argument('--anexos', type=int, default=100, help="De quantas submissions baixar os anexos (padrão: 100)")
+    parser.add_argument('--fotos-por-linha', type=int, default=3, choices=range(6), help="Fotos por submission (0 a 5)")
+    parser.add_argument('--tamanho-foto', default='2000x1500', help="Dimensões das fotos sintéticas (padrão: 2000x1500)")
+    parser.add_argument('--latencia', type=float, default=0.0, help="Latência de cada requisição ao ODK falso, em segundos")
+    parser.add_argument('--downloads', type=int, default=8, help="Downloads simultâneos (padrão: 8)")
+    parser.add_argument('--processos', type=int, default=1, help="Processos de renderização (padrão: 1)")
+    parser.add_argument('--dpi', type=int, default=150, help="Resolução das fotos nos relatórios; 0 mantém o original")
+    parser.add_argument('--modelo', help="Modelo DOCX real (padrão: um modelo sintético)")
+    parser.add_argument('--semente', type=int, default=0, help="Semente dos dados sintéticos")
+    parser.add_argument('--saida', help="Arquivo onde gravar o JSON (padrão: só a saída padrão)")
+    return parser
+
+
+def main(argv=None):
+    args = criar_parser().parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix='sepe_benchmark_') as pasta:
+        resultado = executar(args, pasta)
+
+    texto = json.dumps(resultado, ensure_ascii=False, indent=2)
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as f:
+            f.write(texto + '\n')
+    print(texto)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
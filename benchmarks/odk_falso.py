@@ -0,0 +1,154 @@
+"""Servidor HTTP local que imita os endpoints do ODK Central usados pelo app"""
+import csv
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+import zipfile
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from benchmarks.dados_sinteticos import CABECALHO, COLUNAS_FOTO
+
+ROTA_FORMULARIO = re.compile(r'^/v1/projects/[^/]+/forms/[^/]+?(?=\.svc/|/|$)')
+
+
+class ServidorODKFalso:
+    """ODK Central em memória: submissions.csv.zip, /submissions, .svc/Submissions e /attachments.
+
+    ``latencia`` (segundos) é somada a cada requisição, para simular a rede.
+    Os filtros ``__system/submissionDate gt <data>`` e ``ge`` da exportação
+    CSV são respeitados; com ``attachments`` diferente de 'false' as fotos vão no ZIP
+    em ``media/``, como no ODK Central. A exportação leva ETag e responde
+    304 a If-None-Match igual (contado na rota 'csv_304'). A API OData pagina com ``$top`` e
+    ``$skip``. ``estatisticas`` conta requisições e bytes enviados por rota.
+    """
+
+    def __init__(self, csv_texto, fotos, latencia=0.0):
+        self.latencia = latencia
+        self.fotos = fotos
+        linhas = [linha for linha in csv.reader(io.StringIO(csv_texto)) if linha]
+        self.cabecalho, self.linhas = linhas[0], linhas[1:]
+        col_id = CABECALHO.index('KEY')
+        col_projeto = CABECALHO.index('details-N_mero_ID')
+        self.anexos = {
+            linha[col_id]: [linha[c] for c in COLUNAS_FOTO if linha[c]]
+            for linha in self.linhas
+        }
+        self.submissions = [
+            {'instanceId': linha[col_id], 'submissionDate': linha[0], 'reviewState': None}
+            for linha in self.linhas
+        ]
+        self.odata = [
+            {'__id': linha[col_id], 'details': {'N_mero_ID': linha[col_projeto]}}
+            for linha in self.linhas
+        ]
+        self.estatisticas = {}
+        self._lock = threading.Lock()
+        self._servidor = None
+
+    def foto(self, nome):
+        """Conteúdo do anexo: uma das fotos sintéticas, escolhida de forma estável pelo nome"""
+        return self.fotos[zlib.crc32(nome.encode()) % len(self.fotos)]
+
+    def exportar_csv_zip(self, filtro=None, com_anexos=False):
+        linhas = self.linhas
+        if filtro:
+            _, operador, watermark = filtro.split(' ', 2)
+            if operador == 'ge':
+                linhas = [linha for linha in linhas if linha[0] >= watermark.strip()]
+            else:
+                linhas = [linha for linha in linhas if linha[0] > watermark.strip()]
+        saida = io.StringIO()
+        escritor = csv.writer(saida)
+        escritor.writerow(self.cabecalho)
+        escritor.writerows(linhas)
+
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as arquivo:
+            arquivo.writestr('formulario.csv', saida.getvalue())
+            if com_anexos:
+                for linha in linhas:
+                    for c in COLUNAS_FOTO:
+                        if linha[c]:
+                            arquivo.writestr(f"media/{linha[c]}", self.foto(linha[c]), zipfile.ZIP_STORED)
+        return buffer.getvalue()
+
+    def _contar(self, rota, tamanho):
+        with self._lock:
+            quantidade, total = self.estatisticas.get(rota, (0, 0))
+            self.estatisticas[rota] = (quantidade + 1, total + tamanho)
+
+    def iniciar(self):
+        """Sobe o servidor numa thread e retorna a URL base do formulário"""
+        servidor_falso = self
+
+        class Manipulador(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def responder(self, rota, status, corpo, tipo='application/json', cabecalhos=()):
+                self.send_response(status)
+                self.send_header('Content-Type', tipo)
+                self.send_header('Content-Length', str(len(corpo)))
+                for nome, valor in cabecalhos:
+                    self.send_header(nome, valor)
+                self.end_headers()
+                # Contado antes de enviar, para que o cliente já veja o total ao receber a resposta
+                servidor_falso._contar(rota, len(corpo))
+                self.wfile.write(corpo)
+
+            def do_GET(self):
+                if servidor_falso.latencia:
+                    time.sleep(servidor_falso.latencia)
+                url = urlsplit(self.path)
+                params = parse_qs(url.query)
+                caminho = ROTA_FORMULARIO.sub('', unquote(url.path))
+                partes = caminho.strip('/').split('/')
+
+                if caminho == '/submissions.csv.zip':
+                    com_anexos = params.get('attachments', ['true'])[0] != 'false'
+                    corpo = servidor_falso.exportar_csv_zip(params.get('$filter', [None])[0], com_anexos)
+                    etag = f'"{hashlib.sha1(corpo).hexdigest()}"'
+                    if self.headers.get('If-None-Match') == etag:
+                        self.responder('csv_304', 304, b'', 'application/zip', [('ETag', etag)])
+                    else:
+                        rota = 'csv_midia' if com_anexos else 'csv'
+                        self.responder(rota, 200, corpo, 'application/zip', [('ETag', etag)])
+                elif caminho == '.svc/Submissions':
+                    pular = int(params.get('$skip', ['0'])[0])
+                    quantidade = int(params.get('$top', [str(len(servidor_falso.odata))])[0])
+                    pagina = servidor_falso.odata[pular:pular + quantidade]
+                    self.responder('odata', 200, json.dumps({'value': pagina}).encode())
+                elif caminho == '/submissions':
+                    self.responder('submissions', 200, json.dumps(servidor_falso.submissions).encode())
+                elif len(partes) == 3 and partes[0] == 'submissions' and partes[2] == 'attachments':
+                    nomes = servidor_falso.anexos.get(partes[1])
+                    if nomes is None:
+                        self.responder('anexos', 404, b'{}')
+                    else:
+                        corpo = json.dumps([{'name': nome, 'exists': True} for nome in nomes]).encode()
+                        self.responder('anexos', 200, corpo)
+                elif len(partes) == 4 and partes[0] == 'submissions' and partes[2] == 'attachments':
+                    if partes[3] in servidor_falso.anexos.get(partes[1], ()):
+                        self.responder('anexo', 200, servidor_falso.foto(partes[3]), 'image/jpeg')
+                    else:
+                        self.responder('anexo', 404, b'{}')
+                else:
+                    self.responder('outros', 404, b'{}')
+
+        self._servidor = ThreadingHTTPServer(('127.0.0.1', 0), Manipulador)
+        self._servidor.daemon_threads = True
+        threading.Thread(target=self._servidor.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._servidor.server_port}/v1/projects/1/forms/benchmark"
+
+    def parar(self):
+        if self._servidor:
+            self._servidor.shutdown()
+            self._servidor.server_close()
+            self._servidor = None
@@ -0,0 +1,237 @@
+"""Cache em disco dos anexos do ODK, endereçado por conteúdo e com limite de tamanho"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+DIRETORIO_CACHE = os.path.join(tempfile.gettempdir(), 'sepe_cache_anexos')
+LIMITE_CACHE_BYTES = int(os.environ.get('SEPE_LIMITE_CACHE_MB', '2048')) * 1024 * 1024
+
+
+class CacheAnexos:
+    """Guarda cada arquivo uma única vez, pelo hash SHA-256 do conteúdo.
+
+    Um índice mapeia (instanceId, nome do anexo) para o arquivo. Quando o
+    total passa de ``limite_bytes``, os arquivos usados há mais tempo são
+    removidos (LRU), exceto os fixados por um lote em andamento (``fixando``).
+    """
+
+    def __init__(self, diretorio=DIRETORIO_CACHE, limite_bytes=LIMITE_CACHE_BYTES):
+        self.diretorio = diretorio
+        self.limite_bytes = limite_bytes
+        self.blobs_dir = os.path.join(diretorio, 'blobs')
+        os.makedirs(self.blobs_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # Blobs em uso por lotes em andamento (hash -> número de lotes), que não podem ser removidos
+        self._fixados = Counter()
+        self.conexao = sqlite3.connect(os.path.join(diretorio, 'indice.db'), check_same_thread=False)
+        with self.conexao:
+            self.conexao.executescript("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT PRIMARY KEY,
+                    extensao TEXT NOT NULL,
+                    tamanho INTEGER NOT NULL,
+                    ultimo_acesso REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS indice (
+                    instance_id TEXT NOT NULL,
+                    nome TEXT NOT NULL,
+                    hash TEXT NOT NULL REFERENCES blobs (hash),
+                    PRIMARY KEY (instance_id, nome)
+                );
+                CREATE INDEX IF NOT EXISTS indice_nome ON indice (nome);
+            """)
+        self._total = self.conexao.execute("SELECT COALESCE(SUM(tamanho), 0) FROM blobs").fetchone()[0]
+
+    def _caminho_blob(self, hash_conteudo, extensao):
+        return os.path.join(self.blobs_dir, hash_conteudo[:2], hash_conteudo + extensao)
+
+    def _resolver(self, linha):
+        """Converte (hash, extensão) em caminho e marca o acesso; None se o arquivo sumiu"""
+        if linha is None:
+            return None
+        hash_conteudo, extensao = linha
+        caminho = self._caminho_blob(hash_conteudo, extensao)
+        if not os.path.exists(caminho):
+            return None
+        with self.conexao:
+            self.conexao.execute(
+                "UPDATE blobs SET ultimo_acesso = ? WHERE hash = ?", (time.time(), hash_conteudo)
+            )
+        return caminho
+
+    def _fixar(self, hash_conteudo, fixados):
+        """Fixa o blob para o lote dono do conjunto ``fixados`` (chamar com o lock)"""
+        if fixados is not None and hash_conteudo not in fixados:
+            fixados.add(hash_conteudo)
+            self._fixados[hash_conteudo] += 1
+
+    def obter(self, instance_id, nome, fixados=None):
+        """Caminho do anexo de uma submission, ou None se não estiver no cache"""
+        with self._lock:
+            linha = self.conexao.execute(
+                """SELECT b.hash, b.extensao FROM indice i JOIN blobs b ON b.hash = i.hash
+                   WHERE i.instance_id = ? AND i.nome = ?""",
+                (instance_id, nome)
+            ).fetchone()
+            caminho = self._resolver(linha)
+            if caminho is not None:
+                self._fixar(linha[0], fixados)
+            return caminho
+
+    @contextmanager
+    def fixando(self):
+        """Contexto de um lote: os anexos que ele obtém ou guarda não são removidos até o fim.
+
+        Entrega um LoteAnexos, usado no lugar do cache (mesmos métodos). Sem
+        isso, baixar as fotos de um lote maior que o limite removeria as
+        primeiras antes de os relatórios serem gerados. Enquanto houver
+        blobs fixados, o cache pode passar do limite; o excedente é removido
+        ao fim do lote.
+        """
+        lote = LoteAnexos(self)
+        try:
+            yield lote
+        finally:
+            with self._lock:
+                self._fixados.subtract(lote.fixados)
+                self._fixados += Counter()
+                if self._total > self.limite_bytes:
+                    self._remover_excedente()
+
+    def mapa_nomes(self):
+        """Dicionário nome do anexo -> caminho de todos os arquivos do cache"""
+        with self._lock:
+            linhas = self.conexao.execute(
+                """SELECT i.nome, b.hash, b.extensao FROM indice i JOIN blobs b ON b.hash = i.hash
+                   ORDER BY b.ultimo_acesso"""
+            ).fetchall()
+        # Em nomes repetidos, prevalece o arquivo usado mais recentemente
+        return {nome: self._caminho_blob(hash_conteudo, extensao) for nome, hash_conteudo, extensao in linhas}
+
+    def guardar(self, instance_id, nome, conteudo, fixados=None):
+        """Grava o conteúdo (se ainda não existir) e indexa; retorna o caminho do arquivo"""
+        hash_conteudo = hashlib.sha256(conteudo).hexdigest()
+
+        with self._lock:
+            caminho, novo = self._caminho_para_gravar(hash_conteudo, nome)
+            if novo:
+                # Gravar em arquivo temporário e renomear, para nunca expor um arquivo incompleto
+                os.makedirs(os.path.dirname(caminho), exist_ok=True)
+                fd, temporario = tempfile.mkstemp(dir=os.path.dirname(caminho))
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(conteudo)
+                os.replace(temporario, caminho)
+            self._indexar(instance_id, nome, hash_conteudo, caminho, len(conteudo), fixados)
+        return caminho
+
+    def guardar_fluxo(self, instance_id, nome, fluxo, tamanho_bloco=1024 * 1024, fixados=None):
+        """Como guardar, mas copia de um arquivo aberto (ex.: membro de um ZIP) em blocos.
+
+        O conteúdo vai para um arquivo temporário enquanto o hash é calculado,
+        então o anexo nunca fica inteiro na memória.
+        """
+        hash_conteudo = hashlib.sha256()
+        tamanho = 0
+        fd, temporario = tempfile.mkstemp(dir=self.blobs_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for bloco in iter(lambda: fluxo.read(tamanho_bloco), b''):
+                    hash_conteudo.update(bloco)
+                    f.write(bloco)
+                    tamanho += len(bloco)
+            hash_conteudo = hash_conteudo.hexdigest()
+
+            with self._lock:
+                caminho, novo = self._caminho_para_gravar(hash_conteudo, nome)
+                if novo:
+                    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+                    os.replace(temporario, caminho)
+                self._indexar(instance_id, nome, hash_conteudo, caminho, tamanho, fixados)
+        finally:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+        return caminho
+
+    def _caminho_para_gravar(self, hash_conteudo, nome):
+        """Caminho do blob e se ele ainda precisa ser gravado (chamar com o lock)"""
+        linha = self.conexao.execute(
+            "SELECT extensao FROM blobs WHERE hash = ?", (hash_conteudo,)
+        ).fetchone()
+        extensao = linha[0] if linha is not None else os.path.splitext(nome)[1].lower()
+        caminho = self._caminho_blob(hash_conteudo, extensao)
+        return caminho, not os.path.exists(caminho)
+
+    def _indexar(self, instance_id, nome, hash_conteudo, caminho, tamanho, fixados=None):
+        """Registra o blob (ou marca o acesso) e aponta o anexo para ele (chamar com o lock)"""
+        with self.conexao:
+            existente = self.conexao.execute(
+                "SELECT 1 FROM blobs WHERE hash = ?", (hash_conteudo,)
+            ).fetchone()
+            if existente is None:
+                self.conexao.execute(
+                    "INSERT INTO blobs (hash, extensao, tamanho, ultimo_acesso) VALUES (?, ?, ?, ?)",
+                    (hash_conteudo, os.path.splitext(caminho)[1], tamanho, time.time())
+                )
+                self._total += tamanho
+            else:
+                self.conexao.execute(
+                    "UPDATE blobs SET ultimo_acesso = ? WHERE hash = ?", (time.time(), hash_conteudo)
+                )
+            self.conexao.execute(
+                "INSERT OR REPLACE INTO indice (instance_id, nome, hash) VALUES (?, ?, ?)",
+                (instance_id, nome, hash_conteudo)
+            )
+        self._fixar(hash_conteudo, fixados)
+
+        if self._total > self.limite_bytes:
+            self._remover_excedente(manter=hash_conteudo)
+
+    def _remover_excedente(self, manter=None):
+        """Remove os arquivos menos usados recentemente até voltar ao limite"""
+        cursor = self.conexao.execute(
+            "SELECT hash, extensao, tamanho FROM blobs ORDER BY ultimo_acesso"
+        )
+        removidos = []
+        total = self._total
+        for hash_conteudo, extensao, tamanho in cursor:
+            if total <= self.limite_bytes:
+                break
+            if hash_conteudo == manter or hash_conteudo in self._fixados:
+                continue
+            try:
+                os.remove(self._caminho_blob(hash_conteudo, extensao))
+            except FileNotFoundError:
+                pass
+            removidos.append(hash_conteudo)
+            total -= tamanho
+
+        with self.conexao:
+            self.conexao.executemany("DELETE FROM indice WHERE hash = ?", [(h,) for h in removidos])
+            self.conexao.executemany("DELETE FROM blobs WHERE hash = ?", [(h,) for h in removidos])
+        self._total = total
+
+
+class LoteAnexos:
+    """Cache de anexos visto por um lote (ver CacheAnexos.fixando): tudo que passa por ele fica fixado"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.fixados = set()
+
+    def obter(self, instance_id, nome):
+        return self.cache.obter(instance_id, nome, self.fixados)
+
+    def guardar(self, instance_id, nome, conteudo):
+        return self.cache.guardar(instance_id, nome, conteudo, self.fixados)
+
+    def guardar_fluxo(self, instance_id, nome, fluxo, tamanho_bloco=1024 * 1024):
+        return self.cache.guardar_fluxo(instance_id, nome, fluxo, tamanho_bloco, self.fixados)
+
+    def mapa_nomes(self):
+        return self.cache.mapa_nomes()
@@ -0,0 +1,77 @@
+"""Cache em disco das exportações submissions.csv.zip, revalidadas com ETag / Last-Modified"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+DIRETORIO_CACHE_EXPORTACOES = os.path.join(tempfile.gettempdir(), 'sepe_cache_exportacoes')
+
+
+class CacheExportacoes:
+    """Guarda a última exportação de cada URL com os validadores que o servidor mandou.
+
+    Na próxima busca, ``cabecalhos_condicionais`` devolve If-None-Match e
+    If-Modified-Since; se o servidor responder 304, a cópia guardada é
+    usada sem baixar nada. Há uma entrada por URL e parâmetros (cada nova
+    exportação substitui a anterior), então o cache não cresce sozinho.
+    """
+
+    def __init__(self, diretorio=DIRETORIO_CACHE_EXPORTACOES):
+        self.diretorio = diretorio
+        os.makedirs(diretorio, exist_ok=True)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def chave(url, params=None):
+        texto = json.dumps([url, sorted((params or {}).items())])
+        return hashlib.sha256(texto.encode('utf-8')).hexdigest()
+
+    def _caminhos(self, chave):
+        base = os.path.join(self.diretorio, chave)
+        return base + '.zip', base + '.json'
+
+    def obter(self, chave):
+        """(caminho do arquivo, validadores) da exportação guardada, ou None"""
+        caminho, metadados_path = self._caminhos(chave)
+        try:
+            with open(metadados_path, encoding='utf-8') as f:
+                validadores = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if not os.path.exists(caminho):
+            return None
+        return caminho, validadores
+
+    def cabecalhos_condicionais(self, chave):
+        """Cabeçalhos da requisição condicional para a exportação guardada ({} se não há)"""
+        guardada = self.obter(chave)
+        if guardada is None:
+            return {}
+        validadores = guardada[1]
+        cabecalhos = {}
+        if validadores.get('etag'):
+            cabecalhos['If-None-Match'] = validadores['etag']
+        if validadores.get('last_modified'):
+            cabecalhos['If-Modified-Since'] = validadores['last_modified']
+        return cabecalhos
+
+    def guardar(self, chave, arquivo, etag=None, last_modified=None):
+        """Copia o arquivo (aberto, no início) para o cache com os validadores; retorna o caminho"""
+        caminho, metadados_path = self._caminhos(chave)
+        with self._lock:
+            # Gravar em arquivos temporários e renomear, para nunca expor uma exportação incompleta
+            fd, temporario = tempfile.mkstemp(dir=self.diretorio)
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    bloco = arquivo.read(1024 * 1024)
+                    if not bloco:
+                        break
+                    f.write(bloco)
+            os.replace(temporario, caminho)
+
+            fd, temporario = tempfile.mkstemp(dir=self.diretorio)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'etag': etag, 'last_modified': last_modified}, f)
+            os.replace(temporario, metadados_path)
+        return caminho
@@ -0,0 +1,117 @@
+"""Cache em disco dos relatórios já renderizados, pela chave das entradas de cada um"""
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from imagens import hash_arquivo
+
+DIRETORIO_CACHE_RELATORIOS = os.path.join(tempfile.gettempdir(), 'sepe_cache_relatorios')
+LIMITE_CACHE_RELATORIOS_BYTES = int(os.environ.get('SEPE_LIMITE_CACHE_RELATORIOS_MB', '1024')) * 1024 * 1024
+
+# Mudar quando a renderização mudar de forma que invalide os relatórios já guardados
+VERSAO_RENDERIZACAO = 1
+
+
+class CacheRelatorios:
+    """Guarda o DOCX de cada relatório pela chave das entradas que o produziram.
+
+    A chave (ver ``chave``) junta os valores da linha, o conteúdo do modelo
+    e o conteúdo das fotos; se nada disso mudou, o relatório é o mesmo e
+    não precisa ser renderizado de novo. Quando o total passa de
+    ``limite_bytes``, os relatórios usados há mais tempo são removidos (LRU).
+    """
+
+    def __init__(self, diretorio=DIRETORIO_CACHE_RELATORIOS, limite_bytes=LIMITE_CACHE_RELATORIOS_BYTES):
+        self.diretorio = diretorio
+        self.limite_bytes = limite_bytes
+        os.makedirs(diretorio, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.conexao = sqlite3.connect(os.path.join(diretorio, 'indice.db'), check_same_thread=False)
+        with self.conexao:
+            self.conexao.execute("""
+                CREATE TABLE IF NOT EXISTS relatorios (
+                    chave TEXT PRIMARY KEY,
+                    tamanho INTEGER NOT NULL,
+                    ultimo_acesso REAL NOT NULL
+                )
+            """)
+        self._total = self.conexao.execute("SELECT COALESCE(SUM(tamanho), 0) FROM relatorios").fetchone()[0]
+
+    @staticmethod
+    def chave(hash_modelo, registro, imagens, dpi_imagens=None):
+        """Hash das entradas de um relatório.
+
+        ``registro`` vem de gerador.iterar_registros e ``imagens`` de
+        IndiceMidia.localizar (caminho e largura de cada foto); as fotos
+        entram pelo hash do conteúdo, não pelo caminho.
+        """
+        fotos = [(hash_arquivo(imagem[0]), imagem[1]) if imagem else None for imagem in imagens]
+        entradas = [VERSAO_RENDERIZACAO, hash_modelo, registro, fotos, dpi_imagens]
+        return hashlib.sha256(json.dumps(entradas, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _caminho(self, chave):
+        return os.path.join(self.diretorio, chave[:2], chave + '.docx')
+
+    def obter(self, chave):
+        """Caminho do relatório guardado com esta chave, ou None"""
+        caminho = self._caminho(chave)
+        with self._lock:
+            linha = self.conexao.execute("SELECT 1 FROM relatorios WHERE chave = ?", (chave,)).fetchone()
+            if linha is None or not os.path.exists(caminho):
+                return None
+            with self.conexao:
+                self.conexao.execute(
+                    "UPDATE relatorios SET ultimo_acesso = ? WHERE chave = ?", (time.time(), chave)
+                )
+        return caminho
+
+    def guardar(self, chave, conteudo):
+        """Grava o DOCX renderizado com esta chave; retorna o caminho do arquivo"""
+        caminho = self._caminho(chave)
+        with self._lock:
+            # Gravar em arquivo temporário e renomear, para nunca expor um arquivo incompleto
+            os.makedirs(os.path.dirname(caminho), exist_ok=True)
+            fd, temporario = tempfile.mkstemp(dir=os.path.dirname(caminho))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(conteudo)
+            os.replace(temporario, caminho)
+
+            with self.conexao:
+                anterior = self.conexao.execute(
+                    "SELECT tamanho FROM relatorios WHERE chave = ?", (chave,)
+                ).fetchone()
+                self.conexao.execute(
+                    "INSERT OR REPLACE INTO relatorios (chave, tamanho, ultimo_acesso) VALUES (?, ?, ?)",
+                    (chave, len(conteudo), time.time())
+                )
+            self._total += len(conteudo) - (anterior[0] if anterior else 0)
+
+            if self._total > self.limite_bytes:
+                self._remover_excedente(manter=chave)
+        return caminho
+
+    def _remover_excedente(self, manter=None):
+        """Remove os relatórios menos usados recentemente até voltar ao limite"""
+        cursor = self.conexao.execute("SELECT chave, tamanho FROM relatorios ORDER BY ultimo_acesso")
+        removidos = []
+        total = self._total
+        for chave, tamanho in cursor:
+            if total <= self.limite_bytes:
+                break
+            if chave == manter:
+                continue
+            try:
+                os.remove(self._caminho(chave))
+            except FileNotFoundError:
+                pass
+            removidos.append(chave)
+            total -= tamanho
+
+        with self.conexao:
+            self.conexao.executemany("DELETE FROM relatorios WHERE chave = ?", [(c,) for c in removidos])
+        self._total = total
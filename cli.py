@@ -0,0 +1,213 @@
+"""Geração de relatórios em lote pela linha de comando, sem o Streamlit.
+
+Exemplos:
+    python cli.py --csv dados.csv --modelo formulario.docx --saida relatorios.zip
+    python cli.py --odk-url https://levantamentos.dflegal.df.gov.br --projeto 4 \\
+        --formulario aWX8oXGiD9zmcpDX7KtAer --usuario email@exemplo.com \\
+        --modelo formulario.docx --linhas 1-100,250 --processos 4 --saida relatorios.zip
+
+A senha do ODK Central é lida da variável de ambiente SEPE_ODK_SENHA ou
+pedida no terminal.
+"""
+import argparse
+import csv
+import getpass
+import io
+import os
+import sys
+import time
+
+from requests.auth import HTTPBasicAuth
+
+import colunas
+import dados
+import gerador
+import odk
+from base_local import BaseLocal, DIRETORIO_BASE_LOCAL
+from cache_anexos import CacheAnexos, DIRETORIO_CACHE, LIMITE_CACHE_BYTES
+from cache_exportacoes import CacheExportacoes, DIRETORIO_CACHE_EXPORTACOES
+from cache_relatorios import CacheRelatorios, DIRETORIO_CACHE_RELATORIOS
+from conversor_pdf import PROCESSOS_PDF, PoolConversorPDF
+from imagens import DPI_PADRAO
+from instrumentacao import ARQUIVO_LOG_METRICAS, Instrumentacao
+
+
+def contar_linhas(csv_texto):
+    """Número de linhas de dados do CSV (sem o cabeçalho e as linhas vazias)"""
+    return max(sum(1 for linha in csv.reader(io.StringIO(csv_texto)) if linha) - 1, 0)
+
+
+def criar_parser():
+    parser = argparse.ArgumentParser(
+        description="Gera os relatórios de vistoria (DOCX) num ZIP a partir de um CSV ou do ODK Central."
+    )
+
+    fonte = parser.add_argument_group("fonte dos dados (--csv ou ODK Central)")
+    fonte.add_argument('--csv', help="CSV exportado do ODK Central")
+    fonte.add_argument('--odk-url', help="URL base do servidor ODK Central")
+    fonte.add_argument('--projeto', default='4', help="ID numérico do projeto (padrão: 4)")
+    fonte.add_argument('--formulario', default='aWX8oXGiD9zmcpDX7KtAer', help="ID do formulário")
+    fonte.add_argument('--usuario', help="Email de usuário do ODK Central")
+    fonte.add_argument('--completa', action='store_true',
+                       help="Baixa a exportação completa em vez da sincronização incremental")
+    fonte.add_argument('--sem-anexos', action='store_true', help="Não baixa os anexos (imagens)")
+    fonte.add_argument('--anexos-em-lote', action='store_true',
+                       help="Baixa os anexos numa exportação única com a mídia, em vez de um a um")
+    fonte.add_argument('--downloads', type=int, default=8, help="Anexos baixados em paralelo (padrão: 8)")
+
+    geracao = parser.add_argument_group("geração")
+    geracao.add_argument('--modelo', required=True, help="Modelo DOCX do relatório")
+    geracao.add_argument('--saida', default='relatorios.zip', help="ZIP de saída (padrão: relatorios.zip)")
+    geracao.add_argument('--midia', action='append', default=[],
+                         help="Pasta com as imagens; pode ser repetido (a primeira tem prioridade)")
+    geracao.add_argument('--linhas', help="Linhas a gerar, ex.: 1-10,15 (padrão: todas)")
+    geracao.add_argument('--processos', type=int, default=1,
+                         help="Processos de renderização em paralelo (padrão: 1)")
+    geracao.add_argument('--dpi', type=int, default=DPI_PADRAO,
+                         help=f"Resolução das fotos no relatório; 0 mantém o original (padrão: {DPI_PADRAO})")
+    geracao.add_argument('--xlsx', action='store_true', help="Inclui a planilha dados.xlsx no ZIP")
+    geracao.add_argument('--pdf', action='store_true',
+                         help="Inclui no ZIP o PDF de cada relatório (requer o LibreOffice)")
+    geracao.add_argument('--processos-pdf', type=int, default=PROCESSOS_PDF,
+                         help=f"Instâncias do LibreOffice convertendo em paralelo (padrão: {PROCESSOS_PDF})")
+
+    medicao = parser.add_argument_group("medição")
+    medicao.add_argument('--perfil', help="Grava o perfil cProfile da execução neste arquivo .prof")
+    medicao.add_argument('--log-metricas', default=ARQUIVO_LOG_METRICAS,
+                         help="Arquivo JSON Lines onde o resumo dos tempos é acrescentado")
+
+    cache = parser.add_argument_group("cache")
+    cache.add_argument('--cache', default=DIRETORIO_CACHE, help="Pasta do cache de anexos")
+    cache.add_argument('--cache-mb', type=int, default=LIMITE_CACHE_BYTES // (1024 * 1024),
+                       help="Tamanho máximo do cache de anexos em MB")
+    cache.add_argument('--cache-relatorios', default=DIRETORIO_CACHE_RELATORIOS,
+                       help="Pasta do cache de relatórios já renderizados")
+    cache.add_argument('--sem-cache-relatorios', action='store_true',
+                       help="Renderiza todos os relatórios, sem reaproveitar os de gerações anteriores")
+    cache.add_argument('--cache-exportacoes', default=DIRETORIO_CACHE_EXPORTACOES,
+                       help="Pasta onde a exportação completa fica guardada para ser revalidada (ETag)")
+    cache.add_argument('--base-local', default=DIRETORIO_BASE_LOCAL,
+                       help="Pasta da base local da sincronização incremental")
+    return parser
+
+
+def imprimir_metricas(resumo):
+    """Tempos por etapa e relatórios mais lentos, na saída de erro"""
+    for etapa in resumo['etapas']:
+        detalhes = ', '.join(f"{chave}={valor}" for chave, valor in etapa.items() if chave not in ('etapa', 'segundos'))
+        print(f"  {etapa['etapa']:<22} {etapa['segundos']:>9.3f} s  {detalhes}", file=sys.stderr)
+    contadores = resumo['contadores']
+    if contadores:
+        print(f"  {', '.join(f'{nome}={valor}' for nome, valor in contadores.items())}", file=sys.stderr)
+    relatorios = resumo['relatorios']
+    if relatorios:
+        fases = ', '.join(f"{fase}={segundos:.2f}s" for fase, segundos in relatorios['fases'].items())
+        print(f"  relatórios: mediana {relatorios['mediana'] * 1000:.0f} ms, p95 {relatorios['p95'] * 1000:.0f} ms, "
+              f"máximo {relatorios['maximo'] * 1000:.0f} ms ({fases})", file=sys.stderr)
+        for lento in relatorios['lentos']:
+            print(f"  lento: relatório {lento['relatorio']} {lento['segundos']:.2f} s, "
+                  f"imagens {lento['bytes_imagens'] / (1024 * 1024):.1f} MB", file=sys.stderr)
+
+
+def carregar_odk(args, cache, instrumentacao):
+    """Busca o CSV (e os anexos, se pedidos) no ODK Central; retorna o texto do CSV"""
+    if not args.usuario:
+        raise SystemExit("Informe --usuario para conectar ao ODK Central")
+    senha = os.environ.get('SEPE_ODK_SENHA') or getpass.getpass("Senha do ODK Central: ")
+
+    base_url = f"{args.odk_url.rstrip('/')}/v1/projects/{args.projeto}/forms/{args.formulario}"
+    base = None if args.completa else BaseLocal(args.base_local)
+    with odk.criar_sessao(HTTPBasicAuth(args.usuario, senha), max_conexoes=args.downloads) as sessao:
+        with instrumentacao.etapa('busca_csv') as registro:
+            csv_texto, novas = odk.baixar_csv(sessao, base_url, base, CacheExportacoes(args.cache_exportacoes))
+            registro['bytes'] = len(csv_texto.encode('utf-8'))
+        if novas is not None:
+            print(f"{novas} submissions novas desde a última sincronização")
+
+        if not args.sem_anexos:
+            def mostrar_progresso(etapa, concluidos, total):
+                if concluidos == total or concluidos % 100 == 0:
+                    acao = {'listando': 'Listando', 'extraindo': 'Extraindo'}.get(etapa, 'Baixando')
+                    print(f"{acao} anexos: {concluidos} de {total}")
+
+            with instrumentacao.etapa('download_anexos') as registro:
+                anexos, erros = odk.sincronizar_anexos(
+                    sessao, base_url, cache, base, max_workers=args.downloads, progresso=mostrar_progresso,
+                    em_lote=args.anexos_em_lote
+                )
+                registro['itens'] = len(anexos)
+                registro['bytes'] = sum(anexo['tamanho'] for anexo in anexos)
+                registro['erros'] = len(erros)
+            for _, erro in erros:
+                print(erro, file=sys.stderr)
+            print(f"{len(anexos)} anexos disponíveis no cache")
+    return csv_texto
+
+
+def main(argv=None):
+    parser = criar_parser()
+    args = parser.parse_args(argv)
+    if bool(args.csv) == bool(args.odk_url):
+        raise SystemExit("Informe --csv ou --odk-url (um dos dois)")
+    try:
+        indices = dados.interpretar_numeros(args.linhas) if args.linhas else None
+    except ValueError as e:
+        parser.error(f"--linhas: {e}")
+
+    instrumentacao = Instrumentacao('cli', perfil=bool(args.perfil))
+    instrumentacao.iniciar_perfil()
+
+    cache = CacheAnexos(args.cache, args.cache_mb * 1024 * 1024)
+    if args.csv:
+        with open(args.csv, encoding='utf-8') as f:
+            csv_texto = f.read()
+    else:
+        csv_texto = carregar_odk(args, cache, instrumentacao)
+
+    _, por_posicao = colunas.resolver_mapeamento(next(csv.reader(io.StringIO(csv_texto)), []))
+    if por_posicao:
+        print(f"Aviso: colunas não encontradas pelo nome, lidas pela posição no CSV: {', '.join(por_posicao)}",
+              file=sys.stderr)
+
+    total = len(indices) if indices else contar_linhas(csv_texto)
+    if total == 0:
+        raise SystemExit("Nenhuma linha para gerar")
+
+    def mostrar_progresso(concluidos, relatorio):
+        print(f"Relatório {concluidos} de {total}: {relatorio}")
+
+    inicio = time.perf_counter()
+    with instrumentacao.etapa('indice_midia') as registro:
+        indice_midia = gerador.IndiceMidia(cache, args.midia + [gerador.DIRETORIO_MIDIA_LOCAL])
+        registro['itens'] = len(indice_midia)
+    conversor = None
+    if args.pdf:
+        try:
+            conversor = PoolConversorPDF(args.processos_pdf)
+        except (RuntimeError, ImportError) as e:
+            raise SystemExit(f"Não é possível gerar PDF: {e}")
+    try:
+        gerados, erros = gerador.gerar_zip(
+            csv_texto, args.modelo, args.saida, indice_midia.localizar, indices,
+            workers=max(1, min(args.processos, total)),
+            progresso=mostrar_progresso,
+            dpi_imagens=args.dpi or None,
+            incluir_xlsx=args.xlsx,
+            instrumentacao=instrumentacao,
+            cache_relatorios=None if args.sem_cache_relatorios else CacheRelatorios(args.cache_relatorios),
+            conversor_pdf=conversor
+        )
+    finally:
+        if conversor is not None:
+            conversor.fechar()
+    instrumentacao.parar_perfil(args.perfil)
+
+    for relatorio, erro in erros:
+        print(f"Erro no relatório {relatorio}: {erro}", file=sys.stderr)
+    print(f"{len(gerados)} relatórios gerados em {args.saida} ({time.perf_counter() - inicio:.1f} s)")
+    imprimir_metricas(instrumentacao.gravar_log(args.log_metricas, saida=args.saida, erros=len(erros)))
+    return 1 if erros else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""Colunas da exportação CSV do ODK Central, localizadas pelo nome em um só lugar.
+
+As colunas vêm com o prefixo do grupo do formulário (ex.: "details-N_mero_ID",
+"fotos-foto_1"), então um nome vale tanto sozinho quanto como sufixo depois
+de "-". Usado pela tela (dados), pelos relatórios (gerador), pela base
+local e pela exportação com mídia (odk).
+"""
+
+# Colunas que o ODK Central sempre exporta
+NOMES_INSTANCE_ID = ('KEY', 'instanceID')
+NOMES_DATA_ENVIO = ('SubmissionDate',)
+
+# Variável do modelo -> (nomes possíveis da coluna no CSV, posição da coluna no export atual).
+# A posição só é usada quando nenhum dos nomes aparece no cabeçalho, e quem gera avisa quando isso acontece.
+MAPEAMENTO_CAMPOS = {
+    'data': (('data_vistoria', 'Data_Vistoria', 'data'), 1),
+    'id_proj': (('N_mero_ID', 'Numero_ID'), 4),
+    'processo_sei': (('Processo_SEI', 'Processo_Sei', 'processo_sei'), 5),
+    'id_tipo_rel': (('Tipo_Relat_rio', 'Tipo_Relatorio'), 6),
+    'cidade': (('Cidade', 'cidade'), 10),
+    'lat': (('Latitude',), 11),
+    'long': (('Longitude',), 12),
+    'tipo_proj': (('Tipo_Projeto', 'Tipo_Proj'), 15),
+    'imagem_1': (('foto_1', 'Foto_1', 'imagem_1'), 16),
+    'imagem_2': (('foto_2', 'Foto_2', 'imagem_2'), 17),
+    'imagem_3': (('foto_3', 'Foto_3', 'imagem_3'), 18),
+    'imagem_4': (('foto_4', 'Foto_4', 'imagem_4'), 19),
+    'imagem_5': (('foto_5', 'Foto_5', 'imagem_5'), 20),
+    'observacao': (('Observa_o', 'Observacao'), 21),
+    'meta': (('Meta', 'meta'), 22),
+    'responsavel': (('Respons_vel', 'Responsavel'), 25),
+}
+
+
+def indice_coluna(cabecalho, *nomes):
+    """Índice da primeira coluna cujo nome é (ou termina com "-" e) um dos nomes, na ordem dos nomes; None se nenhuma"""
+    for nome in nomes:
+        for i, coluna in enumerate(cabecalho):
+            if coluna == nome or coluna.endswith(f"-{nome}"):
+                return i
+    return None
+
+
+def celula(linha, indice):
+    """Valor da coluna na linha, ou '' se a coluna não existe ou a linha é mais curta"""
+    return linha[indice] if indice is not None and indice < len(linha) else ''
+
+
+def resolver_mapeamento(cabecalho, mapeamento=MAPEAMENTO_CAMPOS):
+    """Resolve cada variável do modelo no índice da sua coluna no CSV.
+
+    Retorna (dicionário variável -> índice, variáveis resolvidas pela
+    posição por não terem nenhum dos nomes no cabeçalho).
+    """
+    colunas = {}
+    por_posicao = []
+    for variavel, (nomes, posicao) in mapeamento.items():
+        indice = indice_coluna(cabecalho, *nomes)
+        if indice is None:
+            indice = posicao
+            por_posicao.append(variavel)
+        colunas[variavel] = indice
+    return colunas, por_posicao
@@ -0,0 +1,217 @@
+"""Conversão dos relatórios DOCX para PDF com instâncias do LibreOffice (soffice) que ficam abertas.
+
+Cada processo do pool é um soffice headless iniciado uma vez, com perfil
+próprio, e controlado pela ponte UNO (módulo ``uno``, que acompanha o
+LibreOffice). Os documentos são abertos e exportados nele um após o outro,
+sem o custo de iniciar o LibreOffice a cada arquivo.
+"""
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+DIRETORIO_CONVERSOR = os.path.join(tempfile.gettempdir(), 'sepe_conversor_pdf')
+PROCESSOS_PDF = int(os.environ.get('SEPE_PROCESSOS_PDF', '2'))
+# Caminhos onde o soffice costuma estar, além do PATH
+EXECUTAVEIS_SOFFICE = (
+    os.environ.get('SEPE_SOFFICE'),
+    'soffice',
+    'libreoffice',
+    'C:/Program Files/LibreOffice/program/soffice.exe',
+    '/Applications/LibreOffice.app/Contents/MacOS/soffice',
+)
+# Tempo máximo para um soffice recém-iniciado aceitar a conexão
+ESPERA_INICIO_SEGUNDOS = 60
+
+
+def localizar_soffice():
+    """Caminho do executável do LibreOffice, ou None se não estiver instalado"""
+    for candidato in EXECUTAVEIS_SOFFICE:
+        if candidato:
+            caminho = shutil.which(candidato) or (candidato if os.path.isfile(candidato) else None)
+            if caminho:
+                return caminho
+    return None
+
+
+def _importar_uno(executavel):
+    """Importa o módulo uno; no Windows ele fica na pasta program do LibreOffice"""
+    try:
+        import uno
+    except ImportError:
+        pasta = os.path.dirname(os.path.realpath(executavel))
+        if pasta in sys.path:
+            raise
+        sys.path.append(pasta)
+        import uno
+    return uno
+
+
+def pdf_disponivel():
+    """Se a conversão para PDF pode ser usada (LibreOffice e ponte UNO instalados)"""
+    executavel = localizar_soffice()
+    if executavel is None:
+        return False
+    try:
+        _importar_uno(executavel)
+    except ImportError:
+        return False
+    return True
+
+
+def _porta_livre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class InstanciaSoffice:
+    """Um soffice headless escutando numa porta local, com o Desktop UNO já conectado"""
+
+    def __init__(self, executavel, uno, diretorio):
+        self.uno = uno
+        self.diretorio = diretorio
+        os.makedirs(diretorio, exist_ok=True)
+        porta = _porta_livre()
+        conexao = f"socket,host=127.0.0.1,port={porta};urp;StarOffice.ComponentContext"
+        self.processo = subprocess.Popen(
+            [
+                executavel, '--headless', '--invisible', '--nologo', '--norestore', '--nodefault',
+                '--nolockcheck',
+                # Perfil próprio: instâncias que compartilham o perfil se bloqueiam
+                f"-env:UserInstallation={uno.systemPathToFileUrl(os.path.join(diretorio, 'perfil'))}",
+                f"--accept={conexao}",
+            ],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+        contexto_local = uno.getComponentContext()
+        resolvedor = contexto_local.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', contexto_local
+        )
+        limite = time.monotonic() + ESPERA_INICIO_SEGUNDOS
+        while True:
+            try:
+                contexto = resolvedor.resolve(f"uno:{conexao}")
+                break
+            except Exception:
+                if self.processo.poll() is not None or time.monotonic() > limite:
+                    self.processo.kill()
+                    raise RuntimeError("O LibreOffice não iniciou a tempo para converter para PDF")
+                time.sleep(0.25)
+        self.desktop = contexto.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', contexto)
+
+    def _propriedades(self, **valores):
+        propriedades = []
+        for nome, valor in valores.items():
+            propriedade = self.uno.createUnoStruct('com.sun.star.beans.PropertyValue')
+            propriedade.Name = nome
+            propriedade.Value = valor
+            propriedades.append(propriedade)
+        return tuple(propriedades)
+
+    def converter(self, conteudo_docx):
+        """Converte o DOCX (bytes) e retorna o PDF (bytes)"""
+        docx_path = os.path.join(self.diretorio, 'entrada.docx')
+        pdf_path = os.path.join(self.diretorio, 'saida.pdf')
+        with open(docx_path, 'wb') as f:
+            f.write(conteudo_docx)
+        documento = self.desktop.loadComponentFromURL(
+            self.uno.systemPathToFileUrl(docx_path), '_blank', 0, self._propriedades(Hidden=True)
+        )
+        try:
+            documento.storeToURL(
+                self.uno.systemPathToFileUrl(pdf_path), self._propriedades(FilterName='writer_pdf_Export')
+            )
+        finally:
+            documento.close(True)
+        with open(pdf_path, 'rb') as f:
+            return f.read()
+
+    def ativa(self):
+        return self.processo.poll() is None
+
+    def encerrar(self):
+        try:
+            if self.ativa():
+                self.desktop.terminate()
+            self.processo.wait(timeout=10)
+        except Exception:
+            self.processo.kill()
+
+
+class PoolConversorPDF:
+    """Pool de instâncias do soffice que convertem DOCX em PDF em segundo plano.
+
+    ``converter(conteudo_docx)`` põe o documento na fila e devolve um
+    Future com (bytes do PDF, segundos da conversão), de modo que a
+    conversão corre junto com a renderização dos próximos relatórios. A
+    fila guarda no máximo ``max_pendentes`` documentos; com ela cheia,
+    ``converter`` espera, para que a memória não cresça com o lote. Cada
+    uma das ``processos`` threads tem o seu soffice, iniciado no primeiro
+    documento e mantido aberto; se ele cair, é reiniciado no documento
+    seguinte. ``fechar`` encerra as instâncias.
+    """
+
+    def __init__(self, processos=PROCESSOS_PDF, executavel=None, diretorio=DIRETORIO_CONVERSOR):
+        self.executavel = executavel or localizar_soffice()
+        if self.executavel is None:
+            raise RuntimeError("LibreOffice (soffice) não encontrado; defina SEPE_SOFFICE com o caminho do executável")
+        self.uno = _importar_uno(self.executavel)
+        os.makedirs(diretorio, exist_ok=True)
+        self.diretorio = tempfile.mkdtemp(prefix='pool_', dir=diretorio)
+
+        processos = max(1, processos)
+        self.max_pendentes = 2 * processos
+        self._fila = queue.Queue(maxsize=self.max_pendentes)
+        self._threads = [
+            threading.Thread(target=self._trabalhar, args=(numero,), name=f'soffice-{numero}', daemon=True)
+            for numero in range(processos)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def converter(self, conteudo_docx):
+        futuro = Future()
+        self._fila.put((futuro, conteudo_docx))
+        return futuro
+
+    def _trabalhar(self, numero):
+        instancia = None
+        try:
+            while True:
+                item = self._fila.get()
+                if item is None:
+                    return
+                futuro, conteudo_docx = item
+                if not futuro.set_running_or_notify_cancel():
+                    continue
+                inicio = time.perf_counter()
+                try:
+                    if instancia is None or not instancia.ativa():
+                        instancia = InstanciaSoffice(
+                            self.executavel, self.uno, os.path.join(self.diretorio, str(numero))
+                        )
+                    futuro.set_result((instancia.converter(conteudo_docx), time.perf_counter() - inicio))
+                except Exception as e:
+                    futuro.set_exception(e)
+                    # Instância em estado desconhecido: começar outra no próximo documento
+                    if instancia is not None:
+                        instancia.encerrar()
+                        instancia = None
+        finally:
+            if instancia is not None:
+                instancia.encerrar()
+
+    def fechar(self):
+        for _ in self._threads:
+            self._fila.put(None)
+        for thread in self._threads:
+            thread.join()
+        shutil.rmtree(self.diretorio, ignore_errors=True)
@@ -0,0 +1,234 @@
+"""Leitura do CSV de submissions para a tela de seleção (DataFrame e projeções de exibição)"""
+import csv
+import hashlib
+import io
+import threading
+from collections import Counter, OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from colunas import MAPEAMENTO_CAMPOS, NOMES_DATA_ENVIO, indice_coluna
+
+# Resultados de filtros guardados por dataset
+CONSULTAS_GUARDADAS = 32
+# Coluna mostrada como cidade quando o formulário não tem uma
+NOMES_REGIAO = ('Regiao', 'Regi_o', 'regiao')
+
+
+def hash_csv(csv_texto):
+    """Hash do conteúdo do CSV, usado como chave do cache de datasets"""
+    return hashlib.sha256(csv_texto.encode('utf-8')).hexdigest()
+
+
+def interpretar_numeros(texto):
+    """Converte "1, 3, 7-10" nos números de relatório (coluna '#', a partir de 1), em ordem.
+
+    Levanta ValueError com uma mensagem legível se algum trecho não é um
+    número ou intervalo válido, ou se nenhum número foi dado.
+    """
+    numeros = set()
+    for parte in texto.split(','):
+        parte = parte.strip()
+        if not parte:
+            continue
+        try:
+            if '-' in parte:
+                inicio, fim = (int(numero) for numero in parte.split('-', 1))
+            else:
+                inicio = fim = int(parte)
+        except ValueError:
+            raise ValueError(f"Trecho inválido na seleção: '{parte}'") from None
+        if inicio < 1:
+            raise ValueError(f"Número inválido na seleção: '{parte}' (os números começam em 1)")
+        if fim < inicio:
+            raise ValueError(f"Intervalo invertido na seleção: '{parte}'")
+        numeros.update(range(inicio, fim + 1))
+    if not numeros:
+        raise ValueError(f"Seleção vazia: '{texto}'")
+    return sorted(numeros)
+
+
+def colunas_unicas(original_cols):
+    """Renomeia colunas duplicadas com sufixo _dupN (e _idxN se ainda colidirem)"""
+    # Fazer renomeação GARANTIDA de duplicatas
+    seen = {}
+    unique_cols = []
+
+    for col in original_cols:
+        col = col.strip()
+        if col not in seen:
+            seen[col] = 0
+            unique_cols.append(col)
+        else:
+            seen[col] += 1
+            unique_cols.append(f"{col}_dup{seen[col]}")
+
+    # VERIFICAÇÃO FINAL - se ainda houver duplicatas, adicionar índice
+    contagem = Counter(unique_cols)
+    return [f"{col}_idx{i}" if contagem[col] > 1 else col for i, col in enumerate(unique_cols)]
+
+
+class Dataset:
+    """CSV já interpretado: DataFrame com coluna '#', cabeçalho único e projeções da tela.
+
+    É montado uma vez por conteúdo de CSV e reaproveitado em todas as
+    execuções do script; não deve ser modificado por quem o recebe. A
+    busca e os filtros da tela usam um índice montado na primeira consulta
+    (``filtrar``), e a tela recebe só uma página de linhas (``pagina``).
+    """
+
+    def __init__(self, csv_texto):
+        # Ler header e dados usando csv.reader (trata vírgulas entre aspas)
+        leitor = csv.reader(io.StringIO(csv_texto.strip()))
+        original_cols = next(leitor, [])
+        data_rows = [row for row in leitor if row]  # Remove linhas vazias
+
+        unique_cols = colunas_unicas(original_cols)
+        # Linhas com mais ou menos campos que o cabeçalho são ajustadas ao tamanho dele
+        largura = len(unique_cols)
+        data_rows = [row[:largura] + [''] * (largura - len(row)) for row in data_rows]
+
+        # Criar DataFrame COM NOMES ÚNICOS GARANTIDOS
+        df = pd.DataFrame(data_rows, columns=unique_cols)
+
+        # Adicionar coluna de numeração
+        df.insert(0, '#', range(1, len(df) + 1))
+
+        # Formatar a coluna SubmissionDate se existir
+        indice_data = indice_coluna(unique_cols, *NOMES_DATA_ENVIO)
+        if indice_data is not None:
+            try:
+                col_name = unique_cols[indice_data]
+                df[col_name] = pd.to_datetime(df[col_name], errors='coerce')
+                df[col_name] = df[col_name].dt.strftime('%d-%m-%Y')
+            except Exception:
+                pass
+
+        self.df = df
+        self.header = df.columns.tolist()
+        # Cabeçalho como veio no CSV (com duplicatas), usado para resolver as colunas dos relatórios
+        self.cabecalho_csv = original_cols
+
+        self.colunas_papel = self._colunas_por_papel()
+        self.colunas_selecao = self._colunas_display(incluir_tipo_proj=False)
+        self.colunas_todos = self._colunas_display(incluir_tipo_proj=True)
+        self.df_selecao = df[self.colunas_selecao].reset_index(drop=True)
+        self.df_todos = df[self.colunas_todos].reset_index(drop=True)
+
+        self._lock = threading.Lock()
+        self._indice = None
+        self._consultas = OrderedDict()
+
+    def __len__(self):
+        return len(self.df)
+
+    def _colunas_por_papel(self):
+        """Coluna de cada informação da tela ('id', 'tipo', 'data', 'cidade', 'processo', 'tipo_proj'), ou None"""
+        # Sem o '#'; as colunas duplicadas renomeadas ficam depois da original, que é a encontrada
+        header = self.header[1:]
+
+        def procurar(nomes, posicao=None):
+            indice = indice_coluna(header, *nomes)
+            # Sem a coluna pelo nome, usar a posição em que ela costuma estar no formulário
+            if indice is None and posicao is not None and posicao < len(header):
+                indice = posicao
+            return header[indice] if indice is not None else None
+
+        return {
+            'id': procurar(*MAPEAMENTO_CAMPOS['id_proj']),
+            'tipo': procurar(MAPEAMENTO_CAMPOS['id_tipo_rel'][0]),
+            'data': procurar(NOMES_DATA_ENVIO, 0),
+            'cidade': procurar(MAPEAMENTO_CAMPOS['cidade'][0] + NOMES_REGIAO, MAPEAMENTO_CAMPOS['cidade'][1]),
+            'processo': procurar(*MAPEAMENTO_CAMPOS['processo_sei']),
+            'tipo_proj': procurar(*MAPEAMENTO_CAMPOS['tipo_proj']),
+        }
+
+    def _colunas_display(self, incluir_tipo_proj):
+        """Colunas importantes mostradas na tabela de seleção"""
+        papeis = ['id', 'tipo', 'data', 'cidade', 'processo'] + (['tipo_proj'] if incluir_tipo_proj else [])
+        colunas_display = ['#'] + [self.colunas_papel[papel] for papel in papeis if self.colunas_papel[papel]]
+        # REMOVER DUPLICATAS da lista de colunas_display
+        return list(dict.fromkeys(colunas_display))
+
+    def _obter_indice(self):
+        """Índice de busca, montado na primeira consulta e compartilhado pelas sessões"""
+        with self._lock:
+            if self._indice is not None:
+                return self._indice
+            indice = {'texto': {}, 'valores': {}, 'posicoes': {}, 'datas': None}
+            for papel in ('id', 'processo'):
+                col = self.colunas_papel[papel]
+                if col:
+                    indice['texto'][papel] = self.df[col].fillna('').astype(str).str.lower()
+            for papel in ('tipo', 'cidade'):
+                col = self.colunas_papel[papel]
+                if col:
+                    posicoes = self.df.groupby(col, sort=True).indices
+                    indice['posicoes'][papel] = posicoes
+                    indice['valores'][papel] = [valor for valor in posicoes if valor != '']
+            col = self.colunas_papel['data']
+            if col:
+                datas = pd.to_datetime(self.df[col], format='%d-%m-%Y', errors='coerce')
+                if datas.notna().any():
+                    indice['datas'] = datas.to_numpy()
+            self._indice = indice
+            return indice
+
+    def valores_filtro(self, papel):
+        """Valores distintos de uma coluna filtrável ('tipo' ou 'cidade'), em ordem"""
+        return self._obter_indice()['valores'].get(papel, [])
+
+    def periodo_datas(self):
+        """(primeira, última) data de envio, ou None se a coluna de data não existe"""
+        datas = self._obter_indice()['datas']
+        if datas is None:
+            return None
+        validas = datas[~np.isnat(datas)]
+        return pd.Timestamp(validas.min()).date(), pd.Timestamp(validas.max()).date()
+
+    def filtrar(self, texto='', tipos=(), cidades=(), periodo=None):
+        """Posições (0 a n-1) das linhas que passam nos filtros, em ordem.
+
+        ``texto`` é procurado no ID do projeto e no processo/SEI, sem
+        diferenciar maiúsculas; ``tipos`` e ``cidades`` são valores exatos
+        e ``periodo`` é um par de datas (inclusivo). Os resultados das
+        últimas consultas ficam guardados, porque cada reexecução da tela
+        repete a mesma consulta.
+        """
+        chave = (texto.strip().lower(), tuple(tipos), tuple(cidades), tuple(periodo) if periodo else None)
+        with self._lock:
+            if chave in self._consultas:
+                self._consultas.move_to_end(chave)
+                return self._consultas[chave]
+
+        indice = self._obter_indice()
+        mascara = np.ones(len(self.df), dtype=bool)
+        if chave[0]:
+            encontrados = np.zeros(len(self.df), dtype=bool)
+            for serie in indice['texto'].values():
+                encontrados |= serie.str.contains(chave[0], regex=False).to_numpy()
+            mascara &= encontrados
+        for papel, valores in (('tipo', tipos), ('cidade', cidades)):
+            if valores and papel in indice['posicoes']:
+                selecionadas = np.zeros(len(self.df), dtype=bool)
+                for valor in valores:
+                    selecionadas[indice['posicoes'][papel].get(valor, [])] = True
+                mascara &= selecionadas
+        if periodo and indice['datas'] is not None:
+            inicio, fim = (np.datetime64(data) for data in periodo)
+            datas = indice['datas']
+            mascara &= (datas >= inicio) & (datas < fim + np.timedelta64(1, 'D'))
+        posicoes = np.flatnonzero(mascara)
+
+        with self._lock:
+            self._consultas[chave] = posicoes
+            while len(self._consultas) > CONSULTAS_GUARDADAS:
+                self._consultas.popitem(last=False)
+        return posicoes
+
+    def pagina(self, posicoes, numero, tamanho, todas_colunas=False):
+        """Linhas da página ``numero`` (a partir de 1) das posições filtradas, só com as colunas da tela"""
+        inicio = (numero - 1) * tamanho
+        df = self.df_todos if todas_colunas else self.df_selecao
+        return df.iloc[posicoes[inicio:inicio + tamanho]]
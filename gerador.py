@@ -0,0 +1,481 @@
+"""Leitura dos dados de vistoria e renderização dos relatórios (sem dependência do Streamlit)"""
+import contextlib
+import csv
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import pandas as pd
+from docx.shared import Cm
+from openpyxl import Workbook
+
+from colunas import MAPEAMENTO_CAMPOS, NOMES_INSTANCE_ID, celula, indice_coluna, resolver_mapeamento
+from imagens import hash_arquivo, preparar_imagem
+from instrumentacao import Cronometro
+from modelo_docx import ImagemInline, carregar_modelo
+
+CAMPOS_DATA = ('data',)
+CAMPOS_IMAGEM = ('imagem_1', 'imagem_2', 'imagem_3', 'imagem_4', 'imagem_5')
+# Quantas linhas são normalizadas juntas (uma passada do pandas por bloco)
+TAMANHO_BLOCO = 2000
+
+LARGURA_FOTO_CM = 7
+LARGURA_PADRAO_CM = 3
+
+# Imagem usada quando a foto não existe: a do usuário, se houver, ou a que acompanha o app
+IMAGEM_PADRAO_LOCAL = 'C:/arquivos_sepe/xxx.jpg'
+# Pasta de fotos do usuário (Windows), consultada depois das pastas informadas
+DIRETORIO_MIDIA_LOCAL = 'C:/arquivos_sepe/media'
+IMAGEM_PADRAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'sem_imagem.jpg')
+
+
+def formatar_datas(serie):
+    """Converte datas YYYY-MM-DD ou ISO para DD-MM-YYYY de uma vez (mantém o original se falhar)"""
+    eh_data = serie.str.match(r'\d{4}-\d{2}-\d{2}(?:T|$)')
+    # Em valores ISO com hora vale a data como foi escrita, sem converter o fuso
+    datas = pd.to_datetime(serie.where(eh_data).str.slice(0, 10), format='%Y-%m-%d', errors='coerce')
+    return datas.dt.strftime('%d-%m-%Y').where(datas.notna(), serie)
+
+
+def _normalizar_bloco(bloco, variaveis):
+    """Monta os contextos de um bloco de linhas, formatando as colunas numa passada só"""
+    df = pd.DataFrame(bloco, columns=['relatorio', *variaveis])
+    for variavel in CAMPOS_DATA:
+        if variavel in df:
+            df[variavel] = formatar_datas(df[variavel])
+    return df.to_dict('records')
+
+
+def iterar_registros(csv_texto, indices_selecionados=None, mapeamento=MAPEAMENTO_CAMPOS):
+    """Percorre as linhas do CSV já como contextos dos relatórios.
+
+    Cada registro é um dicionário variável do modelo -> valor, com as
+    colunas resolvidas uma vez pelo cabeçalho (ver colunas.MAPEAMENTO_CAMPOS) e
+    as datas já formatadas; as imagens ainda são os nomes do CSV.
+    ``relatorio`` é o número da linha contando o cabeçalho como linha 1 (a
+    mesma numeração da antiga planilha intermediária).
+    ``indices_selecionados`` usa a numeração da coluna '#' da tela (1 =
+    primeira linha de dados); se vazio, todas as linhas são lidas.
+    """
+    leitor = csv.reader(io.StringIO(csv_texto))
+    cabecalho = next(leitor, None)
+    if cabecalho is None:
+        return
+    colunas, _ = resolver_mapeamento(cabecalho, mapeamento)
+    variaveis = list(colunas)
+    indices = list(colunas.values())
+
+    bloco = []
+    for numero, linha in _linhas_selecionadas(leitor, indices_selecionados):
+        bloco.append([numero + 1] + [linha[i] if i < len(linha) else '' for i in indices])
+        if len(bloco) >= TAMANHO_BLOCO:
+            yield from _normalizar_bloco(bloco, variaveis)
+            bloco = []
+    if bloco:
+        yield from _normalizar_bloco(bloco, variaveis)
+
+
+def _linhas_selecionadas(leitor, indices_selecionados):
+    """Pares (número da linha de dados, linha) das linhas selecionadas, parando na última"""
+    selecionados = set(indices_selecionados) if indices_selecionados else None
+    ultimo = max(selecionados) if selecionados else None
+
+    numero = 0
+    for linha in leitor:
+        if not linha:
+            continue
+        numero += 1
+        if selecionados is not None:
+            if numero > ultimo:
+                break
+            if numero not in selecionados:
+                continue
+        yield numero, linha
+
+
+def listar_imagens_referenciadas(csv_texto, indices_selecionados=None, mapeamento=MAPEAMENTO_CAMPOS):
+    """Imagens citadas nas colunas de foto das linhas selecionadas, sem repetição.
+
+    Cada item é um dicionário com 'instance_id' (None se o CSV não tem a
+    coluna KEY/instanceID), 'id_projeto' e 'nome' (o nome do anexo no ODK),
+    no formato de odk.baixar_anexos_referenciados.
+    """
+    leitor = csv.reader(io.StringIO(csv_texto))
+    cabecalho = next(leitor, None)
+    if cabecalho is None:
+        return []
+    colunas, _ = resolver_mapeamento(cabecalho, mapeamento)
+    col_id = indice_coluna(cabecalho, *NOMES_INSTANCE_ID)
+
+    referencias = {}
+    for _, linha in _linhas_selecionadas(leitor, indices_selecionados):
+        for campo in CAMPOS_IMAGEM:
+            nome = celula(linha, colunas[campo])
+            if nome:
+                instance_id = celula(linha, col_id) or None
+                referencias.setdefault((instance_id, nome), {
+                    'instance_id': instance_id,
+                    'id_projeto': celula(linha, colunas['id_proj']) or None,
+                    'nome': nome,
+                })
+    return list(referencias.values())
+
+
+def exportar_xlsx(csv_texto, xlsx_path):
+    """Grava o CSV como XLSX com coluna de numeração (modo write-only do openpyxl)"""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('dados_vistoria')
+
+    leitor = csv.reader(io.StringIO(csv_texto))
+    for row_index, row in enumerate((linha for linha in leitor if linha), start=1):
+        ws.append([row_index] + row)
+
+    wb.save(xlsx_path)
+    return xlsx_path
+
+
+def localizar_imagem_padrao():
+    """Caminho da imagem usada quando a foto não existe"""
+    # Imagem local do usuário (Windows) tem preferência sobre a que acompanha o app
+    if os.path.exists(IMAGEM_PADRAO_LOCAL):
+        return IMAGEM_PADRAO_LOCAL
+    return IMAGEM_PADRAO
+
+
+class IndiceMidia:
+    """Mapa nome do arquivo -> caminho das imagens, montado uma vez por lote.
+
+    Junta o cache de anexos do ODK e os diretórios de mídia (nessa ordem de
+    prioridade), de modo que cada imagem do CSV é resolvida com uma consulta
+    a um dicionário, sem testar caminhos no disco.
+    """
+
+    def __init__(self, cache=None, diretorios_midia=()):
+        self.caminhos = {}
+        for diretorio in reversed(diretorios_midia):
+            if os.path.isdir(diretorio):
+                for entrada in os.scandir(diretorio):
+                    if entrada.is_file():
+                        self.caminhos[entrada.name] = entrada.path
+        if cache:
+            self.caminhos.update(cache.mapa_nomes())
+        self.imagem_padrao = localizar_imagem_padrao()
+
+    def __len__(self):
+        return len(self.caminhos)
+
+    def localizar(self, valor_imagem):
+        """Resolve o nome de imagem do CSV em (caminho, largura em cm); sem foto, usa a imagem padrão"""
+        if valor_imagem:
+            imagem_path = self.caminhos.get(valor_imagem)
+            if imagem_path:
+                return imagem_path, LARGURA_FOTO_CM
+            print(f"Imagem não encontrada: {valor_imagem}")
+        return self.imagem_padrao, LARGURA_PADRAO_CM
+
+
+def renderizar_relatorio(modelo_path, registro, imagens, pasta_saida=None, dpi_imagens=None, metricas=None):
+    """Renderiza o DOCX de um registro de iterar_registros; ``imagens`` vem de IndiceMidia.localizar.
+
+    Com ``pasta_saida``, salva o arquivo lá e retorna o caminho; sem ela,
+    retorna (nome do arquivo, conteúdo em bytes). Com ``dpi_imagens``, as
+    fotos são reduzidas para essa resolução na largura em que aparecem
+    antes de serem embutidas. Se ``metricas`` (dicionário) for dado, recebe
+    o tempo de cada fase, o total, os bytes das imagens e do DOCX e os
+    acertos e faltas do cache de imagens lidas.
+    """
+    metricas = {} if metricas is None else metricas
+    cronometro = Cronometro(metricas.setdefault('fases', {}))
+
+    # O modelo é lido e compilado uma vez por processo e reaproveitado
+    doc = carregar_modelo(modelo_path).novo_relatorio()
+    cronometro.marcar('modelo')
+
+    contexto = dict(registro)
+    bytes_imagens = 0
+    for numero, imagem in enumerate(imagens, 1):
+        if imagem:
+            caminho, largura_cm = imagem
+            if dpi_imagens:
+                caminho = preparar_imagem(caminho, largura_cm, dpi_imagens)
+            bytes_imagens += os.path.getsize(caminho)
+            contexto[f'imagem_{numero}'] = ImagemInline(doc, caminho, Cm(largura_cm))
+        else:
+            contexto[f'imagem_{numero}'] = None
+    cronometro.marcar('imagens')
+
+    # As imagens são embutidas durante o render
+    doc.render(contexto)
+    cronometro.marcar('render')
+
+    nome = f"{registro['relatorio']}.docx"
+    if pasta_saida is None:
+        buffer = io.BytesIO()
+        doc.save(buffer)
+        resultado = (nome, buffer.getvalue())
+        tamanho = len(resultado[1])
+    else:
+        resultado = os.path.join(pasta_saida, nome)
+        doc.save(resultado)
+        tamanho = os.path.getsize(resultado)
+    cronometro.marcar('salvar')
+
+    metricas['segundos'] = sum(metricas['fases'].values())
+    metricas['bytes_imagens'] = bytes_imagens
+    metricas['bytes'] = tamanho
+    metricas['imagens_lidas'] = dict(doc.imagens_lidas)
+    return resultado
+
+
+def _renderizar_medindo(modelo_path, registro, imagens, pasta_saida, dpi_imagens):
+    """renderizar_relatorio devolvendo também as métricas (que não voltariam de outro processo por referência)"""
+    metricas = {}
+    resultado = renderizar_relatorio(modelo_path, registro, imagens, pasta_saida, dpi_imagens, metricas)
+    return resultado, metricas
+
+
+def gerar_relatorios(registros, modelo_path, saida, localizar, workers=1, progresso=None, dpi_imagens=None,
+                     instrumentacao=None, cache_relatorios=None, conversor_pdf=None):
+    """Renderiza os relatórios dos registros, opcionalmente em vários processos.
+
+    ``saida`` é uma pasta, onde cada DOCX é salvo, ou um ``zipfile.ZipFile``
+    aberto para escrita: nesse caso cada relatório vai direto para o ZIP,
+    sem passar pelo disco, e sem nova compressão (o DOCX já é compactado).
+    ``localizar(valor_imagem)`` (em geral IndiceMidia.localizar) resolve as
+    imagens no processo principal, de modo que os processos de renderização
+    só recebem caminhos. Com ``workers`` > 1 os registros são distribuídos
+    num pool de processos. Os relatórios são gravados e devolvidos sempre
+    na ordem dos registros. Um registro com erro não interrompe os demais.
+    ``progresso(concluidos, relatorio)`` é chamado no processo principal a
+    cada relatório terminado. ``dpi_imagens`` é repassado a
+    renderizar_relatorio. Com ``instrumentacao`` (Instrumentacao), as
+    métricas de cada relatório e o tempo de gravação no ZIP são registrados.
+    Com ``cache_relatorios`` (CacheRelatorios), um relatório cujas entradas
+    (linha, modelo e fotos) não mudaram sai do cache sem ser renderizado, e
+    os renderizados são guardados nele; acertos e faltas vão para os
+    contadores da instrumentação. Com ``conversor_pdf``
+    (conversor_pdf.PoolConversorPDF), cada DOCX é enviado para conversão
+    assim que é gravado e o PDF vai para a mesma saída, ao lado dele,
+    enquanto os próximos relatórios são renderizados; com
+    ``max_pendentes`` conversões em andamento, a renderização espera a
+    primeira terminar, para que os DOCX e PDFs na memória não cresçam
+    com o lote.
+
+    Retorna (caminhos ou nomes no ZIP dos DOCX gerados, erros como pares (relatório, mensagem)).
+    """
+    zip_saida = saida if isinstance(saida, zipfile.ZipFile) else None
+    pasta_saida = None if zip_saida else saida
+    hash_modelo = hash_arquivo(modelo_path) if cache_relatorios is not None else None
+    # Chave no cache de cada relatório que precisou ser renderizado, pela ordem
+    chaves = {}
+
+    tarefas = (
+        (ordem, registro, [localizar(registro.get(campo)) for campo in CAMPOS_IMAGEM])
+        for ordem, registro in enumerate(registros)
+    )
+    gerados = []
+    erros = []
+    prontos = {}
+    estado = {'proximo': 0, 'concluidos': 0}
+    # Conversões em andamento: futuro -> nome do DOCX
+    pdfs_pendentes = {}
+
+    def concluir(ordem, relatorio, resultado, erro):
+        # Guardar o resultado e gravar em ordem tudo o que já estiver contíguo
+        chave = chaves.pop(ordem, None)
+        if erro is not None:
+            erros.append((relatorio, f"{type(erro).__name__}: {erro}"))
+        else:
+            # Relatórios vindos do cache não têm métricas de renderização
+            resultado, metricas = resultado
+            if chave is not None:
+                guardar_no_cache(chave, resultado)
+            if instrumentacao is not None:
+                if metricas is not None:
+                    instrumentacao.registrar_relatorio(relatorio, metricas)
+                    for nome, quantidade in metricas['imagens_lidas'].items():
+                        instrumentacao.contar(f'imagens_lidas_{nome}', quantidade)
+                if cache_relatorios is not None:
+                    instrumentacao.contar('cache_relatorios_faltas' if metricas is not None else 'cache_relatorios_acertos')
+        prontos[ordem] = resultado
+        while estado['proximo'] in prontos:
+            resultado = prontos.pop(estado['proximo'])
+            estado['proximo'] += 1
+            if resultado is None:
+                continue
+            if zip_saida:
+                nome, conteudo = resultado
+                inicio = time.perf_counter()
+                zip_saida.writestr(nome, conteudo, compress_type=zipfile.ZIP_STORED)
+                if instrumentacao is not None:
+                    instrumentacao.acumular('gravacao_zip', time.perf_counter() - inicio, len(conteudo))
+                gerados.append(nome)
+            else:
+                gerados.append(resultado)
+            if conversor_pdf is not None:
+                enviar_para_pdf(resultado)
+        gravar_pdfs()
+        estado['concluidos'] += 1
+        if progresso:
+            progresso(estado['concluidos'], relatorio)
+
+    def enviar_para_pdf(resultado):
+        if zip_saida:
+            nome, conteudo = resultado
+        else:
+            nome = os.path.basename(resultado)
+            with open(resultado, 'rb') as f:
+                conteudo = f.read()
+        while len(pdfs_pendentes) >= conversor_pdf.max_pendentes:
+            wait(pdfs_pendentes, return_when=FIRST_COMPLETED)
+            gravar_pdfs()
+        pdfs_pendentes[conversor_pdf.converter(conteudo)] = nome
+
+    def gravar_pdfs(esperar=False):
+        """Grava os PDFs já convertidos (ou todos, esperando os que faltam)"""
+        for futuro in [f for f in pdfs_pendentes if esperar or f.done()]:
+            nome = pdfs_pendentes.pop(futuro)
+            nome_pdf = os.path.splitext(nome)[0] + '.pdf'
+            try:
+                conteudo_pdf, segundos = futuro.result()
+            except Exception as e:
+                erros.append((os.path.splitext(nome)[0], f"Erro ao converter para PDF: {type(e).__name__}: {e}"))
+                continue
+            if zip_saida:
+                zip_saida.writestr(nome_pdf, conteudo_pdf, compress_type=zipfile.ZIP_DEFLATED)
+            else:
+                with open(os.path.join(pasta_saida, nome_pdf), 'wb') as f:
+                    f.write(conteudo_pdf)
+            if instrumentacao is not None:
+                instrumentacao.acumular('conversao_pdf', segundos, len(conteudo_pdf))
+
+    def buscar_no_cache(ordem, registro, imagens):
+        """Conclui o relatório com a cópia do cache, se houver; senão anota a chave para guardá-lo depois"""
+        if cache_relatorios is None:
+            return False
+        try:
+            chave = cache_relatorios.chave(hash_modelo, registro, imagens, dpi_imagens)
+        except OSError as e:
+            print(f"Erro ao consultar o cache de relatórios: {e}")
+            return False
+        nome = f"{registro['relatorio']}.docx"
+        try:
+            caminho = cache_relatorios.obter(chave)
+            if caminho is None:
+                chaves[ordem] = chave
+                return False
+            # Outra geração pode remover a cópia (LRU) entre o obter e a leitura: aí o relatório é renderizado
+            if zip_saida:
+                with open(caminho, 'rb') as f:
+                    resultado = (nome, f.read())
+            else:
+                resultado = os.path.join(pasta_saida, nome)
+                shutil.copyfile(caminho, resultado)
+        except OSError as e:
+            print(f"Erro ao ler do cache de relatórios: {e}")
+            chaves[ordem] = chave
+            return False
+        concluir(ordem, registro['relatorio'], (resultado, None), None)
+        return True
+
+    def guardar_no_cache(chave, resultado):
+        try:
+            if zip_saida:
+                cache_relatorios.guardar(chave, resultado[1])
+            else:
+                with open(resultado, 'rb') as f:
+                    cache_relatorios.guardar(chave, f.read())
+        except OSError as e:
+            print(f"Erro ao gravar no cache de relatórios: {e}")
+
+    if workers <= 1:
+        for ordem, registro, imagens in tarefas:
+            if buscar_no_cache(ordem, registro, imagens):
+                continue
+            try:
+                resultado = _renderizar_medindo(modelo_path, registro, imagens, pasta_saida, dpi_imagens)
+                concluir(ordem, registro['relatorio'], resultado, None)
+            except Exception as e:
+                concluir(ordem, registro['relatorio'], None, e)
+        gravar_pdfs(esperar=True)
+        return gerados, erros
+
+    # 'spawn' funciona igual no Windows e no Linux e não herda as threads do servidor
+    contexto_mp = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=contexto_mp) as executor:
+        pendentes = {}
+        esgotado = False
+        while pendentes or not esgotado:
+            # Manter a fila limitada para não materializar todos os registros
+            while not esgotado and len(pendentes) < workers * 2:
+                tarefa = next(tarefas, None)
+                if tarefa is None:
+                    esgotado = True
+                    break
+                ordem, registro, imagens = tarefa
+                if buscar_no_cache(ordem, registro, imagens):
+                    continue
+                futuro = executor.submit(
+                    _renderizar_medindo, modelo_path, registro, imagens, pasta_saida, dpi_imagens
+                )
+                pendentes[futuro] = (ordem, registro['relatorio'])
+            if not pendentes:
+                break
+
+            terminados, _ = wait(pendentes, return_when=FIRST_COMPLETED)
+            for futuro in terminados:
+                ordem, relatorio = pendentes.pop(futuro)
+                try:
+                    concluir(ordem, relatorio, futuro.result(), None)
+                except Exception as e:
+                    concluir(ordem, relatorio, None, e)
+
+    gravar_pdfs(esperar=True)
+    return gerados, erros
+
+
+def gerar_zip(csv_texto, modelo_path, zip_path, localizar, indices_selecionados=None, workers=1,
+              progresso=None, dpi_imagens=None, incluir_xlsx=False, instrumentacao=None, cache_relatorios=None,
+              conversor_pdf=None):
+    """Gera o ZIP com os relatórios das linhas selecionadas do CSV (e a planilha, se pedida).
+
+    Os parâmetros seguem iterar_registros e gerar_relatorios; com
+    ``incluir_xlsx``, o CSV inteiro vai para o ZIP como dados.xlsx; com
+    ``conversor_pdf``, os PDFs vão junto com os DOCX. Com
+    ``instrumentacao``, as etapas de renderização e da planilha são medidas.
+    Retorna (nomes dos relatórios no ZIP, erros como pares (relatório, mensagem)).
+    """
+    etapa = instrumentacao.etapa if instrumentacao is not None else (lambda nome: contextlib.nullcontext({}))
+    registros = iterar_registros(csv_texto, indices_selecionados)
+    zip_saida = zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED)
+    try:
+        with etapa('renderizacao') as registro:
+            gerados, erros = gerar_relatorios(
+                registros, modelo_path, zip_saida, localizar,
+                workers=workers, progresso=progresso, dpi_imagens=dpi_imagens,
+                instrumentacao=instrumentacao, cache_relatorios=cache_relatorios,
+                conversor_pdf=conversor_pdf
+            )
+            registro['itens'] = len(gerados)
+            registro['erros'] = len(erros)
+
+        if incluir_xlsx:
+            with etapa('conversao_xlsx') as registro:
+                fd, xlsx_path = tempfile.mkstemp(suffix='.xlsx')
+                os.close(fd)
+                try:
+                    exportar_xlsx(csv_texto, xlsx_path)
+                    registro['bytes'] = os.path.getsize(xlsx_path)
+                    zip_saida.write(xlsx_path, 'dados.xlsx')
+                finally:
+                    os.remove(xlsx_path)
+    finally:
+        with etapa('fechamento_zip') as registro:
+            zip_saida.close()
+            registro['bytes'] = os.path.getsize(zip_path)
+    return gerados, erros
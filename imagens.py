@@ -0,0 +1,187 @@
+"""Redução e recompressão das fotos antes de embuti-las nos relatórios, e cache das fotos já lidas"""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+from docx.image.image import Image as ImagemDocx
+from PIL import Image, ImageOps
+
+DIRETORIO_DERIVADAS = os.path.join(tempfile.gettempdir(), 'sepe_imagens_derivadas')
+LIMITE_DERIVADAS_BYTES = int(os.environ.get('SEPE_LIMITE_DERIVADAS_MB', '512')) * 1024 * 1024
+DPI_PADRAO = 150
+QUALIDADE_JPEG = 85
+# Bytes de imagens já lidas mantidos na memória de cada processo de renderização
+LIMITE_IMAGENS_LIDAS_BYTES = int(os.environ.get('SEPE_CACHE_IMAGENS_MB', '128')) * 1024 * 1024
+
+# Hashes lembrados por processo
+LIMITE_HASHES = 4096
+
+# Hash já calculado de cada arquivo, por (caminho, tamanho, data de modificação), do menos para o mais usado
+_hashes = OrderedDict()
+_lock_hashes = threading.Lock()
+
+# Bytes de derivadas gravados por este processo desde a última limpeza da pasta (a primeira gravação já limpa)
+_estado_derivadas = {'gravados': LIMITE_DERIVADAS_BYTES // 10}
+_lock_derivadas = threading.Lock()
+
+# Imagens lidas pelo python-docx (conteúdo, formato e dimensões), da menos para a mais usada
+_imagens_lidas = OrderedDict()
+_estado_imagens_lidas = {'bytes': 0}
+_lock_imagens_lidas = threading.Lock()
+
+
+def hash_arquivo(caminho):
+    """SHA-256 do conteúdo do arquivo (usa o nome se ele já for um blob do cache de anexos)"""
+    nome = os.path.splitext(os.path.basename(caminho))[0]
+    if re.fullmatch(r'[0-9a-f]{64}', nome):
+        return nome
+
+    info = os.stat(caminho)
+    chave = (caminho, info.st_size, info.st_mtime_ns)
+    with _lock_hashes:
+        if chave in _hashes:
+            _hashes.move_to_end(chave)
+            return _hashes[chave]
+
+    sha = hashlib.sha256()
+    with open(caminho, 'rb') as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(bloco)
+    with _lock_hashes:
+        _hashes[chave] = sha.hexdigest()
+        while len(_hashes) > LIMITE_HASHES:
+            _hashes.popitem(last=False)
+    return sha.hexdigest()
+
+
+def limpar_derivadas(diretorio=DIRETORIO_DERIVADAS, limite_bytes=LIMITE_DERIVADAS_BYTES):
+    """Apaga as derivadas de uso mais antigo (mtime) até a pasta voltar ao limite; retorna quantas apagou"""
+    derivadas = []
+    try:
+        entradas = list(os.scandir(diretorio))
+    except FileNotFoundError:
+        return 0
+    for entrada in entradas:
+        # Só as derivadas prontas: os temporários de outro processo ainda estão sendo gravados
+        if re.fullmatch(r'[0-9a-f]{64}_\d+_\d+\.jpg', entrada.name):
+            try:
+                info = entrada.stat()
+            except FileNotFoundError:
+                continue
+            derivadas.append((info.st_mtime, info.st_size, entrada.path))
+    derivadas.sort()
+
+    total = sum(tamanho for _, tamanho, _ in derivadas)
+    removidas = 0
+    for _, tamanho, caminho in derivadas:
+        if total <= limite_bytes:
+            break
+        try:
+            os.remove(caminho)
+            removidas += 1
+        except FileNotFoundError:
+            pass
+        total -= tamanho
+    return removidas
+
+
+def _registrar_derivada(diretorio, tamanho):
+    """Conta os bytes gravados e limpa a pasta a cada décimo do limite, para não varrê-la a cada foto"""
+    with _lock_derivadas:
+        _estado_derivadas['gravados'] += tamanho
+        if _estado_derivadas['gravados'] < LIMITE_DERIVADAS_BYTES // 10:
+            return
+        _estado_derivadas['gravados'] = 0
+    limpar_derivadas(diretorio)
+
+
+def preparar_imagem(caminho, largura_cm, dpi=DPI_PADRAO, qualidade=QUALIDADE_JPEG, diretorio=DIRETORIO_DERIVADAS):
+    """Retorna o caminho de uma versão da foto no tamanho em que ela aparece no relatório.
+
+    A foto é girada conforme a orientação EXIF, reduzida para ``dpi`` na
+    largura exibida e salva como JPEG. O resultado fica em cache pelo hash
+    da foto original e pela largura em pixels, então cada foto é processada
+    uma única vez. Se a foto já é pequena o bastante, ou não pode ser lida,
+    o caminho original é devolvido. A pasta das derivadas é compartilhada
+    pelos processos e mantida abaixo de LIMITE_DERIVADAS_BYTES, apagando
+    as de uso mais antigo; o uso é marcado pela data de modificação.
+    """
+    largura_px = round(largura_cm / 2.54 * dpi)
+    try:
+        destino = os.path.join(diretorio, f"{hash_arquivo(caminho)}_{largura_px}_{qualidade}.jpg")
+        try:
+            os.utime(destino)
+            return destino
+        except FileNotFoundError:
+            pass
+
+        with Image.open(caminho) as original:
+            orientacao = original.getexif().get(0x0112, 1)
+            if original.width <= largura_px and orientacao == 1:
+                return caminho
+
+            imagem = ImageOps.exif_transpose(original)
+            if imagem.width > largura_px:
+                altura_px = max(1, round(imagem.height * largura_px / imagem.width))
+                imagem = imagem.resize((largura_px, altura_px), Image.LANCZOS)
+            if imagem.mode in ('RGBA', 'LA', 'P'):
+                # JPEG não tem transparência: compor sobre fundo branco
+                imagem = imagem.convert('RGBA')
+                fundo = Image.new('RGB', imagem.size, (255, 255, 255))
+                fundo.paste(imagem, mask=imagem.getchannel('A'))
+                imagem = fundo
+            elif imagem.mode != 'RGB':
+                imagem = imagem.convert('RGB')
+
+            # Gravar em arquivo temporário e renomear (vários processos podem gerar a mesma foto)
+            os.makedirs(diretorio, exist_ok=True)
+            fd, temporario = tempfile.mkstemp(dir=diretorio, suffix='.jpg')
+            with os.fdopen(fd, 'wb') as f:
+                imagem.save(f, 'JPEG', quality=qualidade, optimize=True, dpi=(dpi, dpi))
+                tamanho = f.tell()
+            os.replace(temporario, destino)
+        _registrar_derivada(diretorio, tamanho)
+        return destino
+    except Exception as e:
+        print(f"Erro ao reduzir imagem {caminho}: {e}")
+        return caminho
+
+
+def carregar_imagem_docx(caminho, contadores=None):
+    """Imagem do python-docx (conteúdo, formato, dimensões e hash) lida uma vez e reaproveitada.
+
+    As imagens ficam num LRU de até LIMITE_IMAGENS_LIDAS_BYTES por processo,
+    com chave pelo caminho, tamanho e data de modificação. Uma foto que se
+    repete no lote, como a imagem padrão das linhas sem foto, custa uma
+    consulta ao dicionário em vez de ler o arquivo e interpretar o cabeçalho.
+    Se ``contadores`` (dicionário) for dado, soma nele os acertos e as faltas.
+    """
+    contadores = {} if contadores is None else contadores
+    info = os.stat(caminho)
+    chave = (caminho, info.st_size, info.st_mtime_ns)
+    with _lock_imagens_lidas:
+        imagem = _imagens_lidas.get(chave)
+        if imagem is not None:
+            _imagens_lidas.move_to_end(chave)
+    if imagem is not None:
+        contadores['acertos'] = contadores.get('acertos', 0) + 1
+        return imagem
+    contadores['faltas'] = contadores.get('faltas', 0) + 1
+
+    imagem = ImagemDocx.from_file(caminho)
+    tamanho = len(imagem.blob)
+    if tamanho > LIMITE_IMAGENS_LIDAS_BYTES:
+        return imagem
+
+    with _lock_imagens_lidas:
+        if chave not in _imagens_lidas:
+            _imagens_lidas[chave] = imagem
+            _estado_imagens_lidas['bytes'] += tamanho
+            while _estado_imagens_lidas['bytes'] > LIMITE_IMAGENS_LIDAS_BYTES:
+                _, antiga = _imagens_lidas.popitem(last=False)
+                _estado_imagens_lidas['bytes'] -= len(antiga.blob)
+    return imagem
+
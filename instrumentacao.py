@@ -0,0 +1,158 @@
+"""Tempos, bytes e contagens por etapa e por relatório, com perfil cProfile opcional e log em JSON"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+DIRETORIO_METRICAS = os.path.join(tempfile.gettempdir(), 'sepe_metricas')
+ARQUIVO_LOG_METRICAS = os.environ.get('SEPE_LOG_METRICAS', os.path.join(DIRETORIO_METRICAS, 'metricas.jsonl'))
+
+# Relatório lento: mais que FATOR_OUTLIER vezes a mediana do lote
+FATOR_OUTLIER = 3.0
+MAX_OUTLIERS = 10
+# Funções listadas no resumo do perfil
+LINHAS_PERFIL = 25
+
+_lock_log = threading.Lock()
+
+
+class Cronometro:
+    """Acumula em ``tempos`` o tempo decorrido entre marcas consecutivas, por nome"""
+
+    def __init__(self, tempos=None):
+        self.tempos = {} if tempos is None else tempos
+        self._ultimo = time.perf_counter()
+
+    def marcar(self, nome):
+        agora = time.perf_counter()
+        self.tempos[nome] = self.tempos.get(nome, 0.0) + agora - self._ultimo
+        self._ultimo = agora
+
+
+def _percentil(valores_ordenados, fracao):
+    if not valores_ordenados:
+        return 0.0
+    return valores_ordenados[min(len(valores_ordenados) - 1, int(fracao * len(valores_ordenados)))]
+
+
+class Instrumentacao:
+    """Medições de uma execução (uma conexão ao ODK, uma geração, um benchmark).
+
+    ``etapa(nome)`` cronometra um bloco; quem usa pode preencher 'itens' e
+    'bytes' no registro devolvido. ``acumular`` soma tempo e bytes a uma
+    etapa espalhada por várias chamadas (ex.: gravação no ZIP). Os tempos de
+    cada relatório chegam por ``registrar_relatorio``, já divididos nas
+    fases medidas em gerador.renderizar_relatorio; ``contar`` soma
+    contagens avulsas.
+    """
+
+    def __init__(self, nome='execucao', perfil=False):
+        self.nome = nome
+        self.inicio = time.time()
+        self.etapas = []
+        self.relatorios = []
+        self.contadores = {}
+        self.texto_perfil = None
+        self._acumuladas = {}
+        self._perfil = cProfile.Profile() if perfil else None
+
+    @contextmanager
+    def etapa(self, nome):
+        registro = {'etapa': nome}
+        inicio = time.perf_counter()
+        try:
+            yield registro
+        finally:
+            registro['segundos'] = round(time.perf_counter() - inicio, 4)
+            if registro.get('itens'):
+                registro['ms_por_item'] = round(registro['segundos'] * 1000 / registro['itens'], 3)
+            self.etapas.append(registro)
+
+    def acumular(self, nome, segundos, tamanho=0):
+        registro = self._acumuladas.get(nome)
+        if registro is None:
+            registro = self._acumuladas[nome] = {'etapa': nome, 'segundos': 0.0, 'itens': 0, 'bytes': 0}
+            self.etapas.append(registro)
+        registro['segundos'] = round(registro['segundos'] + segundos, 4)
+        registro['itens'] += 1
+        registro['bytes'] += tamanho
+
+    def contar(self, nome, quantidade=1):
+        """Soma a um contador da execução (ex.: relatórios vindos do cache)"""
+        self.contadores[nome] = self.contadores.get(nome, 0) + quantidade
+
+    def registrar_relatorio(self, relatorio, metricas):
+        """Guarda as fases (segundos) e os bytes de um relatório renderizado"""
+        self.relatorios.append({'relatorio': relatorio, **metricas})
+
+    def iniciar_perfil(self):
+        if self._perfil:
+            self._perfil.enable()
+
+    def parar_perfil(self, caminho=None):
+        """Encerra o perfil; grava o .prof em ``caminho``, se dado, e guarda o texto das funções mais caras"""
+        if not self._perfil:
+            return
+        self._perfil.disable()
+        if caminho:
+            self._perfil.dump_stats(caminho)
+        texto = io.StringIO()
+        pstats.Stats(self._perfil, stream=texto).sort_stats('cumulative').print_stats(LINHAS_PERFIL)
+        self.texto_perfil = texto.getvalue()
+
+    def resumo_relatorios(self):
+        """Estatísticas dos relatórios: totais por fase, percentis e os mais lentos"""
+        if not self.relatorios:
+            return None
+        tempos = sorted(relatorio['segundos'] for relatorio in self.relatorios)
+        mediana = _percentil(tempos, 0.5)
+        fases = {}
+        for relatorio in self.relatorios:
+            for fase, segundos in relatorio.get('fases', {}).items():
+                fases[fase] = fases.get(fase, 0.0) + segundos
+
+        lentos = sorted(
+            (relatorio for relatorio in self.relatorios if relatorio['segundos'] > FATOR_OUTLIER * mediana),
+            key=lambda relatorio: relatorio['segundos'], reverse=True
+        )[:MAX_OUTLIERS]
+        return {
+            'quantidade': len(tempos),
+            'segundos_total': round(sum(tempos), 4),
+            'media': round(sum(tempos) / len(tempos), 4),
+            'mediana': round(mediana, 4),
+            'p95': round(_percentil(tempos, 0.95), 4),
+            'maximo': round(tempos[-1], 4),
+            'bytes_imagens': sum(relatorio.get('bytes_imagens', 0) for relatorio in self.relatorios),
+            'bytes': sum(relatorio.get('bytes', 0) for relatorio in self.relatorios),
+            'fases': {fase: round(segundos, 4) for fase, segundos in fases.items()},
+            'lentos': lentos,
+        }
+
+    def resumo(self):
+        """Tudo o que foi medido, num dicionário serializável em JSON"""
+        return {
+            'nome': self.nome,
+            'inicio': datetime.fromtimestamp(self.inicio).isoformat(timespec='seconds'),
+            'segundos': round(time.time() - self.inicio, 4),
+            'etapas': self.etapas,
+            'relatorios': self.resumo_relatorios(),
+            'contadores': self.contadores,
+            'perfil': self.texto_perfil,
+        }
+
+    def gravar_log(self, arquivo=ARQUIVO_LOG_METRICAS, **extras):
+        """Acrescenta o resumo como uma linha JSON ao log de métricas e o retorna"""
+        resumo = {**self.resumo(), **extras}
+        try:
+            os.makedirs(os.path.dirname(arquivo), exist_ok=True)
+            with _lock_log, open(arquivo, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(resumo, ensure_ascii=False) + '\n')
+        except OSError as e:
+            print(f"Erro ao gravar log de métricas: {e}")
+        return resumo
@@ -0,0 +1,141 @@
+"""Modelo DOCX compilado uma única vez e reaproveitado em todos os relatórios, e imagens embutidas sem releitura"""
+import copy
+import hashlib
+import io
+import re
+import threading
+from collections import OrderedDict
+
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.oxml.shape import CT_Inline
+from docxtpl import DocxTemplate, InlineImage
+from jinja2 import Template
+
+from imagens import carregar_imagem_docx
+
+# Quantos modelos diferentes ficam compilados na memória de cada processo
+MAX_MODELOS_COMPILADOS = 4
+
+_modelos_compilados = OrderedDict()
+_lock_modelos = threading.Lock()
+
+
+class ModeloCompilado:
+    """Documento do modelo já lido, com o XML limpo e os templates Jinja compilados.
+
+    O corpo, os cabeçalhos e os rodapés passam pelo mesmo pré-processamento
+    do DocxTemplate (patch_xml) e são compilados uma vez; cada relatório
+    parte de uma cópia do documento já carregado.
+    """
+
+    def __init__(self, conteudo):
+        base = DocxTemplate(io.BytesIO(conteudo))
+        base.init_docx()
+        self.documento = base.docx
+
+        self.corpo = self._compilar(base.patch_xml(base.get_xml()))
+        self.partes = {}
+        for uri in (DocxTemplate.HEADER_URI, DocxTemplate.FOOTER_URI):
+            for rel_key, part in base.get_headers_footers(uri):
+                xml = base.get_part_xml(part)
+                encoding = base.get_headers_footers_encoding(xml)
+                self.partes[rel_key] = (self._compilar(base.patch_xml(xml)), encoding)
+
+    @staticmethod
+    def _compilar(xml):
+        # Mesma quebra de parágrafos que DocxTemplate.render_xml_part faz antes do Jinja
+        return Template(re.sub(r"<w:p([ >])", r"\n<w:p\1", xml))
+
+    def novo_relatorio(self):
+        """DocxTemplate pronto para renderizar um relatório a partir deste modelo"""
+        return RelatorioDocx(self)
+
+
+class RelatorioDocx(DocxTemplate):
+    """DocxTemplate que renderiza com os templates já compilados de um ModeloCompilado"""
+
+    def __init__(self, modelo):
+        super().__init__(None)
+        self.modelo = modelo
+        # Partes de imagem já embutidas neste documento, pelo SHA-1 (ver ImagemInline)
+        self.imagens_embutidas = {}
+        # Acertos e faltas do cache de imagens lidas ao embutir as fotos deste relatório
+        self.imagens_lidas = {'acertos': 0, 'faltas': 0}
+
+    def init_docx(self, reload=True):
+        if not self.docx or (self.is_rendered and reload):
+            self.docx = copy.deepcopy(self.modelo.documento)
+            self.imagens_embutidas = {}
+            self.is_rendered = False
+
+    def _renderizar_parte(self, template, part, context):
+        self.current_rendering_part = part
+        dst_xml = template.render(context)
+        dst_xml = re.sub(r"\n<w:p([ >])", r"<w:p\1", dst_xml)
+        dst_xml = (
+            dst_xml.replace("{_{", "{{")
+            .replace("}_}", "}}")
+            .replace("{_%", "{%")
+            .replace("%_}", "%}")
+        )
+        return self.resolve_listing(dst_xml)
+
+    def build_xml(self, context, jinja_env=None):
+        if jinja_env:
+            return super().build_xml(context, jinja_env)
+        return self._renderizar_parte(self.modelo.corpo, self.docx._part, context)
+
+    def build_headers_footers_xml(self, context, uri, jinja_env=None):
+        if jinja_env:
+            yield from super().build_headers_footers_xml(context, uri, jinja_env)
+            return
+        for rel_key, part in self.get_headers_footers(uri):
+            template, encoding = self.modelo.partes[rel_key]
+            yield rel_key, self._renderizar_parte(template, part, context).encode(encoding)
+
+
+class ImagemInline(InlineImage):
+    """InlineImage de um RelatorioDocx que embute a imagem já lida por imagens.carregar_imagem_docx.
+
+    Faz o mesmo que StoryPart.new_pic_inline do python-docx, mas sem o
+    Image.from_file que releria o arquivo e o cabeçalho a cada relatório, e
+    sem a busca do python-docx por uma parte igual, que recalcula o SHA-1 de
+    todas as imagens do documento a cada foto embutida.
+    """
+
+    def _insert_image(self):
+        parte = self.tpl.current_rendering_part
+        imagem = carregar_imagem_docx(self.image_descriptor, self.tpl.imagens_lidas)
+        # Uma imagem repetida no mesmo relatório aponta para a mesma parte
+        parte_imagem = self.tpl.imagens_embutidas.get(imagem.sha1)
+        if parte_imagem is None:
+            parte_imagem = parte.package.image_parts._add_image_part(imagem)
+            self.tpl.imagens_embutidas[imagem.sha1] = parte_imagem
+        rid = parte.relate_to(parte_imagem, RT.IMAGE)
+        largura, altura = imagem.scaled_dimensions(self.width, self.height)
+        inline = CT_Inline.new_pic_inline(parte.next_id, rid, imagem.filename, largura, altura)
+        return (
+            "</w:t></w:r><w:r><w:drawing>%s</w:drawing></w:r><w:r>"
+            '<w:t xml:space="preserve">' % inline.xml
+        )
+
+
+def carregar_modelo(modelo_path):
+    """Retorna o modelo compilado do arquivo, reaproveitando-o se o conteúdo já foi visto"""
+    with open(modelo_path, 'rb') as f:
+        conteudo = f.read()
+
+    chave = hashlib.sha256(conteudo).hexdigest()
+    with _lock_modelos:
+        modelo = _modelos_compilados.get(chave)
+        if modelo is not None:
+            _modelos_compilados.move_to_end(chave)
+            return modelo
+
+    # Compilado fora do lock; se outra thread compilou o mesmo modelo nesse meio tempo, fica o dela
+    modelo = ModeloCompilado(conteudo)
+    with _lock_modelos:
+        modelo = _modelos_compilados.setdefault(chave, modelo)
+        while len(_modelos_compilados) > MAX_MODELOS_COMPILADOS:
+            _modelos_compilados.popitem(last=False)
+    return modelo
@@ -0,0 +1,460 @@
+"""Acesso ao ODK Central: sessão HTTP reaproveitada, requisições com novas tentativas, exportação revalidada por ETag, download de anexos (em paralelo ou numa exportação única) e sincronização incremental"""
+import csv
+import io
+import os
+import random
+import tempfile
+import time
+import zipfile
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from colunas import MAPEAMENTO_CAMPOS, NOMES_INSTANCE_ID, celula, indice_coluna
+
+# Respostas que valem uma nova tentativa (limite de taxa e falhas do servidor)
+STATUS_RETENTAVEIS = (429, 500, 502, 503, 504)
+# Tempo máximo para abrir a conexão e entre dois blocos da resposta
+TIMEOUT_CONEXAO = 10
+TIMEOUT_LEITURA = 60
+# Espera máxima pedida pelo servidor (Retry-After) que ainda vale atender
+ESPERA_MAXIMA_SEGUNDOS = 60
+
+# Downloads grandes ficam na memória até este tamanho e depois vão para um arquivo temporário
+LIMITE_MEMORIA_DOWNLOAD = 16 * 1024 * 1024
+TAMANHO_BLOCO_DOWNLOAD = 1024 * 1024
+# Submissions gravadas na base local por transação e listadas por página na API OData
+TAMANHO_LOTE_SUBMISSIONS = 5000
+TAMANHO_PAGINA_SUBMISSIONS = 1000
+# Pasta das fotos dentro da exportação submissions.csv.zip com attachments=true
+PASTA_MIDIA_EXPORTACAO = 'media/'
+
+
+def criar_sessao(auth, max_conexoes=8):
+    """Cria uma sessão com pool de conexões keep-alive para o ODK Central"""
+    sessao = requests.Session()
+    sessao.auth = auth
+    adaptador = HTTPAdapter(pool_connections=max_conexoes, pool_maxsize=max_conexoes)
+    sessao.mount('http://', adaptador)
+    sessao.mount('https://', adaptador)
+    return sessao
+
+
+def _espera(resposta, tentativa, backoff):
+    """Segundos até a próxima tentativa: o Retry-After do servidor ou espera exponencial com variação"""
+    if resposta is not None:
+        retry_after = resposta.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return min(int(retry_after), ESPERA_MAXIMA_SEGUNDOS)
+    # A variação evita que downloads paralelos tentem de novo todos ao mesmo tempo
+    return backoff * (2 ** tentativa) * random.uniform(0.5, 1.0)
+
+
+def requisitar(sessao, url, tentativas=3, backoff=1.0, timeout=(TIMEOUT_CONEXAO, TIMEOUT_LEITURA), params=None,
+               stream=False, headers=None):
+    """Faz um GET repetindo em erros de rede e respostas 429/5xx (Retry-After ou espera exponencial)"""
+    for tentativa in range(tentativas):
+        ultima = tentativa == tentativas - 1
+        resposta = None
+        try:
+            resposta = sessao.get(url, timeout=timeout, params=params, stream=stream, headers=headers)
+        except (requests.ConnectionError, requests.Timeout):
+            if ultima:
+                raise
+        else:
+            if resposta.status_code not in STATUS_RETENTAVEIS or ultima:
+                return resposta
+            resposta.close()
+        time.sleep(_espera(resposta, tentativa, backoff))
+
+
+def baixar_para_arquivo(sessao, url, params=None, tentativas=3):
+    """Baixa a resposta em blocos para um arquivo temporário (em memória enquanto for pequena).
+
+    Retorna o arquivo posicionado no início; quem chama deve fechá-lo.
+    """
+    with requisitar(sessao, url, tentativas, params=params, stream=True) as resposta:
+        return _gravar_resposta(resposta)
+
+
+def _gravar_resposta(resposta):
+    resposta.raise_for_status()
+    arquivo = tempfile.SpooledTemporaryFile(max_size=LIMITE_MEMORIA_DOWNLOAD)
+    try:
+        for bloco in resposta.iter_content(TAMANHO_BLOCO_DOWNLOAD):
+            arquivo.write(bloco)
+    except BaseException:
+        arquivo.close()
+        raise
+    arquivo.seek(0)
+    return arquivo
+
+
+def baixar_exportacao(sessao, url, params=None, cache_exportacoes=None, tentativas=3):
+    """Baixa uma exportação, ou reaproveita a do ``cache_exportacoes`` se o servidor disser que não mudou.
+
+    A requisição leva If-None-Match / If-Modified-Since da cópia guardada;
+    com 304, nada é transferido. Respostas novas com ETag ou Last-Modified
+    substituem a cópia. Retorna (arquivo aberto no início, True se veio do
+    cache); quem chama deve fechar o arquivo.
+    """
+    if cache_exportacoes is None:
+        return baixar_para_arquivo(sessao, url, params, tentativas), False
+
+    chave = cache_exportacoes.chave(url, params)
+    cabecalhos = cache_exportacoes.cabecalhos_condicionais(chave)
+    with requisitar(sessao, url, tentativas, params=params, stream=True, headers=cabecalhos) as resposta:
+        if resposta.status_code == 304:
+            guardada = cache_exportacoes.obter(chave)
+            if guardada is not None:
+                return open(guardada[0], 'rb'), True
+            # A cópia sumiu depois da consulta: baixar de novo, sem condição
+            return baixar_para_arquivo(sessao, url, params, tentativas), False
+        arquivo = _gravar_resposta(resposta)
+
+    etag = resposta.headers.get('ETag')
+    last_modified = resposta.headers.get('Last-Modified')
+    if etag or last_modified:
+        cache_exportacoes.guardar(chave, arquivo, etag, last_modified)
+        arquivo.seek(0)
+    return arquivo, False
+
+
+def iterar_submissions(sessao, base_url, tamanho_pagina=TAMANHO_PAGINA_SUBMISSIONS, tentativas=3):
+    """Percorre as submissions do formulário página por página ($top/$skip da API OData).
+
+    Cada item vem no formato usado por baixar_anexos: ``instanceId`` e o
+    grupo ``details`` (de onde sai o ID do projeto).
+    """
+    pular = 0
+    while True:
+        resposta = requisitar(
+            sessao, f"{base_url}.svc/Submissions", tentativas,
+            params={'$top': tamanho_pagina, '$skip': pular}
+        )
+        resposta.raise_for_status()
+        pagina = resposta.json().get('value', [])
+        for submission in pagina:
+            yield {'instanceId': submission.get('__id'), 'details': submission.get('details')}
+        if len(pagina) < tamanho_pagina:
+            return
+        pular += tamanho_pagina
+
+
+def extrair_id_projeto(submission):
+    """Retorna o ID do projeto (details-N_mero_ID) de uma submission, se houver"""
+    if 'details' in submission and isinstance(submission['details'], dict):
+        return submission['details'].get('N_mero_ID') or submission['details'].get('Numero_ID')
+    return submission.get('details-N_mero_ID')
+
+
+def _listar_anexos(sessao, base_url, submission, tentativas):
+    """Lista os anexos de uma submission e devolve as tarefas de download"""
+    instance_id = submission.get('instanceId')
+    id_projeto = extrair_id_projeto(submission)
+    attachments_url = f"{base_url}/submissions/{instance_id}/attachments"
+
+    resposta = requisitar(sessao, attachments_url, tentativas)
+    if resposta.status_code != 200:
+        raise RuntimeError(f"HTTP {resposta.status_code} ao listar anexos de {instance_id}")
+
+    return [
+        {
+            'instance_id': instance_id,
+            'id_projeto': id_projeto,
+            'nome': attachment.get('name'),
+            'url': f"{attachments_url}/{attachment.get('name')}"
+        }
+        for attachment in resposta.json()
+        # Anexos esperados pelo formulário mas ainda não enviados não têm arquivo
+        if attachment.get('exists', True)
+    ]
+
+
+def _baixar_anexo(sessao, tarefa, cache, tentativas):
+    """Baixa um anexo para o cache, a menos que ele já esteja lá"""
+    att_name = tarefa['nome']
+    caminho = cache.obter(tarefa['instance_id'], att_name)
+
+    if caminho is None:
+        resposta = requisitar(sessao, tarefa['url'], tentativas)
+        if resposta.status_code != 200:
+            raise RuntimeError(f"HTTP {resposta.status_code} ao baixar {att_name}")
+        caminho = cache.guardar(tarefa['instance_id'], att_name, resposta.content)
+
+    return _descrever_anexo(tarefa['instance_id'], tarefa['id_projeto'], att_name, caminho)
+
+
+def _descrever_anexo(instance_id, id_projeto, att_name, caminho):
+    """Registro de um anexo no cache, com o nome prefixado pelo ID do projeto"""
+    if id_projeto:
+        novo_nome = f"id{id_projeto}_{att_name}"
+    else:
+        novo_nome = att_name
+
+    # Só a referência ao arquivo; o conteúdo fica no disco e é lido quando necessário
+    return {
+        'instance_id': instance_id,
+        'nome_original': att_name,
+        'nome_com_id': novo_nome,
+        'caminho': caminho,
+        'tamanho': os.path.getsize(caminho)
+    }
+
+
+def baixar_anexos(sessao, base_url, submissions, cache, max_workers=8, tentativas=3, progresso=None):
+    """Baixa em paralelo os anexos de todas as submissions.
+
+    Primeiro lista os anexos de cada submission e depois baixa para o
+    ``cache`` (CacheAnexos) os arquivos que ainda não estão nele, ambos com no
+    máximo ``max_workers`` requisições simultâneas. A função
+    ``progresso(etapa, concluidos, total)`` é chamada na thread de quem chamou,
+    então pode atualizar widgets do Streamlit.
+
+    Retorna a lista de anexos baixados e a lista de erros, como pares
+    ``(instance_id, mensagem)``.
+    """
+    erros = []
+    tarefas = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futuros = {
+            executor.submit(_listar_anexos, sessao, base_url, submission, tentativas): submission
+            for submission in submissions
+        }
+        for concluidos, futuro in enumerate(as_completed(futuros), 1):
+            try:
+                tarefas.extend(futuro.result())
+            except Exception as e:
+                erros.append((futuros[futuro].get('instanceId'), f"Erro ao listar anexos: {e}"))
+            if progresso:
+                progresso('listando', concluidos, len(futuros))
+
+        anexos, erros_download = _baixar_em_paralelo(executor, sessao, tarefas, cache, tentativas, progresso)
+
+    return anexos, erros + erros_download
+
+
+def _baixar_em_paralelo(executor, sessao, tarefas, cache, tentativas, progresso):
+    """Baixa as tarefas de download no executor; retorna (anexos, erros)"""
+    anexos = []
+    erros = []
+    futuros = {
+        executor.submit(_baixar_anexo, sessao, tarefa, cache, tentativas): tarefa
+        for tarefa in tarefas
+    }
+    for concluidos, futuro in enumerate(as_completed(futuros), 1):
+        try:
+            anexos.append(futuro.result())
+        except Exception as e:
+            tarefa = futuros[futuro]
+            erros.append((tarefa['instance_id'], f"Erro ao baixar {tarefa['nome']}: {e}"))
+        if progresso:
+            progresso('baixando', concluidos, len(futuros))
+    return anexos, erros
+
+
+def baixar_anexos_referenciados(sessao, base_url, referencias, cache, max_workers=8, tentativas=3, progresso=None):
+    """Baixa para o cache só os anexos citados (ex.: pelas linhas escolhidas para gerar).
+
+    ``referencias`` vem de gerador.listar_imagens_referenciadas. A URL de
+    cada anexo é montada direto, sem listar os anexos da submission, e os
+    que já estão no cache não geram requisição; referências sem instanceID
+    ficam de fora. ``progresso`` segue baixar_anexos.
+
+    Retorna (anexos, erros como pares (instance_id, mensagem)).
+    """
+    tarefas = [
+        {
+            **referencia,
+            'url': f"{base_url}/submissions/{referencia['instance_id']}/attachments/{referencia['nome']}"
+        }
+        for referencia in referencias
+        if referencia['instance_id']
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return _baixar_em_paralelo(executor, sessao, tarefas, cache, tentativas, progresso)
+
+
+@contextmanager
+def abrir_csv_exportado(arquivo_zip):
+    """Abre o CSV principal de um submissions.csv.zip (arquivo ou caminho) como texto decodificado aos poucos"""
+    with zipfile.ZipFile(arquivo_zip, 'r') as zip_file:
+        with zip_file.open(_nome_csv(zip_file)) as membro:
+            yield io.TextIOWrapper(membro, encoding='utf-8', newline='')
+
+
+def _nome_csv(zip_file):
+    return [f for f in zip_file.namelist() if f.endswith('.csv')][0]
+
+
+def baixar_csv(sessao, base_url, base=None, cache_exportacoes=None):
+    """Baixa o CSV de submissions do formulário.
+
+    Com ``base`` (BaseLocal), traz só as submissions novas e monta o CSV a
+    partir da base local. Sem ela, baixa a exportação completa; com
+    ``cache_exportacoes`` (CacheExportacoes), ela só é baixada de novo se
+    o servidor disser que mudou.
+    Retorna (texto do CSV, número de submissions novas ou None).
+    """
+    if base is not None:
+        novas = sincronizar_submissions(sessao, base_url, base)
+        return base.gerar_csv(base_url), novas
+
+    # O ZIP é baixado em blocos e só o texto do CSV fica inteiro na memória
+    arquivo, _ = baixar_exportacao(
+        sessao, f"{base_url}/submissions.csv.zip", {'attachments': 'false'}, cache_exportacoes
+    )
+    with arquivo:
+        with abrir_csv_exportado(arquivo) as texto:
+            return texto.read(), None
+
+
+def baixar_anexos_em_lote(sessao, base_url, cache, filtro=None, tentativas=3, progresso=None):
+    """Baixa a exportação submissions.csv.zip com a mídia e extrai os anexos para o cache.
+
+    Uma única transferência substitui a listagem dos anexos de cada
+    submission e os downloads arquivo a arquivo. O ZIP vai para um arquivo
+    temporário e cada foto de ``media/`` é copiada dele para o cache em
+    blocos; o CSV da exportação diz a que submission (e a que ID de projeto)
+    cada arquivo pertence. ``filtro`` é um $filter OData aplicado à
+    exportação. ``progresso('extraindo', concluidos, total)`` segue baixar_anexos.
+
+    Retorna (anexos, erros como pares (instance_id, mensagem), instanceIds exportados).
+    """
+    params = {'attachments': 'true'}
+    if filtro:
+        params['$filter'] = filtro
+
+    anexos = []
+    erros = []
+    instance_ids = []
+    with baixar_para_arquivo(sessao, f"{base_url}/submissions.csv.zip", params, tentativas) as arquivo:
+        with zipfile.ZipFile(arquivo, 'r') as zip_file:
+            membros = {
+                os.path.basename(nome): nome for nome in zip_file.namelist()
+                if nome.startswith(PASTA_MIDIA_EXPORTACAO) and not nome.endswith('/')
+            }
+
+            # Dono de cada arquivo: a submission em cuja linha o nome aparece
+            donos = {}
+            with zip_file.open(_nome_csv(zip_file)) as membro:
+                leitor = csv.reader(io.TextIOWrapper(membro, encoding='utf-8', newline=''))
+                cabecalho = next(leitor, [])
+                col_id = indice_coluna(cabecalho, *NOMES_INSTANCE_ID)
+                col_projeto = indice_coluna(cabecalho, *MAPEAMENTO_CAMPOS['id_proj'][0])
+                for linha in leitor:
+                    instance_id = celula(linha, col_id)
+                    if not instance_id:
+                        continue
+                    instance_ids.append(instance_id)
+                    for valor in linha:
+                        if valor in membros and valor not in donos:
+                            donos[valor] = (instance_id, celula(linha, col_projeto) or None)
+
+            for concluidos, (nome, membro) in enumerate(membros.items(), 1):
+                instance_id, id_projeto = donos.get(nome, (None, None))
+                if instance_id is None:
+                    erros.append((None, f"Anexo {nome} não aparece em nenhuma submission do CSV"))
+                    continue
+                try:
+                    caminho = cache.obter(instance_id, nome)
+                    if caminho is None:
+                        with zip_file.open(membro) as fluxo:
+                            caminho = cache.guardar_fluxo(instance_id, nome, fluxo)
+                    anexos.append(_descrever_anexo(instance_id, id_projeto, nome, caminho))
+                except Exception as e:
+                    erros.append((instance_id, f"Erro ao extrair {nome}: {e}"))
+                if progresso:
+                    progresso('extraindo', concluidos, len(membros))
+
+    return anexos, erros, instance_ids
+
+
+def sincronizar_anexos(sessao, base_url, cache, base=None, max_workers=8, progresso=None, em_lote=False):
+    """Baixa para o cache os anexos das submissions do formulário.
+
+    Com ``base`` (BaseLocal), só as submissions cujos anexos ainda não foram
+    baixados (ou saíram do cache desde então) são consultadas, e o
+    resultado fica registrado na base; os
+    anexos devolvidos são todos os já conhecidos pela base. Sem ela, todas
+    as submissions são listadas na API. ``progresso`` segue baixar_anexos.
+    Com ``em_lote``, os anexos vêm de uma só exportação com a mídia
+    (baixar_anexos_em_lote); na base, a exportação é filtrada a partir da
+    submission mais antiga ainda sem anexos.
+
+    Retorna (anexos, erros como pares (instance_id, mensagem)).
+    """
+    if base is not None:
+        base.revalidar_anexos(base_url)
+
+    if em_lote:
+        filtro = None
+        if base is not None:
+            desde = base.data_mais_antiga_sem_anexos(base_url)
+            if desde is None:
+                return base.listar_anexos(base_url), []
+            filtro = f"__system/submissionDate ge {desde}"
+        anexos, erros, consultadas = baixar_anexos_em_lote(
+            sessao, base_url, cache, filtro, progresso=progresso
+        )
+    else:
+        if base is not None:
+            submissions = base.submissions_sem_anexos(base_url)
+        else:
+            submissions = iterar_submissions(sessao, base_url)
+        anexos, erros = baixar_anexos(
+            sessao, base_url, submissions, cache, max_workers=max_workers, progresso=progresso
+        )
+        consultadas = [s['instanceId'] for s in submissions] if base is not None else []
+
+    if base is not None:
+        falhas = {instance_id for instance_id, _ in erros}
+        base.registrar_anexos(
+            base_url, anexos, [instance_id for instance_id in consultadas if instance_id not in falhas]
+        )
+        anexos = base.listar_anexos(base_url)
+    return anexos, erros
+
+
+def sincronizar_submissions(sessao, base_url, base, completa=False):
+    """Traz para a base local apenas as submissions novas desde a última sincronização.
+
+    Usa o filtro OData ``__system/submissionDate gt <watermark>`` da exportação
+    CSV do ODK Central. Se o cabeçalho do formulário mudou (nova versão com
+    colunas diferentes), refaz a sincronização completa. A exportação não é
+    carregada inteira na memória: o ZIP vai para um arquivo temporário e as
+    linhas são gravadas em lotes de TAMANHO_LOTE_SUBMISSIONS.
+
+    Retorna o número de submissions novas.
+    """
+    cabecalho_salvo, watermark = base.obter_estado(base_url)
+    params = {'attachments': 'false'}
+    if watermark and not completa:
+        params['$filter'] = f"__system/submissionDate gt {watermark}"
+
+    # Exportação baixada em blocos e lida linha a linha, gravando na base em lotes
+    with baixar_para_arquivo(sessao, f"{base_url}/submissions.csv.zip", params) as arquivo:
+        with abrir_csv_exportado(arquivo) as texto:
+            leitor = csv.reader(texto)
+            cabecalho = next(leitor, None)
+            if cabecalho is None:
+                return 0
+            refazer = '$filter' in params and cabecalho != cabecalho_salvo
+
+            if not refazer:
+                if completa or not watermark:
+                    base.limpar(base_url)
+                linhas = (linha for linha in leitor if linha)
+                total = 0
+                while True:
+                    lote = list(islice(linhas, TAMANHO_LOTE_SUBMISSIONS))
+                    if not lote:
+                        return total
+                    base.gravar_submissions(base_url, cabecalho, lote)
+                    total += len(lote)
+
+    return sincronizar_submissions(sessao, base_url, base, completa=True)
@@ -0,0 +1,289 @@
+"""Geração de relatórios em segundo plano: fila de tarefas, progresso e ZIPs guardados por um prazo"""
+import atexit
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import gerador
+import odk
+from areas_trabalho import INTERVALO_LIMPEZA, tamanho_pasta
+from conversor_pdf import PoolConversorPDF
+from instrumentacao import Instrumentacao
+
+DIRETORIO_TAREFAS = os.path.join(tempfile.gettempdir(), 'sepe_tarefas')
+TAREFAS_SIMULTANEAS = int(os.environ.get('SEPE_TAREFAS_SIMULTANEAS', '2'))
+RETENCAO_SEGUNDOS = int(os.environ.get('SEPE_RETENCAO_TAREFAS_H', '24')) * 3600
+LIMITE_TAREFAS_BYTES = int(os.environ.get('SEPE_LIMITE_TAREFAS_MB', '4096')) * 1024 * 1024
+
+NA_FILA = 'na_fila'
+EXECUTANDO = 'executando'
+CONCLUIDA = 'concluida'
+FALHOU = 'falhou'
+ESTADOS_ATIVOS = (NA_FILA, EXECUTANDO)
+
+# Intervalo mínimo entre gravações do progresso na base
+INTERVALO_PROGRESSO = 0.5
+# Erros de download de anexos citados na mensagem da tarefa
+ERROS_ANEXOS_NA_MENSAGEM = 5
+
+
+class GerenciadorTarefas:
+    """Executa as gerações em threads de fundo e guarda o estado de cada uma numa base SQLite.
+
+    Cada tarefa tem uma pasta própria com o modelo e o ZIP gerado, e é
+    identificada por um código que permite acompanhá-la e baixar o
+    resultado de outra sessão (por exemplo, depois de recarregar a página).
+    No máximo ``max_simultaneas`` tarefas rodam ao mesmo tempo; as demais
+    esperam na fila. Tarefas terminadas há mais de ``retencao_segundos``
+    são apagadas junto com os arquivos, e também as terminadas mais
+    antigas quando as pastas passam de ``limite_bytes``. Com ``cache_relatorios``
+    (CacheRelatorios), relatórios que não mudaram desde uma geração
+    anterior são reaproveitados. O pool de conversão para PDF é
+    compartilhado por todas as tarefas.
+    """
+
+    def __init__(self, cache=None, diretorio=DIRETORIO_TAREFAS, max_simultaneas=TAREFAS_SIMULTANEAS,
+                 retencao_segundos=RETENCAO_SEGUNDOS, cache_relatorios=None, limite_bytes=LIMITE_TAREFAS_BYTES):
+        self.cache = cache
+        self.cache_relatorios = cache_relatorios
+        # Instâncias do LibreOffice, iniciadas na primeira tarefa que pedir PDF e mantidas abertas
+        self._conversor_pdf = None
+        self.diretorio = diretorio
+        self.retencao_segundos = retencao_segundos
+        self.limite_bytes = limite_bytes
+        self._ultima_limpeza = 0
+        os.makedirs(diretorio, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.conexao = sqlite3.connect(os.path.join(diretorio, 'tarefas.db'), check_same_thread=False)
+        with self.conexao:
+            self.conexao.executescript("""
+                CREATE TABLE IF NOT EXISTS tarefas (
+                    id TEXT PRIMARY KEY,
+                    estado TEXT NOT NULL,
+                    criada_em REAL NOT NULL,
+                    iniciada_em REAL,
+                    concluida_em REAL,
+                    total INTEGER NOT NULL,
+                    concluidos INTEGER NOT NULL DEFAULT 0,
+                    relatorio_atual TEXT,
+                    gerados INTEGER,
+                    erros TEXT,
+                    mensagem TEXT,
+                    zip_path TEXT,
+                    metricas TEXT
+                );
+            """)
+            # Bases criadas antes das métricas por tarefa
+            colunas = {linha[1] for linha in self.conexao.execute("PRAGMA table_info(tarefas)")}
+            if 'metricas' not in colunas:
+                self.conexao.execute("ALTER TABLE tarefas ADD COLUMN metricas TEXT")
+            # Tarefas que estavam rodando quando o servidor parou não vão terminar
+            self.conexao.execute(
+                "UPDATE tarefas SET estado = ?, mensagem = ?, concluida_em = ? WHERE estado IN (?, ?)",
+                (FALHOU, "Interrompida pelo reinício do servidor", time.time(), *ESTADOS_ATIVOS)
+            )
+        self._executor = ThreadPoolExecutor(max_workers=max_simultaneas, thread_name_prefix='tarefa')
+        self.remover_expiradas()
+
+    def _atualizar(self, id_tarefa, **campos):
+        colunas = ', '.join(f"{coluna} = ?" for coluna in campos)
+        with self._lock, self.conexao:
+            self.conexao.execute(f"UPDATE tarefas SET {colunas} WHERE id = ?", (*campos.values(), id_tarefa))
+
+    def enviar(self, csv_texto, modelo_conteudo, indices_selecionados, diretorios_midia=(), workers=1,
+               dpi_imagens=None, incluir_xlsx=False, perfil=False, anexos_odk=None, incluir_pdf=False):
+        """Coloca uma geração na fila e retorna o código da tarefa.
+
+        Os parâmetros seguem gerador.gerar_zip; ``modelo_conteudo`` são os
+        bytes do DOCX, gravados na pasta da tarefa. Com ``perfil``, a
+        geração roda sob o cProfile (na thread da tarefa; processos de
+        renderização ficam de fora) e o perfil.prof fica na pasta da tarefa.
+        Com ``anexos_odk`` (dicionário com 'base_url', 'auth' e
+        'max_conexoes'), antes de renderizar são baixados para o cache só os
+        anexos citados nas linhas selecionadas (modo de anexos sob demanda).
+        Com ``incluir_pdf``, o ZIP leva também o PDF de cada relatório.
+        """
+        self.remover_expiradas()
+
+        id_tarefa = uuid.uuid4().hex
+        pasta = os.path.join(self.diretorio, id_tarefa)
+        # Na base antes da pasta, para a limpeza nunca tomar a pasta por órfã
+        with self._lock, self.conexao:
+            self.conexao.execute(
+                "INSERT INTO tarefas (id, estado, criada_em, total, zip_path) VALUES (?, ?, ?, ?, ?)",
+                (id_tarefa, NA_FILA, time.time(), len(indices_selecionados),
+                 os.path.join(pasta, 'relatorios.zip'))
+            )
+        os.makedirs(pasta)
+        modelo_path = os.path.join(pasta, 'formulario.docx')
+        with open(modelo_path, 'wb') as f:
+            f.write(modelo_conteudo)
+
+        self._executor.submit(
+            self._executar, id_tarefa, csv_texto, modelo_path, list(indices_selecionados),
+            list(diretorios_midia), workers, dpi_imagens, incluir_xlsx, perfil, anexos_odk, incluir_pdf
+        )
+        return id_tarefa
+
+    def _obter_conversor_pdf(self):
+        with self._lock:
+            if self._conversor_pdf is None:
+                self._conversor_pdf = PoolConversorPDF()
+                atexit.register(self._conversor_pdf.fechar)
+            return self._conversor_pdf
+
+    def _baixar_anexos(self, id_tarefa, csv_texto, indices, anexos_odk, cache, registro):
+        """Baixa para o cache os anexos citados nas linhas da tarefa, mostrando o andamento na mensagem.
+
+        Retorna os erros de download, como pares (instance_id, mensagem).
+        """
+        referencias = gerador.listar_imagens_referenciadas(csv_texto, indices)
+        ultima_gravacao = [0.0]
+
+        def registrar_progresso(etapa, concluidos, total):
+            agora = time.monotonic()
+            if agora - ultima_gravacao[0] >= INTERVALO_PROGRESSO or concluidos == total:
+                ultima_gravacao[0] = agora
+                self._atualizar(id_tarefa, mensagem=f"Baixando anexos: {concluidos} de {total}")
+
+        sessao = odk.criar_sessao(anexos_odk['auth'], max_conexoes=anexos_odk['max_conexoes'])
+        with sessao:
+            anexos, erros = odk.baixar_anexos_referenciados(
+                sessao, anexos_odk['base_url'], referencias, cache,
+                max_workers=anexos_odk['max_conexoes'], progresso=registrar_progresso
+            )
+        self._atualizar(id_tarefa, mensagem=None)
+        registro['itens'] = len(anexos)
+        registro['bytes'] = sum(anexo['tamanho'] for anexo in anexos)
+        registro['erros'] = len(erros)
+        return erros
+
+    def _executar(self, id_tarefa, csv_texto, modelo_path, indices, diretorios_midia, workers, dpi_imagens,
+                  incluir_xlsx, perfil, anexos_odk, incluir_pdf):
+        self._atualizar(id_tarefa, estado=EXECUTANDO, iniciada_em=time.time())
+        pasta = os.path.dirname(modelo_path)
+        zip_path = os.path.join(pasta, 'relatorios.zip')
+        instrumentacao = Instrumentacao(f"tarefa {id_tarefa}", perfil=perfil)
+        ultima_gravacao = [0.0]
+
+        def registrar_progresso(concluidos, relatorio):
+            agora = time.monotonic()
+            if agora - ultima_gravacao[0] >= INTERVALO_PROGRESSO or concluidos == len(indices):
+                ultima_gravacao[0] = agora
+                self._atualizar(id_tarefa, concluidos=concluidos, relatorio_atual=str(relatorio))
+
+        instrumentacao.iniciar_perfil()
+        try:
+            erros_anexos = []
+            # Anexos baixados para esta tarefa ficam no cache até o fim da renderização
+            with self.cache.fixando() if self.cache else nullcontext() as cache:
+                if anexos_odk:
+                    with instrumentacao.etapa('anexos_sob_demanda') as registro:
+                        erros_anexos = self._baixar_anexos(id_tarefa, csv_texto, indices, anexos_odk, cache, registro)
+                with instrumentacao.etapa('indice_midia') as registro:
+                    indice_midia = gerador.IndiceMidia(cache, diretorios_midia)
+                    registro['itens'] = len(indice_midia)
+                gerados, erros = gerador.gerar_zip(
+                    csv_texto, modelo_path, zip_path, indice_midia.localizar, indices,
+                    workers=max(1, min(workers, len(indices))),
+                    progresso=registrar_progresso,
+                    dpi_imagens=dpi_imagens,
+                    incluir_xlsx=incluir_xlsx,
+                    instrumentacao=instrumentacao,
+                    cache_relatorios=self.cache_relatorios,
+                    conversor_pdf=self._obter_conversor_pdf() if incluir_pdf else None
+                )
+            instrumentacao.parar_perfil(os.path.join(pasta, 'perfil.prof'))
+            resumo = instrumentacao.gravar_log(
+                tarefa=id_tarefa, workers=workers, erros=len(erros), erros_anexos=len(erros_anexos)
+            )
+            self._atualizar(
+                id_tarefa, estado=CONCLUIDA, concluida_em=time.time(), concluidos=len(indices),
+                gerados=len(gerados), erros=json.dumps(erros), metricas=json.dumps(resumo),
+                mensagem=self._descrever_erros_anexos(erros_anexos)
+            )
+        except Exception as e:
+            mensagem = f"{type(e).__name__}: {e}"
+            instrumentacao.parar_perfil()
+            resumo = instrumentacao.gravar_log(tarefa=id_tarefa, workers=workers, falha=mensagem)
+            self._atualizar(
+                id_tarefa, estado=FALHOU, concluida_em=time.time(), mensagem=mensagem,
+                metricas=json.dumps(resumo)
+            )
+
+    @staticmethod
+    def _descrever_erros_anexos(erros_anexos):
+        """Aviso guardado na mensagem de uma tarefa concluída cujos anexos não vieram todos"""
+        if not erros_anexos:
+            return None
+        detalhes = '; '.join(erro for _, erro in erros_anexos[:ERROS_ANEXOS_NA_MENSAGEM])
+        if len(erros_anexos) > ERROS_ANEXOS_NA_MENSAGEM:
+            detalhes += f"; e mais {len(erros_anexos) - ERROS_ANEXOS_NA_MENSAGEM}"
+        return (f"{len(erros_anexos)} anexos não puderam ser baixados e aparecem como \"sem imagem\" "
+                f"nos relatórios: {detalhes}")
+
+    def obter(self, id_tarefa):
+        """Estado da tarefa como dicionário, ou None se o código não existe (ou já expirou)"""
+        # Consultada a cada poucos segundos pelo app: aproveitar para limpar de vez em quando
+        if time.monotonic() - self._ultima_limpeza > INTERVALO_LIMPEZA:
+            self.remover_expiradas()
+        with self._lock:
+            cursor = self.conexao.execute("SELECT * FROM tarefas WHERE id = ?", (id_tarefa,))
+            linha = cursor.fetchone()
+            if linha is None:
+                return None
+            tarefa = dict(zip([coluna[0] for coluna in cursor.description], linha))
+        tarefa['erros'] = json.loads(tarefa['erros']) if tarefa['erros'] else []
+        tarefa['metricas'] = json.loads(tarefa['metricas']) if tarefa['metricas'] else None
+        if tarefa['concluida_em']:
+            tarefa['expira_em'] = tarefa['concluida_em'] + self.retencao_segundos
+        return tarefa
+
+    def remover_expiradas(self):
+        """Apaga as tarefas terminadas há mais tempo que a retenção, com as suas pastas.
+
+        Se as pastas que sobram passam de ``limite_bytes``, apaga também as
+        tarefas terminadas mais antigas; as que estão na fila ou rodando
+        nunca são apagadas. Pastas sem tarefa na base (restos de uma
+        base apagada) também são removidas depois da retenção.
+        """
+        self._ultima_limpeza = time.monotonic()
+        limite = time.time() - self.retencao_segundos
+        with self._lock:
+            terminadas = self.conexao.execute(
+                "SELECT id, concluida_em FROM tarefas WHERE estado NOT IN (?, ?) ORDER BY concluida_em",
+                ESTADOS_ATIVOS
+            ).fetchall()
+            conhecidas = {linha[0] for linha in self.conexao.execute("SELECT id FROM tarefas")}
+        ids = [id_tarefa for id_tarefa, concluida_em in terminadas if concluida_em < limite]
+
+        restantes = [id_tarefa for id_tarefa, concluida_em in terminadas if concluida_em >= limite]
+        tamanhos = {id_tarefa: tamanho_pasta(os.path.join(self.diretorio, id_tarefa)) for id_tarefa in restantes}
+        total = sum(tamanhos.values()) + sum(
+            tamanho_pasta(os.path.join(self.diretorio, id_tarefa))
+            for id_tarefa in conhecidas.difference(tamanhos, ids)
+        )
+        for id_tarefa in restantes:
+            if total <= self.limite_bytes:
+                break
+            ids.append(id_tarefa)
+            total -= tamanhos[id_tarefa]
+
+        with self._lock, self.conexao:
+            self.conexao.executemany("DELETE FROM tarefas WHERE id = ?", [(i,) for i in ids])
+        # Só as antigas: uma pasta recém-criada pode ser de uma tarefa que ainda vai entrar na base
+        orfas = [
+            entrada.name for entrada in os.scandir(self.diretorio)
+            if entrada.is_dir() and entrada.name not in conhecidas and entrada.stat().st_mtime < limite
+        ]
+        for id_tarefa in ids + orfas:
+            shutil.rmtree(os.path.join(self.diretorio, id_tarefa), ignore_errors=True)
+        return len(ids)